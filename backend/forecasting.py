@@ -0,0 +1,39 @@
+"""Demand model fitting, kept free of the API's imports.
+
+The forecast process pool spawns fresh interpreters and pickles ``fit_demand`` by
+module name, so each worker imports only this module and numpy.
+"""
+from typing import Tuple
+
+import numpy as np
+
+# Average days between demands above which a series counts as intermittent (Syntetos-Boylan)
+CROSTON_ADI_THRESHOLD = 1.32
+
+def fit_demand(history: np.ndarray, alpha: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fit every row of ``history`` (series x days) at once.
+
+    Smooth series use simple exponential smoothing and intermittent ones Croston
+    with the Syntetos-Boylan correction. Returns the daily demand forecast, the
+    standard deviation of one-step-ahead errors and the Croston mask.
+    """
+    n, days = history.shape
+    nonzero = (history > 0).sum(axis=1)
+    intermittent = (nonzero > 0) & (days / np.maximum(nonzero, 1) > CROSTON_ADI_THRESHOLD)
+    level = history[:, :min(days, 7)].mean(axis=1)
+    size = history.sum(axis=1) / np.maximum(nonzero, 1)
+    interval = days / np.maximum(nonzero, 1).astype(float)
+    since = np.ones(n)
+    sq_error = np.zeros(n)
+    bias = 1 - alpha / 2
+    for t in range(days):
+        y = history[:, t]
+        forecast = np.where(intermittent, bias * size / interval, level)
+        sq_error += (y - forecast) ** 2
+        level += alpha * (y - level)
+        update = intermittent & (y > 0)
+        size = np.where(update, size + alpha * (y - size), size)
+        interval = np.where(update, interval + alpha * (since - interval), interval)
+        since = np.where(y > 0, 1.0, since + 1.0)
+    forecast = np.where(intermittent, bias * size / interval, level)
+    return forecast, np.sqrt(sq_error / max(days, 1)), intermittent
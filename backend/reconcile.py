@@ -0,0 +1,50 @@
+"""Stock balance reconciliation from the command line.
+
+    python reconcile.py            # report drift only
+    python reconcile.py --repair   # also write the recomputed balances back
+
+Reads MONGO_URL and DB_NAME the same way the API does.
+"""
+import asyncio
+
+import typer
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import server
+
+cli = typer.Typer(add_completion=False)
+
+async def reconcile(repair: bool) -> dict:
+    settings = server.Settings.from_env()
+    if not settings.mongo_url or not settings.db_name:
+        raise typer.BadParameter("MONGO_URL and DB_NAME must be set")
+    motor_client = AsyncIOMotorClient(settings.mongo_url)
+    server.client.bind(motor_client)
+    server.db.bind(motor_client[settings.db_name])
+    try:
+        return await server.reconcile_stock(repair)
+    finally:
+        motor_client.close()
+        server.client.bind(None)
+        server.db.bind(None)
+
+@cli.command()
+def main(
+    repair: bool = typer.Option(False, "--repair", help="Overwrite drifted balances with the recomputed quantities"),
+    show: int = typer.Option(20, help="How many of the largest discrepancies to print"),
+):
+    summary = asyncio.run(reconcile(repair))
+    typer.echo(f"Transactions:     {summary['transactions']}")
+    typer.echo(f"Balances checked: {summary['balances_checked']}")
+    typer.echo(f"Discrepancies:    {summary['discrepancy_count']}")
+    if repair:
+        typer.echo(f"Repaired:         {summary['repaired']}")
+        typer.echo(f"Left alone:       {summary['repair_skipped']}")
+    for d in summary['discrepancies'][:show]:
+        actual = "missing" if d['actual'] is None else f"{d['actual']:.4f}"
+        skipped = f" (not repaired: {d['repair_skipped']})" if d.get('repair_skipped') else ""
+        typer.echo(f"  {d['item_id']} @ {d['warehouse_id']}: expected {d['expected']:.4f}, stock_balance {actual}{skipped}")
+    raise typer.Exit(1 if summary['discrepancy_count'] > (summary['repaired'] if repair else 0) else 0)
+
+if __name__ == "__main__":
+    cli()
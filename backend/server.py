@@ -1,36 +1,108 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import encode as bson_encode
+from bson.errors import InvalidDocument
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, TypeAdapter
+from typing import TYPE_CHECKING, List, Optional, Dict, Any, Tuple
 import uuid
+import asyncio
+import bisect
+import copy
+import csv
+import hashlib
+import inspect
+import io
+import json
+import math
+import re
+import statistics
+import time
+import zipfile
+import zlib
+from xml.sax.saxutils import escape
+from decimal import Decimal, ROUND_HALF_UP
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; responses fall back to gzip
+    brotli = None
 from enum import Enum
 
+if TYPE_CHECKING:
+    # Imported where used so workers that never convert UOMs or price POs don't load it
+    import numpy as np
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+class Settings(BaseModel):
+    mongo_url: Optional[str] = None
+    db_name: Optional[str] = None
+    cors_origins: List[str] = ["*"]
+    compression_min_size: int = 1024
+    # Backfills run before the worker serves; index builds continue in the background
+    startup_maintenance: bool = True
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            mongo_url=os.environ.get('MONGO_URL'),
+            db_name=os.environ.get('DB_NAME'),
+            cors_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+            compression_min_size=int(os.environ.get('COMPRESSION_MIN_SIZE', '1024')),
+            startup_maintenance=os.environ.get('STARTUP_MAINTENANCE', '1') != '0',
+        )
+
+class _Bound:
+    """Stands in for a Motor object until the app lifespan binds the real one."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._target = None
+
+    def bind(self, target):
+        self._target = target
+
+    def _resolve(self):
+        if self._target is None:
+            raise RuntimeError(f"MongoDB {self._name} is not connected; serve the app from create_app()")
+        return self._target
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+# MongoDB connection, opened by the app lifespan
+client = _Bound("client")
+db = _Bound("db")
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
 
-security = HTTPBearer()
+# Tolerance for float quantity comparisons (over-receipt, cover checks, archive filters)
+QTY_EPSILON = 1e-9
+
+security = HTTPBearer(auto_error=False)
 
-# Create the main app
-app = FastAPI(title="ERP Inventory Management System")
 api_router = APIRouter(prefix="/api")
 
 # Enums
@@ -99,6 +171,8 @@ class ItemCategory(BaseModel):
     code: str
     name: str
     parent_category: Optional[str] = None
+    # Materialized ancestor ids, root first and ending with this category
+    path_ids: List[str] = []
     inventory_type: InventoryType
     default_uom: str
     default_hsn: Optional[str] = None
@@ -126,9 +200,23 @@ class ItemMaster(BaseModel):
     expense_account: Optional[str] = None
     barcode: Optional[str] = None
     remarks: Optional[str] = None
+    # Set by the ABC/XYZ classification job
+    abc_class: Optional[str] = None
+    xyz_class: Optional[str] = None
     status: str = "Active"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+# ItemMaster fields only the classification job writes; an item edit leaves them alone
+ITEM_JOB_FIELDS = {"abc_class", "xyz_class"}
+
+class ItemSearchResult(BaseModel):
+    id: str
+    item_code: str
+    item_name: str
+    uom: str
+    barcode: Optional[str] = None
+    status: str = "Active"
+
 class UOMMaster(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -139,6 +227,20 @@ class UOMMaster(BaseModel):
     status: str = "Active"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class UOMConversionLine(BaseModel):
+    qty: float
+    from_uom: str
+    to_uom: str
+
+class UOMConversionRequest(BaseModel):
+    lines: List[UOMConversionLine]
+    round_to_precision: bool = True
+
+class UOMConversionResult(BaseModel):
+    qty: Optional[float] = None
+    uom: str
+    error: Optional[str] = None
+
 class SupplierMaster(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -162,6 +264,10 @@ class WarehouseMaster(BaseModel):
     location: Optional[str] = None
     capacity: Optional[float] = None
     parent_warehouse_id: Optional[str] = None
+    # Materialized ancestor ids, root first and ending with this warehouse
+    path_ids: List[str] = []
+    # Two-digit GST state code, used to decide intra- vs inter-state tax
+    gst_state_code: Optional[str] = None
     status: str = "Active"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -177,6 +283,38 @@ class BINLocationMaster(BaseModel):
     status: str = "Active"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class BinStockBalance(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    item_id: str
+    item_name: str
+    warehouse_id: str
+    bin_location_id: str
+    bin_code: str
+    walk_key: str
+    qty: float = 0.0
+    uom: str
+    last_updated: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class LotBalance(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    item_id: str
+    item_name: str
+    warehouse_id: str
+    batch_no: str
+    expiry_date: Optional[datetime] = None
+    qty: float = 0.0
+    uom: str
+    received_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    last_updated: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class PickSuggestion(BaseModel):
+    bin_location_id: str
+    bin_code: str
+    available_qty: float
+    pick_qty: float
+
 class TaxHSNMaster(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -189,6 +327,10 @@ class TaxHSNMaster(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # ============ Purchase Models ============
+class RepriceRequest(BaseModel):
+    # Only reprice drafts with lines under these HSN codes; all drafts if omitted
+    hsn_codes: Optional[List[str]] = None
+
 class PurchaseIndentItem(BaseModel):
     item_id: str
     item_name: str
@@ -220,6 +362,16 @@ class POItem(BaseModel):
     tax_rate: float = 0.0
     tax_amount: float = 0.0
     total: float
+    # Computed server-side from the HSN rate table
+    hsn: Optional[str] = None
+    cgst_amount: float = 0.0
+    sgst_amount: float = 0.0
+    igst_amount: float = 0.0
+    # Maintained server-side by GRN and QC posting
+    received_qty: float = 0.0
+    accepted_qty: float = 0.0
+    rejected_qty: float = 0.0
+    open_qty: Optional[float] = None
 
 class PurchaseOrder(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -228,7 +380,10 @@ class PurchaseOrder(BaseModel):
     indent_id: Optional[str] = None
     supplier_id: str
     supplier_name: str
+    # Delivery warehouse; its state decides intra- vs inter-state GST
+    warehouse_id: Optional[str] = None
     items: List[POItem]
+    tax_type: Optional[str] = None
     subtotal: float
     tax_amount: float
     total_amount: float
@@ -238,6 +393,8 @@ class PurchaseOrder(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     approved_by: Optional[str] = None
     approved_at: Optional[datetime] = None
+    current_approver_role: Optional[str] = None
+    open_qty: Optional[float] = None
     remarks: Optional[str] = None
 
 # ============ Quality Models ============
@@ -259,6 +416,25 @@ class QualityCheck(BaseModel):
     inspected_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     remarks: Optional[str] = None
 
+class SupplierScore(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    supplier_id: str
+    supplier_name: Optional[str] = None
+    # Calendar month, YYYY-MM
+    period: str
+    grn_count: int = 0
+    received_qty: float = 0.0
+    avg_lead_time_days: Optional[float] = None
+    max_lead_time_days: Optional[float] = None
+    ordered_qty: float = 0.0
+    filled_qty: float = 0.0
+    fill_rate: Optional[float] = None
+    accepted_qty: float = 0.0
+    rejected_qty: float = 0.0
+    rejection_rate: Optional[float] = None
+    score: Optional[float] = None
+    computed_at: datetime
+
 # ============ Inventory Models ============
 class GRN(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -277,6 +453,8 @@ class GRN(BaseModel):
     invoice_date: Optional[datetime] = None
     transport_details: Optional[str] = None
     status: str = "Pending QC"
+    # Quantity inspected so far across the GRN's quality checks
+    qc_qty: float = 0.0
     received_by: str
     received_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -292,6 +470,7 @@ class StockInward(BaseModel):
     warehouse_id: str
     bin_location_id: Optional[str] = None
     batch_no: Optional[str] = None
+    expiry_date: Optional[datetime] = None
     status: str = "Completed"
     created_by: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -313,6 +492,7 @@ class StockTransfer(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     approved_by: Optional[str] = None
     approved_at: Optional[datetime] = None
+    current_approver_role: Optional[str] = None
 
 class IssueToDepartment(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -325,10 +505,60 @@ class IssueToDepartment(BaseModel):
     uom: str
     warehouse_id: str
     warehouse_name: str
+    bin_location_id: Optional[str] = None
+    # Restricts the issue to one lot; otherwise lots are allocated FEFO
+    batch_no: Optional[str] = None
+    lot_allocations: List[Dict[str, Any]] = []
+    # Reservation this issue draws down; it is consumed in full
+    reservation_id: Optional[str] = None
     issued_by: str
     issued_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     remarks: Optional[str] = None
 
+class ReservationSource(str, Enum):
+    INDENT = "Indent"
+    ISSUE = "Issue"
+
+class ReservationStatus(str, Enum):
+    ACTIVE = "Active"
+    CONSUMED = "Consumed"
+    RELEASED = "Released"
+    EXPIRED = "Expired"
+
+class StockReservationRequest(BaseModel):
+    item_id: str
+    warehouse_id: str
+    qty: float = Field(gt=0)
+    uom: str
+    source_type: ReservationSource
+    source_id: Optional[str] = None
+    department: Optional[str] = None
+    ttl_minutes: int = Field(default=24 * 60, ge=1, le=30 * 24 * 60)
+
+class StockReservation(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    item_id: str
+    item_name: str
+    warehouse_id: str
+    qty: float
+    uom: str
+    source_type: ReservationSource
+    source_id: Optional[str] = None
+    department: Optional[str] = None
+    status: ReservationStatus = ReservationStatus.ACTIVE
+    reserved_by: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    expires_at: datetime
+    released_at: Optional[datetime] = None
+
+class AvailableStock(BaseModel):
+    item_id: str
+    warehouse_id: str
+    qty: float = 0.0
+    reserved_qty: float = 0.0
+    available_qty: float = 0.0
+
 class ReturnFromDepartment(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -340,6 +570,7 @@ class ReturnFromDepartment(BaseModel):
     qty_returned: float
     uom: str
     warehouse_id: str
+    bin_location_id: Optional[str] = None
     condition: str = "Good"
     returned_by: str
     returned_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -360,6 +591,50 @@ class StockAdjustment(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     approved_by: Optional[str] = None
     approved_at: Optional[datetime] = None
+    current_approver_role: Optional[str] = None
+    remarks: Optional[str] = None
+    bin_location_id: Optional[str] = None
+    cycle_count_id: Optional[str] = None
+
+class CycleCountLine(BaseModel):
+    item_id: str
+    item_name: str
+    bin_location_id: Optional[str] = None
+    bin_code: Optional[str] = None
+    uom: str
+    abc_class: Optional[str] = None
+    last_counted_at: Optional[datetime] = None
+    counted_qty: Optional[float] = None
+    system_qty: Optional[float] = None
+    variance: Optional[float] = None
+
+class CycleCountSheet(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    sheet_no: str
+    warehouse_id: str
+    bin_location_id: Optional[str] = None
+    bin_code: Optional[str] = None
+    status: str = "Open"
+    lines: List[CycleCountLine] = []
+    adjustment_ids: List[str] = []
+    created_by: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    counted_by: Optional[str] = None
+    counted_at: Optional[datetime] = None
+
+class CycleCountGenerateRequest(BaseModel):
+    warehouse_id: str
+    by_bin: bool = False
+    abc_classes: Optional[List[str]] = None
+    max_lines: int = Field(default=200, ge=1, le=5000)
+
+class CycleCountEntry(BaseModel):
+    item_id: str
+    counted_qty: float = Field(ge=0)
+
+class CycleCountUpload(BaseModel):
+    counts: List[CycleCountEntry]
     remarks: Optional[str] = None
 
 # ============ Stock Balance Model ============
@@ -371,6 +646,8 @@ class StockBalance(BaseModel):
     warehouse_id: str
     warehouse_name: str
     qty: float = 0.0
+    # Held by active reservations; available to promise is qty - reserved_qty
+    reserved_qty: float = 0.0
     uom: str
     last_updated: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -383,6 +660,163 @@ class ApprovalFlow(BaseModel):
     approvers: List[Dict[str, Any]]
     status: str = "Active"
 
+class BatchApprovalAction(str, Enum):
+    APPROVE = "approve"
+    REJECT = "reject"
+
+class BatchApprovalRequest(BaseModel):
+    action: BatchApprovalAction
+    # Document ids keyed by document type, e.g. {"purchase_order": ["..."]}
+    documents: Dict[str, List[str]]
+    remarks: Optional[str] = None
+
+class BatchApprovalOutcome(BaseModel):
+    document_type: str
+    id: str
+    outcome: str
+    status: Optional[str] = None
+
+class ApprovalHistory(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    document_type: str
+    document_id: str
+    level: int = 0
+    role: Optional[str] = None
+    action: str
+    from_status: Optional[str] = None
+    to_status: Optional[str] = None
+    user_id: str
+    remarks: Optional[str] = None
+    at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class AuditEntry(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    entity: str
+    entity_id: str
+    action: str
+    user_id: Optional[str] = None
+    # Changed fields as {field: {"before": ..., "after": ...}}
+    changes: Dict[str, Dict[str, Any]] = {}
+    at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class SyncResponse(BaseModel):
+    # Pass back as ``since`` on the next call
+    version: int
+    # True when the client must drop its local copy and take ``changes`` as the full data set
+    reset: bool = False
+    # More changes are waiting; call again with ``version`` straight away
+    has_more: bool = False
+    changes: Dict[str, List[Dict[str, Any]]] = {}
+    deleted: Dict[str, List[str]] = {}
+
+class BatchRequest(BaseModel):
+    # Section name -> query parameters for that section's list route
+    sections: Dict[str, Dict[str, str]]
+
+class PeriodCloseRequest(BaseModel):
+    # Documents dated before this day are moved to the archive
+    period_end: datetime
+
+class PeriodClose(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    period_end: datetime
+    status: str = "Running"
+    moved: Dict[str, int] = {}
+    snapshot_rows: int = 0
+    error: Optional[str] = None
+    closed_by: str
+    started_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: Optional[datetime] = None
+
+class RenameJob(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    # Master type: item, supplier or warehouse
+    entity: str
+    entity_id: str
+    old_name: str
+    new_name: str
+    status: str = "Running"
+    # Documents still carrying another name when the job started
+    total: int = 0
+    updated: int = 0
+    collections: Dict[str, int] = {}
+    error: Optional[str] = None
+    started_by: str
+    started_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: Optional[datetime] = None
+
+class StockReconciliationRequest(BaseModel):
+    # Overwrite drifted balances with the recomputed ones
+    repair: bool = False
+
+class StockReconciliationRun(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    repair: bool = False
+    status: str = "Running"
+    transactions: int = 0
+    balances_checked: int = 0
+    discrepancy_count: int = 0
+    repaired: int = 0
+    # Drifted balances a repair left alone; each carries its reason in discrepancies
+    repair_skipped: int = 0
+    # Largest differences first, capped at RECONCILE_REPORT_LIMIT
+    discrepancies: List[Dict[str, Any]] = []
+    error: Optional[str] = None
+    started_by: str
+    started_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: Optional[datetime] = None
+
+class DemandForecastRequest(BaseModel):
+    history_days: int = Field(default=180, ge=14, le=730)
+    # Replenishment lead time and review cycle, in days
+    lead_time_days: float = Field(default=7.0, gt=0)
+    review_days: float = Field(default=14.0, ge=0)
+    service_level: float = Field(default=0.95, gt=0.5, lt=1.0)
+    alpha: float = Field(default=0.2, gt=0.0, lt=1.0)
+    # Also write the suggestions onto the items' reorder_level/min_stock/max_stock
+    apply: bool = False
+
+class DemandForecastRun(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    params: DemandForecastRequest
+    status: str = "Running"
+    series: int = 0
+    items_applied: int = 0
+    error: Optional[str] = None
+    started_by: str
+    started_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: Optional[datetime] = None
+
+class ItemClassificationRequest(BaseModel):
+    history_days: int = Field(default=365, ge=28, le=730)
+    # Cumulative consumption-value shares closing classes A and B
+    a_cutoff: float = Field(default=0.80, gt=0.0, lt=1.0)
+    b_cutoff: float = Field(default=0.95, gt=0.0, lt=1.0)
+    # Weekly demand coefficient-of-variation limits for classes X and Y
+    x_cv: float = Field(default=0.5, gt=0.0)
+    y_cv: float = Field(default=1.0, gt=0.0)
+
+class DemandForecast(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    item_id: str
+    # None on the item-level row that sums all warehouses
+    warehouse_id: Optional[str] = None
+    method: str
+    daily_demand: float
+    demand_std: float
+    safety_stock: float
+    reorder_level: float
+    min_stock: float
+    max_stock: float
+    run_id: str
+    computed_at: datetime
+
 class NumberSeries(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -407,28 +841,266 @@ def create_jwt_token(user: User) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict:
+async def authenticate(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)) -> Tuple[Optional[Dict], Optional[HTTPException]]:
+    """Decode the bearer token once per request; FastAPI caches this dependency.
+
+    The failure is returned rather than raised so admission control can still
+    rate-limit anonymous callers by IP; ``get_current_user`` raises it.
+    """
+    if credentials is None:
+        return None, HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authenticated")
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
+        return jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM]), None
     except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
+        return None, HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
     except jwt.InvalidTokenError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+        return None, HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-async def get_next_number(series_type: str) -> str:
-    series = await db.number_series.find_one({"series_type": series_type})
-    if not series:
-        series = {"series_type": series_type, "prefix": series_type[:3].upper(), "current_number": 0, "padding": 4}
-        await db.number_series.insert_one(series)
-    
-    next_num = series['current_number'] + 1
-    await db.number_series.update_one(
+async def get_current_user(auth: Tuple[Optional[Dict], Optional[HTTPException]] = Depends(authenticate)) -> Dict:
+    user, error = auth
+    if error:
+        raise error
+    return user
+
+async def reserve_numbers(series_type: str, count: int) -> List[str]:
+    """Take ``count`` consecutive numbers from a series in one atomic increment."""
+    series = await db.number_series.find_one_and_update(
         {"series_type": series_type},
-        {"$set": {"current_number": next_num}}
+        {
+            "$inc": {"current_number": count},
+            "$setOnInsert": {"prefix": series_type[:3].upper(), "padding": 4},
+        },
+        upsert=True,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
-    return f"{series['prefix']}{str(next_num).zfill(series['padding'])}"
+    first = series['current_number'] - count + 1
+    return [f"{series['prefix']}{str(n).zfill(series['padding'])}" for n in range(first, series['current_number'] + 1)]
+
+async def get_next_number(series_type: str) -> str:
+    return (await reserve_numbers(series_type, 1))[0]
+
+# ============ Sparse Fieldsets ============
+# Fields that are never returned, whatever the client asks for
+HIDDEN_FIELDS = {"_id", "password_hash"}
+
+def field_projection(fields: Optional[str]) -> Optional[Dict[str, int]]:
+    """Turn ``fields=a,b.c`` into a Mongo inclusion projection; None means the full document."""
+    if not fields:
+        return None
+    projection: Dict[str, int] = {"_id": 0, "id": 1}
+    for field in fields.split(","):
+        field = field.strip()
+        if not field:
+            continue
+        if field in HIDDEN_FIELDS or field.startswith("$") or not all(part.isidentifier() for part in field.split(".")):
+            raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
+        projection[field] = 1
+    # A parent and its child path collide in MongoDB; the parent already includes the child
+    return {
+        field: value for field, value in projection.items()
+        if not any(field.startswith(f"{parent}.") for parent in projection)
+    }
+
+def sparse_response(data) -> JSONResponse:
+    """Partial documents skip response_model validation, which would reject missing fields."""
+    return JSONResponse(content=jsonable_encoder(data))
+
+# ============ Audit Trail ============
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', '200'))
+AUDIT_FLUSH_MS = int(os.environ.get('AUDIT_FLUSH_MS', '500'))
+# Entries held in memory while audit_log is unwritable; later ones spill to AUDIT_SPILL_PATH
+AUDIT_MAX_BUFFER = int(os.environ.get('AUDIT_MAX_BUFFER', '10000'))
+AUDIT_SPILL_PATH = Path(os.environ.get('AUDIT_SPILL_PATH', str(ROOT_DIR / 'audit_spill.jsonl')))
+# Serialized entry kept on an audit_dead_letter row, cut to stay under the BSON size limit
+AUDIT_DEAD_LETTER_MAX_CHARS = 1_000_000
+AUDIT_IGNORED_FIELDS = {"_id", "password_hash", "updated_seq"}
+
+def audit_diff(before: Optional[Dict], after: Optional[Dict]) -> Dict[str, Dict[str, Any]]:
+    before = before or {}
+    after = after or {}
+    changes = {}
+    for field in before.keys() | after.keys():
+        if field in AUDIT_IGNORED_FIELDS:
+            continue
+        old, new = before.get(field), after.get(field)
+        if old != new:
+            changes[field] = {"before": old, "after": new}
+    return changes
+
+class AuditTrail:
+    """Buffers audit entries in memory and writes them to ``audit_log`` in batches.
+
+    Routes only append to the buffer, so auditing adds no database round trip to a
+    request. A background task flushes every AUDIT_FLUSH_MS, or as soon as
+    AUDIT_BATCH_SIZE entries are waiting.
+
+    While audit_log is unwritable and the buffer is full, entries are appended to a
+    JSON-lines spill file and replayed once the buffer drains, so nothing is dropped.
+    Entries MongoDB rejects outright (unencodable or oversized) go to
+    ``audit_dead_letter`` instead of being retried forever.
+    """
+
+    def __init__(self, batch_size: int, flush_ms: int, max_buffer: int, spill_path: Path):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self.buffer: List[Dict] = []
+        # Entries written to the spill file since it was last replayed
+        self.spilled = 0
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task: Optional[asyncio.Task] = None
+
+    def record(self, entity: str, entity_id: str, action: str, current_user: Optional[Dict],
+               before: Optional[Dict] = None, after: Optional[Dict] = None):
+        changes = audit_diff(before, after)
+        if action == "update" and not changes:
+            return
+        entry = AuditEntry(
+            entity=entity, entity_id=entity_id, action=action,
+            user_id=(current_user or {}).get('user_id'), changes=changes,
+        ).model_dump()
+        entry['at'] = entry['at'].isoformat()
+        # Once spilling starts, later entries follow the spilled ones so the order holds
+        if not ((len(self.buffer) >= self.max_buffer or self.spilled) and self.spill(entry)):
+            # Nowhere on disk to put it either: hold it in memory past the limit rather than lose it
+            self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    def spill(self, entry: Dict) -> bool:
+        """Append one entry to the spill file; False if it couldn't be written."""
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as spill:
+                # insert_many may have stamped an ObjectId on a failed attempt; the replay gets a new one
+                spill.write(json.dumps({k: v for k, v in entry.items() if k != '_id'}, default=str) + "\n")
+        except OSError:
+            logger.exception("Audit spill to %s failed", self.spill_path)
+            return False
+        if not self.spilled:
+            logger.warning("Audit buffer full, spilling entries to %s", self.spill_path)
+        self.spilled += 1
+        return True
+
+    async def dead_letter(self, entries: List[Dict], error: str):
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [{
+            "id": str(uuid.uuid4()),
+            "entry_id": entry.get('id'),
+            "entity": entry.get('entity'),
+            "entity_id": entry.get('entity_id'),
+            "error": error,
+            "entry": json.dumps(entry, default=repr)[:AUDIT_DEAD_LETTER_MAX_CHARS],
+            "at": now,
+        } for entry in entries]
+        try:
+            await db.audit_dead_letter.insert_many(rows, ordered=False)
+        except Exception:
+            for row in rows:
+                logger.error("Audit entry %s rejected (%s) and not dead-lettered: %s", row['entry_id'], error, row['entry'])
+            return
+        logger.warning("Audit flush rejected %d entries, moved to audit_dead_letter: %s", len(rows), error)
+
+    async def write_batch(self, batch: List[Dict]) -> List[Dict]:
+        """Insert one batch; returns the entries to try again later."""
+        try:
+            await db.audit_log.insert_many(batch, ordered=False)
+        except (InvalidDocument, OverflowError):
+            # Raised client-side for the whole batch: find the entries that can't be encoded
+            unencodable = []
+            for entry in batch:
+                try:
+                    bson_encode(entry)
+                except (InvalidDocument, OverflowError) as exc:
+                    unencodable.append((entry, str(exc)))
+            for entry, error in unencodable:
+                await self.dead_letter([entry], error)
+            rejected = {id(entry) for entry, _ in unencodable}
+            return [entry for entry in batch if id(entry) not in rejected]
+        except BulkWriteError as exc:
+            # Duplicate keys mean the entry landed on an earlier attempt; any other
+            # per-document error (size, validation) will fail again on every retry
+            rejected = [error for error in exc.details.get('writeErrors', []) if error.get('code') != 11000]
+            if rejected:
+                await self.dead_letter([batch[error['index']] for error in rejected], rejected[0].get('errmsg', 'write error'))
+        return []
+
+    async def flush(self):
+        while self.buffer:
+            batch, self.buffer = self.buffer[:self.batch_size], self.buffer[self.batch_size:]
+            try:
+                retry = await self.write_batch(batch)
+            except Exception as exc:
+                logger.warning("Audit flush failed, %d entries re-queued: %s", len(batch), exc)
+                self.buffer[:0] = batch
+                return
+            if retry:
+                self.buffer[:0] = retry
+        await self.replay_spill()
+
+    async def replay_spill(self):
+        """Write spilled entries to audit_log, oldest first, once the buffer has drained."""
+        replay = self.spill_path.with_suffix(".replay")
+        try:
+            if not replay.exists():
+                if not self.spill_path.exists():
+                    return
+                # Entries recorded from here on go to the buffer or a fresh spill file
+                os.replace(self.spill_path, replay)
+                self.spilled = 0
+            lines = (await asyncio.to_thread(replay.read_text, encoding="utf-8")).splitlines()
+        except OSError:
+            logger.exception("Reading the audit spill file %s failed", replay)
+            return
+        for offset in range(0, len(lines), self.batch_size):
+            batch = []
+            for line in lines[offset:offset + self.batch_size]:
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a crash mid-write
+                    logger.error("Skipping unreadable audit spill line: %s", line)
+            try:
+                while batch:
+                    batch = await self.write_batch(batch)
+            except Exception as exc:
+                logger.warning("Audit spill replay failed, %d entries kept in %s: %s", len(lines) - offset, replay, exc)
+                await asyncio.to_thread(replay.write_text, "".join(line + "\n" for line in lines[offset:]), encoding="utf-8")
+                return
+        os.remove(replay)
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.stopping = False
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the flusher after draining whatever is still buffered."""
+        if self.task is None:
+            return
+        self.stopping = True
+        self.wakeup.set()
+        await self.task
+        self.task = None
+        # Still unwritable at shutdown: keep them for the next start's replay
+        remaining, self.buffer = self.buffer, []
+        unspilled = [entry for entry in remaining if not self.spill(entry)]
+        if unspilled:
+            # No spill file either; the dead letter collection (or, failing that, the log) keeps them
+            await self.dead_letter(unspilled, "audit_log and the spill file were unwritable at shutdown")
+
+audit_trail = AuditTrail(AUDIT_BATCH_SIZE, AUDIT_FLUSH_MS, AUDIT_MAX_BUFFER, AUDIT_SPILL_PATH)
 
 # ============ Authentication Routes ============
 @api_router.post("/auth/register", response_model=User)
@@ -446,6 +1118,7 @@ async def register(user_create: UserCreate):
     doc['created_at'] = doc['created_at'].isoformat()
     doc['password_hash'] = hashed_pwd  # Add password_hash to the document
     await db.users.insert_one(doc)
+    audit_trail.record("user", user.id, "create", None, after=doc)
     return user
 
 @api_router.post("/auth/login", response_model=Token)
@@ -471,102 +1144,869 @@ async def get_me(current_user: Dict = Depends(get_current_user)):
     return User(**user_doc)
 
 @api_router.get("/users", response_model=List[User])
-async def get_users(current_user: Dict = Depends(get_current_user)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
+async def get_users(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    users = await db.users.find({}, projection or {"_id": 0, "password_hash": 0}).to_list(1000)
+    if projection:
+        return sparse_response(users)
     for user in users:
         if isinstance(user['created_at'], str):
             user['created_at'] = datetime.fromisoformat(user['created_at'])
     return users
 
+# ============ Hierarchy Paths ============
+async def compute_path(collection, parent_field: str, doc: Dict) -> List[str]:
+    parent_id = doc.get(parent_field)
+    if not parent_id:
+        return [doc['id']]
+    parent = await collection.find_one({"id": parent_id}, {"_id": 0, "id": 1, "path_ids": 1})
+    if not parent:
+        raise HTTPException(status_code=400, detail="Parent not found")
+    parent_path = parent.get('path_ids') or [parent_id]
+    if doc['id'] in parent_path:
+        raise HTTPException(status_code=400, detail="Parent would create a cycle")
+    return parent_path + [doc['id']]
+
+async def repath_descendants(collection, node_id: str, new_path: List[str]) -> Dict[str, List[str]]:
+    """Rewrite the path prefix of every descendant of ``node_id``; returns the new paths by id."""
+    paths = {node_id: new_path}
+    operations = []
+    seq = await next_sync_seq()
+    async for child in collection.find({"path_ids": node_id, "id": {"$ne": node_id}}, {"_id": 0, "id": 1, "path_ids": 1}):
+        old_path = child['path_ids']
+        child_path = new_path + old_path[old_path.index(node_id) + 1:]
+        paths[child['id']] = child_path
+        operations.append(UpdateOne({"id": child['id']}, {"$set": {"path_ids": child_path, "updated_seq": seq}}))
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+    return paths
+
+async def propagate_stock_paths(field: str, key_field: str, paths: Dict[str, List[str]]):
+    """Copy changed warehouse/category paths onto the stock balances that denormalize them."""
+    if paths:
+        seq = await next_sync_seq()
+        await db.stock_balance.bulk_write(
+            [UpdateMany({key_field: node_id}, {"$set": {field: path, "updated_seq": seq}}) for node_id, path in paths.items()],
+            ordered=False
+        )
+    stock_rollup_cache.invalidate()
+
+def build_paths(docs: List[Dict], parent_field: str) -> Dict[str, List[str]]:
+    parents = {doc['id']: doc.get(parent_field) for doc in docs}
+    paths: Dict[str, List[str]] = {}
+    for node_id in parents:
+        chain = [node_id]
+        seen = {node_id}
+        parent = parents.get(node_id)
+        while parent and parent in parents and parent not in seen:
+            chain.append(parent)
+            seen.add(parent)
+            parent = parents.get(parent)
+        paths[node_id] = chain[::-1]
+    return paths
+
+async def backfill_hierarchy_paths():
+    """Populate paths on warehouses, categories and stock balances written before paths existed."""
+    for collection, parent_field in ((db.warehouses, 'parent_warehouse_id'), (db.item_categories, 'parent_category')):
+        if await collection.count_documents({"path_ids": {"$exists": False}}, limit=1):
+            docs = await collection.find({}, {"_id": 0, "id": 1, parent_field: 1}).to_list(None)
+            paths = build_paths(docs, parent_field)
+            await collection.bulk_write(
+                [UpdateOne({"id": node_id}, {"$set": {"path_ids": path}}) for node_id, path in paths.items()],
+                ordered=False
+            )
+    if not await db.stock_balance.count_documents({"warehouse_path": {"$exists": False}}, limit=1):
+        return
+    warehouse_paths = {wh['id']: wh['path_ids'] async for wh in db.warehouses.find({}, {"_id": 0, "id": 1, "path_ids": 1})}
+    category_paths = {cat['id']: cat['path_ids'] async for cat in db.item_categories.find({}, {"_id": 0, "id": 1, "path_ids": 1})}
+    item_categories = {item['id']: item['category_id'] async for item in db.items.find({}, {"_id": 0, "id": 1, "category_id": 1})}
+    operations = []
+    async for stock in db.stock_balance.find({"warehouse_path": {"$exists": False}}, {"_id": 0, "id": 1, "item_id": 1, "warehouse_id": 1}):
+        category_id = item_categories.get(stock['item_id'])
+        operations.append(UpdateOne({"id": stock['id']}, {"$set": {
+            "warehouse_path": warehouse_paths.get(stock['warehouse_id'], [stock['warehouse_id']]),
+            "category_id": category_id,
+            "category_path": category_paths.get(category_id, [category_id] if category_id else []),
+        }}))
+    if operations:
+        await db.stock_balance.bulk_write(operations, ordered=False)
+
+async def stock_path_fields(item_id: str, warehouse_id: str, session=None) -> Dict:
+    """Denormalized tree fields stored on a new stock balance row."""
+    warehouse = await db.warehouses.find_one({"id": warehouse_id}, {"_id": 0, "warehouse_name": 1, "path_ids": 1}, session=session)
+    item = await db.items.find_one({"id": item_id}, {"_id": 0, "category_id": 1}, session=session)
+    category_id = item['category_id'] if item else None
+    category = await db.item_categories.find_one({"id": category_id}, {"_id": 0, "path_ids": 1}, session=session) if category_id else None
+    return {
+        "warehouse_name": warehouse['warehouse_name'] if warehouse else "",
+        "warehouse_path": (warehouse or {}).get('path_ids') or [warehouse_id],
+        "category_id": category_id,
+        "category_path": (category or {}).get('path_ids') or ([category_id] if category_id else []),
+    }
+
+# ============ Background Runs ============
+# Run documents whose job runs in a worker task; a Running row with a stale heartbeat lost its worker
+RUN_COLLECTIONS = ("period_closes", "demand_forecast_runs", "stock_reconciliations", "rename_jobs")
+# Of those, the ones allowed at most one Running row at a time
+SINGLE_RUN_COLLECTIONS = ("period_closes", "demand_forecast_runs", "stock_reconciliations")
+RUN_HEARTBEAT_SECONDS = float(os.environ.get('RUN_HEARTBEAT_SECONDS', '30'))
+RUN_STALE_SECONDS = RUN_HEARTBEAT_SECONDS * 4
+
+# The event loop only keeps weak references to tasks; this keeps the fire-and-forget ones alive
+background_tasks = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def heartbeat_run(collection_name: str, run_id: str):
+    while True:
+        await asyncio.sleep(RUN_HEARTBEAT_SECONDS)
+        await db[collection_name].update_one({"id": run_id, "status": "Running"}, {"$set": {
+            "heartbeat_at": datetime.now(timezone.utc).isoformat()
+        }})
+
+async def supervise_run(collection_name: str, run_id: str, job):
+    heartbeat = asyncio.create_task(heartbeat_run(collection_name, run_id))
+    try:
+        await job
+    finally:
+        heartbeat.cancel()
+
+def spawn_run(collection_name: str, run_id: str, job) -> asyncio.Task:
+    """Run a job in the background, heartbeating its run document while it works."""
+    return spawn(supervise_run(collection_name, run_id, job))
+
+async def fail_stale_runs(collection_name: str) -> int:
+    """Mark Running rows whose worker stopped heartbeating (a restart or crash) as Failed."""
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=RUN_STALE_SECONDS)).isoformat()
+    result = await db[collection_name].update_many(
+        {"status": "Running", "$or": [
+            {"heartbeat_at": {"$lt": cutoff}},
+            {"heartbeat_at": {"$exists": False}, "started_at": {"$lt": cutoff}},
+        ]},
+        {"$set": {"status": "Failed", "error": "Interrupted: the worker running it stopped", "finished_at": now.isoformat()}}
+    )
+    if result.modified_count:
+        logger.warning("Marked %d orphaned run(s) in %s as Failed", result.modified_count, collection_name)
+    return result.modified_count
+
+async def claim_run(collection_name: str, doc: Dict, conflict: str):
+    """Insert a Running row; the partial unique index on status lets only one through."""
+    await fail_stale_runs(collection_name)
+    doc['heartbeat_at'] = doc['started_at']
+    try:
+        await db[collection_name].insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=conflict)
+
+# ============ Archival ============
+# Transaction collections that are archived by financial year, with their date field
+ARCHIVE_COLLECTIONS = {
+    "issues": "issued_at",
+    "grn": "received_at",
+    "stock_inward": "created_at",
+    "quality_checks": "inspected_at",
+    "purchase_orders": "created_at",
+}
+# Extra conditions a document must meet to leave the hot collection
+ARCHIVE_FILTERS = {
+    # Only POs that are finished with: rejected, or approved, fully received and
+    # fully inspected, since a QC rejection reopens the line on the hot PO
+    "purchase_orders": {
+        "$or": [
+            {"status": ApprovalStatus.REJECTED},
+            {"status": ApprovalStatus.APPROVED, "open_qty": {"$lte": QTY_EPSILON}},
+        ],
+        "$expr": {"$allElementsTrue": [{"$map": {"input": "$items", "as": "line", "in": {"$lte": [
+            {"$subtract": ["$$line.received_qty", {"$add": ["$$line.accepted_qty", "$$line.rejected_qty"]}]},
+            QTY_EPSILON,
+        ]}}}]},
+    },
+}
+ARCHIVE_BATCH_SIZE = 1000
+
+def financial_year(value: str) -> int:
+    """Starting year of the April-March financial year containing an ISO date."""
+    dt = datetime.fromisoformat(value)
+    return dt.year if dt.month >= 4 else dt.year - 1
+
+def archive_collection_name(name: str, fy: int) -> str:
+    return f"{name}_archive_fy{fy}"
+
+class ArchiveState:
+    """Latest closed period end, so list routes know when a range reaches into the archive."""
+
+    def __init__(self):
+        self.closed_through: Optional[str] = None
+        self.first_year: Optional[int] = None
+
+    async def load(self):
+        closes = await db.period_closes.find({"status": "Completed"}, {"_id": 0, "period_end": 1}).sort("period_end", ASCENDING).to_list(None)
+        self.closed_through = closes[-1]['period_end'] if closes else None
+        years = [
+            int(name.rsplit("_fy", 1)[1]) for name in await db.list_collection_names()
+            if "_archive_fy" in name and name.rsplit("_fy", 1)[1].isdigit()
+        ]
+        self.first_year = min(years) if years else None
+
+archive_state = ArchiveState()
+
+def dated_sources(name: str, query: Dict, start_date: Optional[str] = None, end_date: Optional[str] = None) -> Tuple[Dict, List[str]]:
+    """The dated query for a transaction collection and the collections to read, live first.
+
+    Archives are only included for ranges before the last period close.
+    """
+    date_field = ARCHIVE_COLLECTIONS[name]
+    query = dict(query)
+    date_range = {}
+    if start_date:
+        date_range['$gte'] = start_date
+    if end_date:
+        date_range['$lte'] = end_date
+    if date_range:
+        query[date_field] = date_range
+    sources = [name]
+    closed_through = archive_state.closed_through
+    if start_date and closed_through and start_date < closed_through and archive_state.first_year is not None:
+        first = max(financial_year(start_date), archive_state.first_year)
+        last = financial_year(min(end_date, closed_through) if end_date else closed_through)
+        sources += [archive_collection_name(name, fy) for fy in range(first, last + 1)]
+    return query, sources
+
+async def find_documents(name: str, query: Dict, start_date: Optional[str] = None, end_date: Optional[str] = None, limit: int = 1000, projection: Optional[Dict] = None) -> List[Dict]:
+    """Query a transaction collection, reaching into archives only for ranges before the last period close."""
+    query, sources = dated_sources(name, query, start_date, end_date)
+    projection = projection or {"_id": 0}
+    docs = []
+    for source in sources:
+        if len(docs) >= limit:
+            break
+        docs += await db[source].find(query, projection).to_list(limit - len(docs))
+    return docs
+
+async def archive_collection(name: str, period_end: str) -> int:
+    """Move closed documents dated before ``period_end`` into per-year archives, a batch at a time.
+
+    Inserts are idempotent on the archive's unique id index, so a close interrupted
+    between insert and delete can simply be re-run.
+    """
+    date_field = ARCHIVE_COLLECTIONS[name]
+    query = {date_field: {"$lt": period_end}, **ARCHIVE_FILTERS.get(name, {})}
+    moved = 0
+    while True:
+        batch = await db[name].find(query).sort(date_field, ASCENDING).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+        if not batch:
+            return moved
+        by_year: Dict[int, List[Dict]] = {}
+        for doc in batch:
+            by_year.setdefault(financial_year(doc[date_field]), []).append(doc)
+        for fy, docs in by_year.items():
+            archive = db[archive_collection_name(name, fy)]
+            await archive.create_index("id", unique=True)
+            await archive.create_index(date_field)
+            try:
+                await archive.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # Duplicates are documents archived by an earlier, interrupted run
+                if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                    raise
+        ids = [doc['_id'] for doc in batch]
+        # Re-check the filter on delete: a document changed since the read (a QC
+        # rejection reopening a PO) stays hot, and its stale archive copy goes
+        result = await db[name].delete_many({"_id": {"$in": ids}, **query})
+        if result.deleted_count < len(ids):
+            kept = [doc['_id'] async for doc in db[name].find({"_id": {"$in": ids}}, {"_id": 1})]
+            for fy in by_year:
+                await db[archive_collection_name(name, fy)].delete_many({"_id": {"$in": kept}})
+        moved += result.deleted_count
+        # Yield between batches so foreground requests keep the pool
+        await asyncio.sleep(0)
+
+async def snapshot_stock_balance(period: str) -> int:
+    await db.stock_balance_snapshots.delete_many({"period_end": period})
+    rows = 0
+    cursor = db.stock_balance.find({}, {"_id": 0})
+    while True:
+        batch = await cursor.to_list(ARCHIVE_BATCH_SIZE)
+        if not batch:
+            return rows
+        for row in batch:
+            row['period_end'] = period
+        await db.stock_balance_snapshots.insert_many(batch)
+        rows += len(batch)
+
+async def run_period_close(close_id: str, period_end: str):
+    moved: Dict[str, int] = {}
+    try:
+        snapshot_rows = await snapshot_stock_balance(period_end)
+        await db.period_closes.update_one({"id": close_id}, {"$set": {"snapshot_rows": snapshot_rows}})
+        for name in ARCHIVE_COLLECTIONS:
+            moved[name] = await archive_collection(name, period_end)
+            await db.period_closes.update_one({"id": close_id}, {"$set": {"moved": moved}})
+        await db.period_closes.update_one({"id": close_id}, {"$set": {
+            "status": "Completed", "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+    except Exception as e:
+        logger.exception("Period close %s failed", close_id)
+        await db.period_closes.update_one({"id": close_id}, {"$set": {
+            "status": "Failed", "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+    await archive_state.load()
+
 # ============ Item Category Routes ============
 @api_router.post("/masters/item-categories", response_model=ItemCategory)
 async def create_item_category(category: ItemCategory, current_user: Dict = Depends(get_current_user)):
     doc = category.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    category.path_ids = doc['path_ids'] = await compute_path(db.item_categories, 'parent_category', doc)
     await db.item_categories.insert_one(doc)
+    audit_trail.record("item_category", category.id, "create", current_user, after=doc)
     return category
 
 @api_router.get("/masters/item-categories", response_model=List[ItemCategory])
-async def get_item_categories(current_user: Dict = Depends(get_current_user)):
-    categories = await db.item_categories.find({}, {"_id": 0}).to_list(1000)
+async def get_item_categories(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    categories = await db.item_categories.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(categories)
     for cat in categories:
         if isinstance(cat['created_at'], str):
             cat['created_at'] = datetime.fromisoformat(cat['created_at'])
     return categories
 
 @api_router.get("/masters/item-categories/{category_id}", response_model=ItemCategory)
-async def get_item_category(category_id: str, current_user: Dict = Depends(get_current_user)):
-    category = await db.item_categories.find_one({"id": category_id}, {"_id": 0})
+async def get_item_category(category_id: str, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    category = await db.item_categories.find_one({"id": category_id}, projection or {"_id": 0})
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
+    if projection:
+        return sparse_response(category)
     if isinstance(category['created_at'], str):
         category['created_at'] = datetime.fromisoformat(category['created_at'])
     return ItemCategory(**category)
 
 @api_router.put("/masters/item-categories/{category_id}", response_model=ItemCategory)
 async def update_item_category(category_id: str, category: ItemCategory, current_user: Dict = Depends(get_current_user)):
+    category.id = category_id
     doc = category.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.item_categories.update_one({"id": category_id}, {"$set": doc})
+    category.path_ids = doc['path_ids'] = await compute_path(db.item_categories, 'parent_category', doc)
+    existing = await db.item_categories.find_one_and_update({"id": category_id}, {"$set": doc}, projection={"_id": 0})
+    if existing:
+        audit_trail.record("item_category", category_id, "update", current_user, before=existing, after=doc)
+    if existing and existing.get('path_ids') != doc['path_ids']:
+        paths = await repath_descendants(db.item_categories, category_id, doc['path_ids'])
+        await propagate_stock_paths('category_path', 'category_id', paths)
     return category
 
 @api_router.delete("/masters/item-categories/{category_id}")
 async def delete_item_category(category_id: str, current_user: Dict = Depends(get_current_user)):
-    result = await db.item_categories.delete_one({"id": category_id})
-    if result.deleted_count == 0:
+    existing = await db.item_categories.find_one_and_delete({"id": category_id}, projection={"_id": 0})
+    if not existing:
         raise HTTPException(status_code=404, detail="Category not found")
+    audit_trail.record("item_category", category_id, "delete", current_user, before=existing)
     return {"message": "Category deleted successfully"}
 
+# ============ Item Search Index ============
+# Case-insensitive collation shared by the item code/name indexes and prefix queries
+ITEM_COLLATION = {"locale": "en", "strength": 2}
+ITEM_SEARCH_CACHE_ENABLED = os.environ.get('ITEM_SEARCH_CACHE', '1') != '0'
+ITEM_SEARCH_FIELDS = {"_id": 0, "id": 1, "item_code": 1, "item_name": 1, "uom": 1, "barcode": 1, "status": 1}
+
+class ItemSearchIndex:
+    """Sorted-array prefix index over item codes and names for type-ahead.
+
+    Rebuilt lazily from Mongo on the first search after any item write.
+    """
+
+    def __init__(self):
+        self._keys: List[str] = []
+        self._ids: List[str] = []
+        self._items: Dict[str, Dict] = {}
+        self._generation = 0
+        self._built_generation = -1
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.casefold().split())
+
+    def invalidate(self):
+        self._generation += 1
+
+    async def _ensure_built(self):
+        if self._built_generation == self._generation:
+            return
+        async with self._lock:
+            generation = self._generation
+            if self._built_generation == generation:
+                return
+            items = await db.items.find({}, ITEM_SEARCH_FIELDS).to_list(None)
+            entries = []
+            by_id = {}
+            for item in items:
+                by_id[item['id']] = item
+                code = self.normalize(item.get('item_code') or "")
+                name = self.normalize(item.get('item_name') or "")
+                if code:
+                    entries.append((code, item['id']))
+                if name:
+                    entries.append((name, item['id']))
+                    # Index every word so "cotton" also finds "Dyed Cotton Yarn"
+                    words = name.split(" ")
+                    for i in range(1, len(words)):
+                        entries.append((" ".join(words[i:]), item['id']))
+            entries.sort()
+            self._keys = [key for key, _ in entries]
+            self._ids = [item_id for _, item_id in entries]
+            self._items = by_id
+            self._built_generation = generation
+
+    async def search(self, prefix: str, limit: int, active_only: bool = True) -> List[Dict]:
+        await self._ensure_built()
+        prefix = self.normalize(prefix)
+        results = []
+        seen = set()
+        pos = bisect.bisect_left(self._keys, prefix)
+        while pos < len(self._keys) and self._keys[pos].startswith(prefix):
+            item_id = self._ids[pos]
+            pos += 1
+            if item_id in seen:
+                continue
+            seen.add(item_id)
+            item = self._items[item_id]
+            if active_only and item.get('status') != "Active":
+                continue
+            results.append(item)
+            if len(results) >= limit:
+                break
+        return results
+
+item_search_index = ItemSearchIndex()
+
+async def search_items_db(prefix: str, limit: int, active_only: bool = True) -> List[Dict]:
+    """Prefix search on the collated item_code/item_name indexes, used when the cache is disabled."""
+    prefix = prefix.strip()
+    # Highest BMP code point sorts after any continuation of the prefix
+    bounds = {"$gte": prefix, "$lt": prefix + "\uffff"}
+    results = []
+    seen = set()
+    for field in ("item_code", "item_name"):
+        query: Dict[str, Any] = {field: bounds}
+        if active_only:
+            query['status'] = "Active"
+        cursor = db.items.find(query, ITEM_SEARCH_FIELDS, collation=ITEM_COLLATION).sort(field, ASCENDING).limit(limit)
+        async for item in cursor:
+            if item['id'] not in seen:
+                seen.add(item['id'])
+                results.append(item)
+    return results[:limit]
+
+# ============ Name Propagation ============
+# Denormalized copies of master names: (collection, array field or None, id field, name field)
+RENAME_TARGETS = {
+    "item": [
+        ("stock_balance", None, "item_id", "item_name"),
+        ("bin_stock_balance", None, "item_id", "item_name"),
+        ("lot_balance", None, "item_id", "item_name"),
+        ("grn", None, "item_id", "item_name"),
+        ("quality_checks", None, "item_id", "item_name"),
+        ("stock_inward", None, "item_id", "item_name"),
+        ("stock_transfer", None, "item_id", "item_name"),
+        ("issues", None, "item_id", "item_name"),
+        ("returns", None, "item_id", "item_name"),
+        ("adjustments", None, "item_id", "item_name"),
+        ("reservations", None, "item_id", "item_name"),
+        ("purchase_orders", "items", "item_id", "item_name"),
+        ("purchase_indents", "items", "item_id", "item_name"),
+        ("cycle_counts", "lines", "item_id", "item_name"),
+    ],
+    "supplier": [
+        ("purchase_orders", None, "supplier_id", "supplier_name"),
+        ("grn", None, "supplier_id", "supplier_name"),
+        ("supplier_scores", None, "supplier_id", "supplier_name"),
+    ],
+    "warehouse": [
+        ("stock_balance", None, "warehouse_id", "warehouse_name"),
+        ("issues", None, "warehouse_id", "warehouse_name"),
+        ("stock_transfer", None, "from_warehouse_id", "from_warehouse_name"),
+        ("stock_transfer", None, "to_warehouse_id", "to_warehouse_name"),
+    ],
+}
+RENAME_BATCH_SIZE = int(os.environ.get('RENAME_BATCH_SIZE', '500'))
+# Pause between batches so a large rename yields to foreground traffic
+RENAME_THROTTLE_MS = int(os.environ.get('RENAME_THROTTLE_MS', '50'))
+
+def rename_filter(array: Optional[str], id_field: str, name_field: str, entity_id: str, new_name: str) -> Dict:
+    if array:
+        return {array: {"$elemMatch": {id_field: entity_id, name_field: {"$ne": new_name}}}}
+    return {id_field: entity_id, name_field: {"$ne": new_name}}
+
+async def with_archives(collection_name: str) -> List[str]:
+    """The collection plus, for archived transaction collections, every archive year."""
+    if collection_name not in ARCHIVE_COLLECTIONS:
+        return [collection_name]
+    prefix = archive_collection_name(collection_name, 0)[:-1]
+    return [collection_name] + sorted(name for name in await db.list_collection_names() if name.startswith(prefix))
+
+async def propagate_name(job_id: str, collection_name: str, array: Optional[str], id_field: str, name_field: str, entity_id: str, new_name: str) -> bool:
+    """Rewrite one denormalized name in ``_id`` order, a batch per update_many; False once the job is superseded."""
+    collection = db[collection_name]
+    match = rename_filter(array, id_field, name_field, entity_id, new_name)
+    if array:
+        update = {f"{array}.$[line].{name_field}": new_name}
+        array_filters = [{f"line.{id_field}": entity_id}]
+    else:
+        update = {name_field: new_name}
+        array_filters = None
+    last_id = None
+    while True:
+        query = {**match, "_id": {"$gt": last_id}} if last_id is not None else match
+        ids = [doc['_id'] async for doc in collection.find(query, {"_id": 1}).sort("_id", ASCENDING).limit(RENAME_BATCH_SIZE)]
+        if not ids:
+            return True
+        last_id = ids[-1]
+        if collection_name in SYNC_ENTITIES:
+            update['updated_seq'] = await next_sync_seq()
+        result = await collection.update_many({**match, "_id": {"$in": ids}}, {"$set": update}, array_filters=array_filters)
+        job = await db.rename_jobs.find_one_and_update(
+            {"id": job_id},
+            {"$inc": {"updated": result.modified_count, f"collections.{collection_name}": result.modified_count}},
+            projection={"_id": 0, "status": 1}
+        )
+        if not job or job['status'] != "Running":
+            return False
+        await asyncio.sleep(RENAME_THROTTLE_MS / 1000)
+
+async def run_rename(job_id: str, entity: str, entity_id: str, new_name: str):
+    try:
+        targets = [
+            (source, array, id_field, name_field)
+            for collection_name, array, id_field, name_field in RENAME_TARGETS[entity]
+            for source in await with_archives(collection_name)
+        ]
+        total = 0
+        for source, array, id_field, name_field in targets:
+            total += await db[source].count_documents(rename_filter(array, id_field, name_field, entity_id, new_name))
+        await db.rename_jobs.update_one({"id": job_id}, {"$set": {"total": total}})
+        for target in targets:
+            if not await propagate_name(job_id, *target, entity_id, new_name):
+                return
+        if entity == "item":
+            stock_rollup_cache.invalidate()
+        await db.rename_jobs.update_one({"id": job_id, "status": "Running"}, {"$set": {
+            "status": "Completed", "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+    except Exception as e:
+        logger.exception("Rename job %s failed", job_id)
+        await db.rename_jobs.update_one({"id": job_id}, {"$set": {
+            "status": "Failed", "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+
+async def start_rename(entity: str, entity_id: str, old_name: str, new_name: str, current_user: Dict) -> RenameJob:
+    """Queue the fan-out of a master rename; an earlier job for the same master stops at its next batch."""
+    await db.rename_jobs.update_many(
+        {"entity": entity, "entity_id": entity_id, "status": "Running"},
+        {"$set": {"status": "Superseded", "finished_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    job = RenameJob(entity=entity, entity_id=entity_id, old_name=old_name, new_name=new_name, started_by=current_user['user_id'])
+    doc = job.model_dump()
+    doc['started_at'] = doc['started_at'].isoformat()
+    doc['heartbeat_at'] = doc['started_at']
+    await db.rename_jobs.insert_one(doc)
+    spawn_run("rename_jobs", job.id, run_rename(job.id, entity, entity_id, new_name))
+    return job
+
+@api_router.get("/admin/rename-jobs", response_model=List[RenameJob])
+async def get_rename_jobs(entity: Optional[str] = None, entity_id: Optional[str] = None, status: Optional[str] = None,
+                          current_user: Dict = Depends(get_current_user)):
+    query = {}
+    if entity:
+        query['entity'] = entity
+    if entity_id:
+        query['entity_id'] = entity_id
+    if status:
+        query['status'] = status
+    jobs = await db.rename_jobs.find(query, {"_id": 0}).sort("started_at", -1).to_list(1000)
+    for job in jobs:
+        for field in ('started_at', 'finished_at'):
+            if job.get(field) and isinstance(job[field], str):
+                job[field] = datetime.fromisoformat(job[field])
+    return jobs
+
 # ============ Item Master Routes ============
+def normalize_barcode(item: ItemMaster):
+    # The item form posts "" when no barcode is entered; only real barcodes are unique
+    item.barcode = (item.barcode or "").strip() or None
+
+async def normalize_blank_barcodes():
+    """Clear blank barcodes left by earlier item saves so the unique barcode index can build."""
+    blank = {"barcode": {"$type": "string", "$not": re.compile(r"\S")}}
+    if await db.items.find_one(blank, {"_id": 1}):
+        await db.items.update_many(blank, {"$set": {"barcode": None, "updated_seq": await next_sync_seq()}})
+
 @api_router.post("/masters/items", response_model=ItemMaster)
 async def create_item(item: ItemMaster, current_user: Dict = Depends(get_current_user)):
+    normalize_barcode(item)
     doc = item.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.items.insert_one(doc)
+    doc['updated_seq'] = await next_sync_seq()
+    try:
+        await db.items.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Barcode already assigned to another item")
+    item_search_index.invalidate()
+    audit_trail.record("item", item.id, "create", current_user, after=doc)
     return item
 
 @api_router.get("/masters/items", response_model=List[ItemMaster])
-async def get_items(current_user: Dict = Depends(get_current_user)):
-    items = await db.items.find({}, {"_id": 0}).to_list(1000)
+async def get_items(abc_class: Optional[str] = None, xyz_class: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    # Class filters are served by the (abc_class, xyz_class) index
+    query = {}
+    if abc_class:
+        query['abc_class'] = abc_class.upper()
+    if xyz_class:
+        query['xyz_class'] = xyz_class.upper()
+    projection = field_projection(fields)
+    items = await db.items.find(query, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(items)
     for item in items:
         if isinstance(item['created_at'], str):
             item['created_at'] = datetime.fromisoformat(item['created_at'])
     return items
 
+@api_router.get("/masters/items/search", response_model=List[ItemSearchResult])
+async def search_items(q: str, limit: int = 20, include_inactive: bool = False, current_user: Dict = Depends(get_current_user)):
+    if not q.strip():
+        return []
+    limit = max(1, min(limit, 100))
+    if ITEM_SEARCH_CACHE_ENABLED:
+        return await item_search_index.search(q, limit, active_only=not include_inactive)
+    return await search_items_db(q, limit, active_only=not include_inactive)
+
+@api_router.get("/masters/items/barcode/{barcode}", response_model=ItemMaster)
+async def get_item_by_barcode(barcode: str, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    item = await db.items.find_one({"barcode": barcode}, projection or {"_id": 0})
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if projection:
+        return sparse_response(item)
+    if isinstance(item['created_at'], str):
+        item['created_at'] = datetime.fromisoformat(item['created_at'])
+    return ItemMaster(**item)
+
 @api_router.get("/masters/items/{item_id}", response_model=ItemMaster)
-async def get_item(item_id: str, current_user: Dict = Depends(get_current_user)):
-    item = await db.items.find_one({"id": item_id}, {"_id": 0})
+async def get_item(item_id: str, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    item = await db.items.find_one({"id": item_id}, projection or {"_id": 0})
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
+    if projection:
+        return sparse_response(item)
     if isinstance(item['created_at'], str):
         item['created_at'] = datetime.fromisoformat(item['created_at'])
     return ItemMaster(**item)
 
 @api_router.put("/masters/items/{item_id}", response_model=ItemMaster)
 async def update_item(item_id: str, item: ItemMaster, current_user: Dict = Depends(get_current_user)):
-    doc = item.model_dump()
+    normalize_barcode(item)
+    doc = item.model_dump(exclude=ITEM_JOB_FIELDS)
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.items.update_one({"id": item_id}, {"$set": doc})
+    doc['updated_seq'] = await next_sync_seq()
+    try:
+        existing = await db.items.find_one_and_update({"id": item_id}, {"$set": doc}, projection={"_id": 0})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Barcode already assigned to another item")
+    item_search_index.invalidate()
+    if existing:
+        audit_trail.record("item", item_id, "update", current_user, before=existing, after=doc)
+        for field in ITEM_JOB_FIELDS:
+            setattr(item, field, existing.get(field))
+    if existing and existing.get('category_id') != item.category_id:
+        category = await db.item_categories.find_one({"id": item.category_id}, {"_id": 0, "path_ids": 1})
+        await db.stock_balance.update_many({"item_id": item_id}, {"$set": {
+            "category_id": item.category_id,
+            "category_path": (category or {}).get('path_ids') or [item.category_id],
+            "updated_seq": doc['updated_seq'],
+        }})
+        stock_rollup_cache.invalidate()
+    if existing and existing.get('item_name') != item.item_name:
+        await start_rename("item", item_id, existing.get('item_name') or "", item.item_name, current_user)
     return item
 
 @api_router.delete("/masters/items/{item_id}")
 async def delete_item(item_id: str, current_user: Dict = Depends(get_current_user)):
-    result = await db.items.delete_one({"id": item_id})
-    if result.deleted_count == 0:
+    existing = await db.items.find_one_and_delete({"id": item_id}, projection={"_id": 0})
+    if not existing:
         raise HTTPException(status_code=404, detail="Item not found")
+    item_search_index.invalidate()
+    await record_tombstone("items", item_id)
+    audit_trail.record("item", item_id, "delete", current_user, before=existing)
     return {"message": "Item deleted successfully"}
 
+# ============ UOM Conversion Engine ============
+class UOMConverter:
+    """Closed conversion matrix over all UOMs, compiled from ``UOMMaster.conversions``.
+
+    ``conversions`` maps a target UOM to how many target units one unit of this
+    UOM holds, e.g. ROLL: {"MTR": 50}. Direct factors are mirrored and then closed
+    transitively, so any two UOMs joined by a chain of conversions can be converted.
+    """
+
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.matrix = None
+        self.precision: Dict[str, int] = {}
+        self._generation = 0
+        self._compiled_generation = -1
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def key(uom: str) -> str:
+        return uom.strip().upper()
+
+    def compile(self, uoms: List[Dict]):
+        import numpy as np
+        names = set()
+        for uom in uoms:
+            names.add(self.key(uom['uom_name']))
+            names.update(self.key(target) for target in (uom.get('conversions') or {}))
+        index = {name: i for i, name in enumerate(sorted(names))}
+        size = len(index)
+        matrix = np.full((size, size), np.nan)
+        np.fill_diagonal(matrix, 1.0)
+        for uom in uoms:
+            src = index[self.key(uom['uom_name'])]
+            for target, factor in (uom.get('conversions') or {}).items():
+                if factor:
+                    dst = index[self.key(target)]
+                    matrix[src, dst] = factor
+                    matrix[dst, src] = 1.0 / factor
+        # Multiplicative Floyd-Warshall: fill unknown pairs through each intermediate UOM
+        for k in range(size):
+            via = matrix[:, k:k + 1] * matrix[k:k + 1, :]
+            matrix = np.where(np.isnan(matrix), via, matrix)
+        self.index = index
+        self.matrix = matrix
+        self.precision = {self.key(uom['uom_name']): uom.get('decimal_precision', 2) for uom in uoms}
+
+    def invalidate(self):
+        self._generation += 1
+
+    async def get(self) -> "UOMConverter":
+        """The converter, recompiled first if a UOM changed since the last compile.
+
+        Callers arriving while a compile is in flight wait for it, so none sees an empty matrix.
+        """
+        while self._compiled_generation != self._generation:
+            async with self._lock:
+                generation = self._generation
+                if self._compiled_generation == generation:
+                    continue
+                self.compile(await db.uoms.find({"status": "Active"}, {"_id": 0}).to_list(None))
+                self._compiled_generation = generation
+        return self
+
+    def factor(self, from_uom: str, to_uom: str) -> Optional[float]:
+        src, dst = self.key(from_uom), self.key(to_uom)
+        if src == dst:
+            return 1.0
+        if src not in self.index or dst not in self.index:
+            return None
+        value = self.matrix[self.index[src], self.index[dst]]
+        return None if math.isnan(value) else float(value)
+
+    def round(self, qty: float, uom: str) -> float:
+        return round(qty, self.precision.get(self.key(uom), 2))
+
+    def convert(self, qty: float, from_uom: str, to_uom: str) -> float:
+        factor = self.factor(from_uom, to_uom)
+        if factor is None:
+            raise HTTPException(status_code=400, detail=f"No conversion from {from_uom} to {to_uom}")
+        return self.round(qty * factor, to_uom)
+
+    def convert_many(self, qtys: "np.ndarray", from_uoms: List[str], to_uoms: List[str]) -> "np.ndarray":
+        """Vectorized conversion; pairs without a known conversion come back as NaN."""
+        import numpy as np
+        unknown = len(self.index)
+        src = np.array([self.index.get(self.key(u), unknown) for u in from_uoms], dtype=np.intp)
+        dst = np.array([self.index.get(self.key(u), unknown) for u in to_uoms], dtype=np.intp)
+        # Pad with a NaN row/column so unknown UOMs index safely
+        padded = np.full((unknown + 1, unknown + 1), np.nan)
+        padded[:unknown, :unknown] = self.matrix
+        factors = padded[src, dst]
+        same = np.array([self.key(a) == self.key(b) for a, b in zip(from_uoms, to_uoms)], dtype=bool)
+        factors[same] = 1.0
+        return qtys * factors
+
+uom_converter = UOMConverter()
+
+async def to_base_uom(item_id: str, qty: float, uom: str):
+    """Convert ``qty`` in ``uom`` to the item's base UOM, rounded to its precision.
+
+    A quantity already in the base UOM always converts (factor 1), even for a UOM the
+    master doesn't list; any other UOM needs a conversion path or the request gets a 400.
+    """
+    item = await db.items.find_one({"id": item_id}, {"_id": 0, "uom": 1})
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    base_uom = item['uom']
+    converter = await uom_converter.get()
+    return converter.convert(qty, uom, base_uom), base_uom
+
 # ============ UOM Master Routes ============
 @api_router.post("/masters/uoms", response_model=UOMMaster)
 async def create_uom(uom: UOMMaster, current_user: Dict = Depends(get_current_user)):
     doc = uom.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.uoms.insert_one(doc)
+    uom_converter.invalidate()
+    audit_trail.record("uom", uom.id, "create", current_user, after=doc)
     return uom
 
+@api_router.put("/masters/uoms/{uom_id}", response_model=UOMMaster)
+async def update_uom(uom_id: str, uom: UOMMaster, current_user: Dict = Depends(get_current_user)):
+    doc = uom.model_dump()
+    doc['created_at'] = doc['created_at'].isoformat()
+    existing = await db.uoms.find_one_and_update({"id": uom_id}, {"$set": doc}, projection={"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="UOM not found")
+    uom_converter.invalidate()
+    audit_trail.record("uom", uom_id, "update", current_user, before=existing, after=doc)
+    return uom
+
+@api_router.post("/uoms/convert", response_model=List[UOMConversionResult])
+async def convert_uoms(request: UOMConversionRequest, current_user: Dict = Depends(get_current_user)):
+    import numpy as np
+    converter = await uom_converter.get()
+    qtys = np.array([line.qty for line in request.lines], dtype=float)
+    converted = converter.convert_many(
+        qtys, [line.from_uom for line in request.lines], [line.to_uom for line in request.lines]
+    )
+    results = []
+    for line, qty in zip(request.lines, converted.tolist()):
+        if math.isnan(qty):
+            results.append(UOMConversionResult(uom=line.to_uom, error=f"No conversion from {line.from_uom} to {line.to_uom}"))
+        else:
+            results.append(UOMConversionResult(
+                qty=converter.round(qty, line.to_uom) if request.round_to_precision else qty,
+                uom=line.to_uom,
+            ))
+    return results
+
 @api_router.get("/masters/uoms", response_model=List[UOMMaster])
-async def get_uoms(current_user: Dict = Depends(get_current_user)):
-    uoms = await db.uoms.find({}, {"_id": 0}).to_list(1000)
+async def get_uoms(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    uoms = await db.uoms.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(uoms)
     for uom in uoms:
         if isinstance(uom['created_at'], str):
             uom['created_at'] = datetime.fromisoformat(uom['created_at'])
@@ -578,12 +2018,29 @@ async def create_supplier(supplier: SupplierMaster, current_user: Dict = Depends
     doc = supplier.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.suppliers.insert_one(doc)
+    audit_trail.record("supplier", supplier.id, "create", current_user, after=doc)
     return supplier
 
-@api_router.get("/masters/suppliers", response_model=List[SupplierMaster])
-async def get_suppliers(current_user: Dict = Depends(get_current_user)):
-    suppliers = await db.suppliers.find({}, {"_id": 0}).to_list(1000)
-    for supplier in suppliers:
+@api_router.put("/masters/suppliers/{supplier_id}", response_model=SupplierMaster)
+async def update_supplier(supplier_id: str, supplier: SupplierMaster, current_user: Dict = Depends(get_current_user)):
+    supplier.id = supplier_id
+    doc = supplier.model_dump()
+    doc['created_at'] = doc['created_at'].isoformat()
+    existing = await db.suppliers.find_one_and_update({"id": supplier_id}, {"$set": doc}, projection={"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Supplier not found")
+    audit_trail.record("supplier", supplier_id, "update", current_user, before=existing, after=doc)
+    if existing.get('name') != supplier.name:
+        await start_rename("supplier", supplier_id, existing.get('name') or "", supplier.name, current_user)
+    return supplier
+
+@api_router.get("/masters/suppliers", response_model=List[SupplierMaster])
+async def get_suppliers(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    suppliers = await db.suppliers.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(suppliers)
+    for supplier in suppliers:
         if isinstance(supplier['created_at'], str):
             supplier['created_at'] = datetime.fromisoformat(supplier['created_at'])
     return suppliers
@@ -593,44 +2050,221 @@ async def get_suppliers(current_user: Dict = Depends(get_current_user)):
 async def create_warehouse(warehouse: WarehouseMaster, current_user: Dict = Depends(get_current_user)):
     doc = warehouse.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    warehouse.path_ids = doc['path_ids'] = await compute_path(db.warehouses, 'parent_warehouse_id', doc)
+    doc['updated_seq'] = await next_sync_seq()
     await db.warehouses.insert_one(doc)
+    audit_trail.record("warehouse", warehouse.id, "create", current_user, after=doc)
+    return warehouse
+
+@api_router.put("/masters/warehouses/{warehouse_id}", response_model=WarehouseMaster)
+async def update_warehouse(warehouse_id: str, warehouse: WarehouseMaster, current_user: Dict = Depends(get_current_user)):
+    warehouse.id = warehouse_id
+    doc = warehouse.model_dump()
+    doc['created_at'] = doc['created_at'].isoformat()
+    warehouse.path_ids = doc['path_ids'] = await compute_path(db.warehouses, 'parent_warehouse_id', doc)
+    doc['updated_seq'] = await next_sync_seq()
+    existing = await db.warehouses.find_one_and_update({"id": warehouse_id}, {"$set": doc}, projection={"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Warehouse not found")
+    audit_trail.record("warehouse", warehouse_id, "update", current_user, before=existing, after=doc)
+    if existing.get('path_ids') != doc['path_ids']:
+        paths = await repath_descendants(db.warehouses, warehouse_id, doc['path_ids'])
+        await propagate_stock_paths('warehouse_path', 'warehouse_id', paths)
+    if existing.get('warehouse_name') != warehouse.warehouse_name:
+        await start_rename("warehouse", warehouse_id, existing.get('warehouse_name') or "", warehouse.warehouse_name, current_user)
     return warehouse
 
 @api_router.get("/masters/warehouses", response_model=List[WarehouseMaster])
-async def get_warehouses(current_user: Dict = Depends(get_current_user)):
-    warehouses = await db.warehouses.find({}, {"_id": 0}).to_list(1000)
+async def get_warehouses(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    warehouses = await db.warehouses.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(warehouses)
     for warehouse in warehouses:
         if isinstance(warehouse['created_at'], str):
             warehouse['created_at'] = datetime.fromisoformat(warehouse['created_at'])
     return warehouses
 
 # ============ BIN Location Routes ============
+def bin_walk_key(bin_loc: Dict) -> str:
+    """Sortable aisle/rack/level key; numeric parts are zero-padded so aisle 2 precedes aisle 10."""
+    parts = []
+    for field in ("aisle", "rack", "level"):
+        value = (bin_loc.get(field) or "").strip()
+        parts.append(value.zfill(6) if value.isdigit() else value.upper())
+    parts.append(bin_loc.get('bin_code') or "")
+    return "|".join(parts)
+
+async def backfill_bin_walk_keys():
+    bins = await db.bin_locations.find({"walk_key": {"$exists": False}}, {"_id": 0}).to_list(None)
+    if bins:
+        await db.bin_locations.bulk_write(
+            [UpdateOne({"id": b['id']}, {"$set": {"walk_key": bin_walk_key(b)}}) for b in bins], ordered=False
+        )
+
 @api_router.post("/masters/bin-locations", response_model=BINLocationMaster)
 async def create_bin_location(bin_loc: BINLocationMaster, current_user: Dict = Depends(get_current_user)):
     doc = bin_loc.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc['walk_key'] = bin_walk_key(doc)
+    doc['updated_seq'] = await next_sync_seq()
     await db.bin_locations.insert_one(doc)
+    audit_trail.record("bin_location", bin_loc.id, "create", current_user, after=doc)
     return bin_loc
 
 @api_router.get("/masters/bin-locations", response_model=List[BINLocationMaster])
-async def get_bin_locations(current_user: Dict = Depends(get_current_user)):
-    bins = await db.bin_locations.find({}, {"_id": 0}).to_list(1000)
+async def get_bin_locations(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    bins = await db.bin_locations.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(bins)
     for bin_loc in bins:
         if isinstance(bin_loc['created_at'], str):
             bin_loc['created_at'] = datetime.fromisoformat(bin_loc['created_at'])
     return bins
 
+# ============ GST Computation ============
+COMPANY_STATE_CODE = os.environ.get('COMPANY_STATE_CODE')
+PAISE = Decimal("0.01")
+
+class TaxRateTable:
+    """HSN code -> (CGST, SGST, IGST) rates in basis points, reloaded lazily after tax master writes."""
+
+    def __init__(self):
+        self.rates: Dict[str, tuple] = {}
+        self._generation = 0
+        self._loaded_generation = -1
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._generation += 1
+
+    async def get(self) -> Dict[str, tuple]:
+        # Callers arriving mid-reload wait on the lock rather than read the old (or empty) table
+        while self._loaded_generation != self._generation:
+            async with self._lock:
+                generation = self._generation
+                if self._loaded_generation == generation:
+                    continue
+                taxes = await db.tax_hsn.find({"status": "Active"}, {"_id": 0}).to_list(None)
+                self.rates = {
+                    tax['hsn_code']: tuple(int(round(tax.get(field, 0.0) * 100)) for field in ('cgst_rate', 'sgst_rate', 'igst_rate'))
+                    for tax in taxes
+                }
+                self._loaded_generation = generation
+        return self.rates
+
+tax_rate_table = TaxRateTable()
+
+def gst_state_of(gstin: Optional[str]) -> Optional[str]:
+    return gstin[:2] if gstin and gstin[:2].isdigit() else None
+
+async def load_tax_context(pos: List[Dict]):
+    """Fetch, in one query per collection, the HSN of every line and the states of every PO."""
+    item_ids = {line['item_id'] for po in pos for line in po['items']}
+    items = {item['id']: item async for item in db.items.find({"id": {"$in": list(item_ids)}}, {"_id": 0, "id": 1, "hsn": 1, "category_id": 1})}
+    category_ids = {item['category_id'] for item in items.values() if not item.get('hsn')}
+    categories = {cat['id']: cat async for cat in db.item_categories.find({"id": {"$in": list(category_ids)}}, {"_id": 0, "id": 1, "default_hsn": 1})}
+    hsn_by_item = {
+        item_id: item.get('hsn') or categories.get(item['category_id'], {}).get('default_hsn')
+        for item_id, item in items.items()
+    }
+    supplier_ids = {po['supplier_id'] for po in pos}
+    suppliers = {sup['id']: gst_state_of(sup.get('gst')) async for sup in db.suppliers.find({"id": {"$in": list(supplier_ids)}}, {"_id": 0, "id": 1, "gst": 1})}
+    warehouse_ids = {po['warehouse_id'] for po in pos if po.get('warehouse_id')}
+    warehouses = {wh['id']: wh.get('gst_state_code') async for wh in db.warehouses.find({"id": {"$in": list(warehouse_ids)}}, {"_id": 0, "id": 1, "gst_state_code": 1})}
+    return hsn_by_item, suppliers, warehouses
+
+async def compute_po_taxes(pos: List[Dict]):
+    """Recompute line and document totals for ``pos`` in place.
+
+    Amounts are carried as integer paise and rates as integer basis points, so
+    the vectorized tax arithmetic is exact; lines whose HSN has no active rate
+    are treated as exempt.
+    """
+    if not pos:
+        return
+    import numpy as np
+    rates = await tax_rate_table.get()
+    hsn_by_item, supplier_states, warehouse_states = await load_tax_context(pos)
+
+    po_index, amounts, rate_rows, intra = [], [], [], []
+    for i, po in enumerate(pos):
+        supplier_state = supplier_states.get(po['supplier_id'])
+        delivery_state = warehouse_states.get(po.get('warehouse_id')) or COMPANY_STATE_CODE
+        # Unknown states are treated as intra-state
+        po_intra = not supplier_state or not delivery_state or supplier_state == delivery_state
+        po['tax_type'] = "intra" if po_intra else "inter"
+        for line in po['items']:
+            line['hsn'] = hsn_by_item.get(line['item_id'])
+            amount = (Decimal(str(line['qty'])) * Decimal(str(line['rate']))).quantize(PAISE, rounding=ROUND_HALF_UP)
+            po_index.append(i)
+            amounts.append(int(amount * 100))
+            rate_rows.append(rates.get(line['hsn'], (0, 0, 0)))
+            intra.append(po_intra)
+
+    po_index = np.array(po_index, dtype=np.intp)
+    amounts = np.array(amounts, dtype=np.int64)
+    rate_rows = np.array(rate_rows, dtype=np.int64).reshape(-1, 3)
+    intra = np.array(intra, dtype=bool)
+
+    def tax_at(bp: np.ndarray) -> np.ndarray:
+        # Round half up on exact integers: paise * bp / 10000
+        return (amounts * bp + 5000) // 10000
+
+    cgst = np.where(intra, tax_at(rate_rows[:, 0]), 0)
+    sgst = np.where(intra, tax_at(rate_rows[:, 1]), 0)
+    igst = np.where(intra, 0, tax_at(rate_rows[:, 2]))
+    line_tax = cgst + sgst + igst
+    line_rate_bp = np.where(intra, rate_rows[:, 0] + rate_rows[:, 1], rate_rows[:, 2])
+
+    subtotals = np.zeros(len(pos), dtype=np.int64)
+    tax_totals = np.zeros(len(pos), dtype=np.int64)
+    np.add.at(subtotals, po_index, amounts)
+    np.add.at(tax_totals, po_index, line_tax)
+
+    line_numbers = iter(range(len(amounts)))
+    for i, po in enumerate(pos):
+        for line in po['items']:
+            j = next(line_numbers)
+            line['amount'] = int(amounts[j]) / 100
+            line['tax_rate'] = int(line_rate_bp[j]) / 100
+            line['cgst_amount'] = int(cgst[j]) / 100
+            line['sgst_amount'] = int(sgst[j]) / 100
+            line['igst_amount'] = int(igst[j]) / 100
+            line['tax_amount'] = int(line_tax[j]) / 100
+            line['total'] = int(amounts[j] + line_tax[j]) / 100
+        po['subtotal'] = int(subtotals[i]) / 100
+        po['tax_amount'] = int(tax_totals[i]) / 100
+        po['total_amount'] = int(subtotals[i] + tax_totals[i]) / 100
+
 # ============ Tax/HSN Master Routes ============
 @api_router.post("/masters/tax-hsn", response_model=TaxHSNMaster)
 async def create_tax_hsn(tax: TaxHSNMaster, current_user: Dict = Depends(get_current_user)):
     doc = tax.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.tax_hsn.insert_one(doc)
+    tax_rate_table.invalidate()
+    audit_trail.record("tax_hsn", tax.id, "create", current_user, after=doc)
+    return tax
+
+@api_router.put("/masters/tax-hsn/{tax_id}", response_model=TaxHSNMaster)
+async def update_tax_hsn(tax_id: str, tax: TaxHSNMaster, current_user: Dict = Depends(get_current_user)):
+    doc = tax.model_dump()
+    doc['created_at'] = doc['created_at'].isoformat()
+    existing = await db.tax_hsn.find_one_and_update({"id": tax_id}, {"$set": doc}, projection={"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Tax/HSN not found")
+    tax_rate_table.invalidate()
+    audit_trail.record("tax_hsn", tax_id, "update", current_user, before=existing, after=doc)
     return tax
 
 @api_router.get("/masters/tax-hsn", response_model=List[TaxHSNMaster])
-async def get_tax_hsn(current_user: Dict = Depends(get_current_user)):
-    taxes = await db.tax_hsn.find({}, {"_id": 0}).to_list(1000)
+async def get_tax_hsn(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    taxes = await db.tax_hsn.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(taxes)
     for tax in taxes:
         if isinstance(tax['created_at'], str):
             tax['created_at'] = datetime.fromisoformat(tax['created_at'])
@@ -646,11 +2280,15 @@ async def create_indent(indent: PurchaseIndent, current_user: Dict = Depends(get
     for item in doc['items']:
         item['required_date'] = item['required_date'].isoformat()
     await db.purchase_indents.insert_one(doc)
+    audit_trail.record("purchase_indent", indent.id, "create", current_user, after=doc)
     return indent
 
 @api_router.get("/purchase/indents", response_model=List[PurchaseIndent])
-async def get_indents(current_user: Dict = Depends(get_current_user)):
-    indents = await db.purchase_indents.find({}, {"_id": 0}).to_list(1000)
+async def get_indents(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    indents = await db.purchase_indents.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(indents)
     for indent in indents:
         if isinstance(indent['created_at'], str):
             indent['created_at'] = datetime.fromisoformat(indent['created_at'])
@@ -659,6 +2297,81 @@ async def get_indents(current_user: Dict = Depends(get_current_user)):
                 item['required_date'] = datetime.fromisoformat(item['required_date'])
     return indents
 
+# ============ PO Receipt Tracking ============
+def init_po_line_quantities(doc: Dict):
+    """Reset receipt tracking on a new PO: nothing received, every line fully open."""
+    for line in doc['items']:
+        line['received_qty'] = 0.0
+        line['accepted_qty'] = 0.0
+        line['rejected_qty'] = 0.0
+        line['open_qty'] = line['qty']
+    doc['open_qty'] = sum(line['qty'] for line in doc['items'])
+
+async def post_grn_receipt(po_id: str, item_id: str, qty: float):
+    """Atomically book ``qty`` against the PO line, rejecting receipts beyond the open quantity."""
+    result = await db.purchase_orders.update_one(
+        {"id": po_id, "items": {"$elemMatch": {"item_id": item_id, "open_qty": {"$gte": qty - QTY_EPSILON}}}},
+        {"$inc": {"items.$.received_qty": qty, "items.$.open_qty": -qty, "open_qty": -qty},
+         "$set": {"updated_seq": await next_sync_seq()}}
+    )
+    if result.matched_count:
+        return
+    po = await db.purchase_orders.find_one({"id": po_id}, {"_id": 0, "items": 1})
+    if not po:
+        raise HTTPException(status_code=404, detail="PO not found")
+    line = next((line for line in po['items'] if line['item_id'] == item_id), None)
+    if not line:
+        raise HTTPException(status_code=400, detail="Item is not on the PO")
+    raise HTTPException(status_code=400, detail=f"Receipt exceeds open PO quantity ({line.get('open_qty', 0)})")
+
+async def post_qc_result(po_id: str, item_id: str, qty_accepted: float, qty_rejected: float, session=None):
+    # Rejected goods go back to the supplier, so they reopen the line for redelivery
+    await db.purchase_orders.update_one(
+        {"id": po_id, "items.item_id": item_id},
+        {"$inc": {
+            "items.$.accepted_qty": qty_accepted,
+            "items.$.rejected_qty": qty_rejected,
+            "items.$.open_qty": qty_rejected,
+            "open_qty": qty_rejected,
+        }, "$set": {"updated_seq": await next_sync_seq()}},
+        session=session
+    )
+
+async def backfill_po_line_quantities():
+    """Populate receipt tracking on POs created before it existed, from their GRNs and QCs."""
+    pos = await db.purchase_orders.find({"open_qty": {"$exists": False}}, {"_id": 0, "id": 1, "items": 1}).to_list(None)
+    if not pos:
+        return
+    po_ids = [po['id'] for po in pos]
+    received = {
+        (row['_id']['po_id'], row['_id']['item_id']): row['qty']
+        async for row in db.grn.aggregate([
+            {"$match": {"po_id": {"$in": po_ids}}},
+            {"$group": {"_id": {"po_id": "$po_id", "item_id": "$item_id"}, "qty": {"$sum": "$qty"}}},
+        ])
+    }
+    checked = {
+        (row['_id']['po_id'], row['_id']['item_id']): row
+        async for row in db.quality_checks.aggregate([
+            {"$match": {"po_id": {"$in": po_ids}}},
+            {"$group": {"_id": {"po_id": "$po_id", "item_id": "$item_id"},
+                        "accepted": {"$sum": "$qty_accepted"}, "rejected": {"$sum": "$qty_rejected"}}},
+        ])
+    }
+    operations = []
+    for po in pos:
+        open_total = 0.0
+        for line in po['items']:
+            key = (po['id'], line['item_id'])
+            qc = checked.get(key, {})
+            line['received_qty'] = received.get(key, 0.0)
+            line['accepted_qty'] = qc.get('accepted', 0.0)
+            line['rejected_qty'] = qc.get('rejected', 0.0)
+            line['open_qty'] = max(line['qty'] - line['received_qty'] + line['rejected_qty'], 0.0)
+            open_total += line['open_qty']
+        operations.append(UpdateOne({"id": po['id']}, {"$set": {"items": po['items'], "open_qty": open_total}}))
+    await db.purchase_orders.bulk_write(operations, ordered=False)
+
 # ============ Purchase Order Routes ============
 @api_router.post("/purchase/orders", response_model=PurchaseOrder)
 async def create_po(po: PurchaseOrder, current_user: Dict = Depends(get_current_user)):
@@ -668,12 +2381,52 @@ async def create_po(po: PurchaseOrder, current_user: Dict = Depends(get_current_
     doc['created_at'] = doc['created_at'].isoformat()
     if doc.get('approved_at'):
         doc['approved_at'] = doc['approved_at'].isoformat()
+    # Client-sent amounts and taxes are recomputed from the HSN rate table
+    await compute_po_taxes([doc])
+    if po.status == ApprovalStatus.PENDING:
+        doc.update(approval_engine.start_fields("purchase_order", doc))
+    init_po_line_quantities(doc)
+    doc['updated_seq'] = await next_sync_seq()
     await db.purchase_orders.insert_one(doc)
-    return po
+    doc.pop('_id', None)
+    audit_trail.record("purchase_order", doc['id'], "create", current_user, after=doc)
+    return PurchaseOrder(**doc)
+
+@api_router.post("/purchase/orders/reprice")
+async def reprice_draft_pos(request: RepriceRequest, current_user: Dict = Depends(get_current_user)):
+    query: Dict[str, Any] = {"status": ApprovalStatus.DRAFT}
+    if request.hsn_codes:
+        query['items.hsn'] = {"$in": request.hsn_codes}
+    tax_rate_table.invalidate()
+    repriced = 0
+    priced_fields = ("items", "tax_type", "subtotal", "tax_amount", "total_amount")
+    cursor = db.purchase_orders.find(query, {"_id": 0, "id": 1, "supplier_id": 1, "warehouse_id": 1, **{key: 1 for key in priced_fields}})
+    while True:
+        batch = await cursor.to_list(1000)
+        if not batch:
+            break
+        before = {po['id']: copy.deepcopy({key: po.get(key) for key in priced_fields}) for po in batch}
+        await compute_po_taxes(batch)
+        first_seq = await next_sync_seq(len(batch))
+        result = await db.purchase_orders.bulk_write([
+            UpdateOne(
+                {"id": po['id'], "status": ApprovalStatus.DRAFT},
+                {"$set": {**{key: po[key] for key in priced_fields}, "updated_seq": first_seq + i}}
+            )
+            for i, po in enumerate(batch)
+        ], ordered=False)
+        repriced += result.modified_count
+        for po in batch:
+            audit_trail.record("purchase_order", po['id'], "update", current_user,
+                               before=before[po['id']], after={key: po[key] for key in priced_fields})
+    return {"message": "Draft POs repriced", "repriced": repriced}
 
 @api_router.get("/purchase/orders", response_model=List[PurchaseOrder])
-async def get_pos(current_user: Dict = Depends(get_current_user)):
-    pos = await db.purchase_orders.find({}, {"_id": 0}).to_list(1000)
+async def get_pos(start_date: Optional[str] = None, end_date: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    pos = await find_documents("purchase_orders", {}, start_date, end_date, projection=projection)
+    if projection:
+        return sparse_response(pos)
     for po in pos:
         if isinstance(po['created_at'], str):
             po['created_at'] = datetime.fromisoformat(po['created_at'])
@@ -683,45 +2436,211 @@ async def get_pos(current_user: Dict = Depends(get_current_user)):
 
 @api_router.put("/purchase/orders/{po_id}/approve")
 async def approve_po(po_id: str, remarks: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {
-            "status": ApprovalStatus.APPROVED,
-            "approved_by": current_user['user_id'],
-            "approved_at": datetime.now(timezone.utc).isoformat(),
-            "remarks": remarks
-        }}
-    )
-    return {"message": "PO approved successfully"}
+    outcome = await approve_single("purchase_order", po_id, BatchApprovalAction.APPROVE, remarks, current_user)
+    if outcome.status == ApprovalStatus.PENDING:
+        return {"message": "PO approved at current level and forwarded", "status": outcome.status}
+    return {"message": "PO approved successfully", "status": outcome.status}
 
 @api_router.put("/purchase/orders/{po_id}/reject")
 async def reject_po(po_id: str, remarks: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {
-            "status": ApprovalStatus.REJECTED,
-            "approved_by": current_user['user_id'],
-            "approved_at": datetime.now(timezone.utc).isoformat(),
-            "remarks": remarks
-        }}
+    outcome = await approve_single("purchase_order", po_id, BatchApprovalAction.REJECT, remarks, current_user)
+    return {"message": "PO rejected successfully", "status": outcome.status}
+
+# ============ Stock Posting ============
+class InsufficientStock(Exception):
+    pass
+
+async def post_stock_movement(item_id: str, item_name: str, warehouse_id: str, qty: float, uom: str, bin_location_id: Optional[str] = None, session=None, unreserved_only: bool = False):
+    """Atomically add ``qty`` (negative to remove) to the item's warehouse balance and, if given, its bin balance.
+
+    Removals are conditional on the balance covering them and raise InsufficientStock otherwise;
+    with ``unreserved_only`` stock held by reservations doesn't count towards that.
+    """
+    if bin_location_id and session is None:
+        # Warehouse and bin totals must move together
+        async with await client.start_session() as own_session:
+            async with own_session.start_transaction():
+                await post_stock_movement(item_id, item_name, warehouse_id, qty, uom, bin_location_id, session=own_session, unreserved_only=unreserved_only)
+        return
+
+    now = datetime.now(timezone.utc).isoformat()
+    stamp = {"last_updated": now, "updated_seq": await next_sync_seq()}
+    key = {"item_id": item_id, "warehouse_id": warehouse_id}
+    if qty < 0:
+        covered = available_at_least(-qty) if unreserved_only else {"qty": {"$gte": -qty - QTY_EPSILON}}
+        result = await db.stock_balance.update_one(
+            {**key, **covered},
+            {"$inc": {"qty": qty}, "$set": stamp},
+            session=session
+        )
+        if not result.matched_count:
+            raise InsufficientStock()
+    else:
+        result = await db.stock_balance.update_one(
+            key, {"$inc": {"qty": qty}, "$set": stamp}, session=session
+        )
+        if not result.matched_count:
+            # Upsert so two first receipts of the same item can't create duplicate balances
+            await db.stock_balance.update_one(
+                key,
+                {
+                    "$inc": {"qty": qty},
+                    "$set": stamp,
+                    "$setOnInsert": {
+                        "id": str(uuid.uuid4()),
+                        "item_name": item_name,
+                        "uom": uom,
+                        **await stock_path_fields(item_id, warehouse_id, session=session),
+                    },
+                },
+                upsert=True,
+                session=session
+            )
+
+    if bin_location_id:
+        await post_bin_movement(item_id, item_name, warehouse_id, bin_location_id, qty, uom, now, session)
+    stock_rollup_cache.invalidate()
+
+async def post_bin_movement(item_id: str, item_name: str, warehouse_id: str, bin_location_id: str, qty: float, uom: str, now: str, session):
+    key = {"item_id": item_id, "warehouse_id": warehouse_id, "bin_location_id": bin_location_id}
+    if qty < 0:
+        result = await db.bin_stock_balance.update_one(
+            {**key, "qty": {"$gte": -qty - QTY_EPSILON}},
+            {"$inc": {"qty": qty}, "$set": {"last_updated": now}},
+            session=session
+        )
+        if not result.matched_count:
+            raise InsufficientStock()
+        return
+    bin_loc = await db.bin_locations.find_one({"id": bin_location_id}, {"_id": 0}, session=session)
+    if not bin_loc or bin_loc['warehouse_id'] != warehouse_id:
+        raise HTTPException(status_code=400, detail="BIN location does not belong to the warehouse")
+    await db.bin_stock_balance.update_one(
+        key,
+        {
+            "$inc": {"qty": qty},
+            "$set": {"last_updated": now},
+            "$setOnInsert": {
+                "id": str(uuid.uuid4()),
+                "item_name": item_name,
+                "bin_code": bin_loc['bin_code'],
+                "walk_key": bin_loc.get('walk_key') or bin_walk_key(bin_loc),
+                "uom": uom,
+            },
+        },
+        upsert=True,
+        session=session
+    )
+
+async def run_in_transaction(callback):
+    """Run ``callback(session)`` in a Motor transaction, retrying transient errors."""
+    async with await client.start_session() as session:
+        result = await session.with_transaction(callback)
+    # Rollups computed while the transaction was open may have cached pre-commit stock
+    stock_rollup_cache.invalidate()
+    return result
+
+# ============ Lot Tracking ============
+# Lots without an expiry sort after every dated lot in FEFO order
+NO_EXPIRY_SORT = "9999-12-31"
+
+async def post_lot_receipt(item_id: str, item_name: str, warehouse_id: str, batch_no: str, qty: float, uom: str, expiry_date: Optional[datetime], session=None):
+    now = datetime.now(timezone.utc).isoformat()
+    expiry = expiry_date.isoformat() if expiry_date else None
+    await db.lot_balance.update_one(
+        {"item_id": item_id, "warehouse_id": warehouse_id, "batch_no": batch_no},
+        {
+            "$inc": {"qty": qty},
+            "$set": {"last_updated": now},
+            "$setOnInsert": {
+                "id": str(uuid.uuid4()),
+                "item_name": item_name,
+                "uom": uom,
+                "expiry_date": expiry,
+                "expiry_sort": expiry[:10] if expiry else NO_EXPIRY_SORT,
+                "received_at": now,
+            },
+        },
+        upsert=True,
+        session=session
     )
-    return {"message": "PO rejected successfully"}
+
+async def allocate_lots_fefo(item_id: str, warehouse_id: str, qty: float, batch_no: Optional[str] = None, session=None) -> List[Dict]:
+    """Consume ``qty`` from open lots, earliest expiry first, with one conditional bulk_write.
+
+    Lot-tracked stock is consumed as far as it goes; any remainder comes from
+    untracked stock, which the warehouse balance check already covers.
+    """
+    query: Dict[str, Any] = {"item_id": item_id, "warehouse_id": warehouse_id, "qty": {"$gt": QTY_EPSILON}}
+    if batch_no:
+        query['batch_no'] = batch_no
+    lots = db.lot_balance.find(
+        query, {"_id": 0, "batch_no": 1, "qty": 1, "expiry_date": 1}, session=session
+    ).sort([("expiry_sort", ASCENDING), ("received_at", ASCENDING)])
+
+    allocations = []
+    remaining = qty
+    async for lot in lots:
+        take = min(lot['qty'], remaining)
+        allocations.append({"batch_no": lot['batch_no'], "qty": take, "expiry_date": lot.get('expiry_date')})
+        remaining -= take
+        if remaining <= QTY_EPSILON:
+            break
+    if batch_no and remaining > QTY_EPSILON:
+        raise InsufficientStock()
+    if not allocations:
+        return allocations
+
+    now = datetime.now(timezone.utc).isoformat()
+    result = await db.lot_balance.bulk_write([
+        UpdateOne(
+            {"item_id": item_id, "warehouse_id": warehouse_id, "batch_no": a['batch_no'], "qty": {"$gte": a['qty'] - QTY_EPSILON}},
+            {"$inc": {"qty": -a['qty']}, "$set": {"last_updated": now}}
+        )
+        for a in allocations
+    ], ordered=True, session=session)
+    if result.modified_count != len(allocations):
+        # A concurrent issue drained one of the lots; the transaction is aborted
+        raise InsufficientStock()
+    return allocations
+
+async def find_quarantine_warehouse(session=None) -> Optional[str]:
+    warehouse = await db.warehouses.find_one(
+        {"warehouse_type": "Quarantine", "status": "Active"}, {"_id": 0, "id": 1}, session=session
+    )
+    return warehouse['id'] if warehouse else None
 
 # ============ GRN Routes ============
 @api_router.post("/inventory/grn", response_model=GRN)
 async def create_grn(grn: GRN, current_user: Dict = Depends(get_current_user)):
     if not grn.grn_no:
         grn.grn_no = await get_next_number("GRN")
+    grn.qc_qty = 0.0
     doc = grn.model_dump()
     doc['received_at'] = doc['received_at'].isoformat()
     if doc.get('invoice_date'):
         doc['invoice_date'] = doc['invoice_date'].isoformat()
-    await db.grn.insert_one(doc)
+    await post_grn_receipt(grn.po_id, grn.item_id, grn.qty)
+    try:
+        await db.grn.insert_one(doc)
+    except Exception:
+        # Give the quantity back so the PO line stays consistent with posted GRNs
+        await db.purchase_orders.update_one(
+            {"id": grn.po_id, "items.item_id": grn.item_id},
+            {"$inc": {"items.$.received_qty": -grn.qty, "items.$.open_qty": grn.qty, "open_qty": grn.qty},
+             "$set": {"updated_seq": await next_sync_seq()}}
+        )
+        raise
+    audit_trail.record("grn", grn.id, "create", current_user, after=doc)
+    supplier_score_refresher.schedule_grn(doc)
     return grn
 
 @api_router.get("/inventory/grn", response_model=List[GRN])
-async def get_grns(current_user: Dict = Depends(get_current_user)):
-    grns = await db.grn.find({}, {"_id": 0}).to_list(1000)
+async def get_grns(start_date: Optional[str] = None, end_date: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    grns = await find_documents("grn", {}, start_date, end_date, projection=projection)
+    if projection:
+        return sparse_response(grns)
     for grn in grns:
         if isinstance(grn['received_at'], str):
             grn['received_at'] = datetime.fromisoformat(grn['received_at'])
@@ -730,69 +2649,382 @@ async def get_grns(current_user: Dict = Depends(get_current_user)):
     return grns
 
 # ============ Quality Check Routes ============
+# GRN status after QC, by QC outcome
+QC_GRN_STATUS = {
+    QCStatus.ACCEPTED: "QC Passed",
+    QCStatus.REJECTED: "QC Failed",
+    QCStatus.PARTIAL: "QC Partial",
+}
+
+async def find_qc_grn(grn_id: str) -> Tuple[Any, Dict]:
+    """The GRN a QC inspects and the collection holding it, which may be an archive."""
+    for name in await with_archives("grn"):
+        grn = await db[name].find_one({"id": grn_id}, {"_id": 0})
+        if grn:
+            if 'qc_qty' not in grn:
+                # GRNs from before the running total get it from their existing QCs
+                inspected = 0.0
+                for qc_name in await with_archives("quality_checks"):
+                    async for row in db[qc_name].aggregate([
+                        {"$match": {"grn_id": grn_id}},
+                        {"$group": {"_id": None, "qty": {"$sum": "$qty_received"}}},
+                    ]):
+                        inspected += row['qty']
+                await db[name].update_one({"id": grn_id, "qc_qty": {"$exists": False}}, {"$set": {"qc_qty": inspected}})
+            return db[name], grn
+    raise HTTPException(status_code=404, detail="GRN not found")
+
+async def claim_qc_qty(grn_collection, grn: Dict, qty: float, session=None):
+    """Count ``qty`` as inspected on the GRN, refusing more than it received across all its QCs."""
+    result = await grn_collection.update_one(
+        {"id": grn['id'], "$expr": {"$lte": [{"$add": [{"$ifNull": ["$qc_qty", 0]}, qty]}, {"$add": ["$qty", QTY_EPSILON]}]}},
+        {"$inc": {"qc_qty": qty}},
+        session=session
+    )
+    if not result.matched_count:
+        raise HTTPException(status_code=400, detail="Quantity received exceeds what is left to inspect on the GRN")
+
 @api_router.post("/quality/checks", response_model=QualityCheck)
-async def create_qc(qc: QualityCheck, current_user: Dict = Depends(get_current_user)):
+async def create_qc(qc: QualityCheck, post_stock: bool = False, quarantine_warehouse_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
     if not qc.qc_no:
         qc.qc_no = await get_next_number("QC")
+    if qc.qty_accepted + qc.qty_rejected > qc.qty_received + QTY_EPSILON:
+        raise HTTPException(status_code=400, detail="Accepted and rejected quantities exceed quantity received")
+    grn_collection, grn = await find_qc_grn(qc.grn_id)
+    # The PO line being settled is the GRN's, whatever the client sent
+    qc.grn_no, qc.po_id, qc.item_id, qc.item_name = grn['grn_no'], grn['po_id'], grn['item_id'], grn['item_name']
     doc = qc.model_dump()
     doc['inspected_at'] = doc['inspected_at'].isoformat()
-    await db.quality_checks.insert_one(doc)
-    
-    # Update GRN status
-    if qc.qc_status == QCStatus.ACCEPTED:
-        await db.grn.update_one({"id": qc.grn_id}, {"$set": {"status": "QC Passed"}})
-    elif qc.qc_status == QCStatus.REJECTED:
-        await db.grn.update_one({"id": qc.grn_id}, {"$set": {"status": "QC Failed"}})
-    
+
+    if not post_stock:
+        await claim_qc_qty(grn_collection, grn, qc.qty_received)
+        try:
+            await db.quality_checks.insert_one(doc)
+        except Exception:
+            await grn_collection.update_one({"id": qc.grn_id}, {"$inc": {"qc_qty": -qc.qty_received}})
+            raise
+        await post_qc_result(qc.po_id, qc.item_id, qc.qty_accepted, qc.qty_rejected)
+        if qc.qc_status in QC_GRN_STATUS:
+            await grn_collection.update_one({"id": qc.grn_id}, {"$set": {"status": QC_GRN_STATUS[qc.qc_status]}})
+        audit_trail.record("quality_check", qc.id, "create", current_user, after=doc)
+        supplier_score_refresher.schedule_qc(doc)
+        return qc
+
+    # Post accepted goods to the GRN warehouse and rejected goods to quarantine in one transaction
+    if qc.qty_rejected > 0 and not quarantine_warehouse_id:
+        quarantine_warehouse_id = await find_quarantine_warehouse()
+        if not quarantine_warehouse_id:
+            raise HTTPException(status_code=400, detail="No quarantine warehouse configured for rejected quantity")
+
+    inwards = []
+    for qty, warehouse_id in ((qc.qty_accepted, grn['warehouse_id']), (qc.qty_rejected, quarantine_warehouse_id)):
+        if qty > 0:
+            qty, uom = await to_base_uom(qc.item_id, qty, grn['uom'])
+            inwards.append(StockInward(
+                inward_no=await get_next_number("INWARD"),
+                qc_id=qc.id,
+                item_id=qc.item_id,
+                item_name=qc.item_name,
+                qty=qty,
+                uom=uom,
+                warehouse_id=warehouse_id,
+                created_by=current_user['user_id'],
+            ))
+
+    async with await client.start_session() as session:
+        async with session.start_transaction():
+            await claim_qc_qty(grn_collection, grn, qc.qty_received, session=session)
+            await db.quality_checks.insert_one(doc, session=session)
+            await post_qc_result(qc.po_id, qc.item_id, qc.qty_accepted, qc.qty_rejected, session=session)
+            if qc.qc_status in QC_GRN_STATUS:
+                await grn_collection.update_one({"id": qc.grn_id}, {"$set": {"status": QC_GRN_STATUS[qc.qc_status]}}, session=session)
+            for inward in inwards:
+                inward_doc = inward.model_dump()
+                inward_doc['created_at'] = inward_doc['created_at'].isoformat()
+                await db.stock_inward.insert_one(inward_doc, session=session)
+                await post_stock_movement(inward.item_id, inward.item_name, inward.warehouse_id, inward.qty, inward.uom, inward.bin_location_id, session=session)
+    audit_trail.record("quality_check", qc.id, "create", current_user, after=doc)
+    supplier_score_refresher.schedule_qc(doc)
+    for inward in inwards:
+        audit_trail.record("stock_inward", inward.id, "create", current_user, after=inward.model_dump(mode="json"))
     return qc
 
 @api_router.get("/quality/checks", response_model=List[QualityCheck])
-async def get_qcs(current_user: Dict = Depends(get_current_user)):
-    qcs = await db.quality_checks.find({}, {"_id": 0}).to_list(1000)
+async def get_qcs(start_date: Optional[str] = None, end_date: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    qcs = await find_documents("quality_checks", {}, start_date, end_date, projection=projection)
+    if projection:
+        return sparse_response(qcs)
     for qc in qcs:
         if isinstance(qc['inspected_at'], str):
             qc['inspected_at'] = datetime.fromisoformat(qc['inspected_at'])
     return qcs
 
+# ============ Supplier Scorecards ============
+# Weights of the 0-100 composite score
+SUPPLIER_SCORE_WEIGHTS = {"fill_rate": 0.5, "quality": 0.5}
+# Seconds to wait after a posting so a burst of GRNs/QCs costs one recompute
+SUPPLIER_SCORE_REFRESH_DELAY = float(os.environ.get('SUPPLIER_SCORE_REFRESH_DELAY', '2'))
+
+async def find_in_archives(name: str, doc_id: str, projection: Dict) -> Optional[Dict]:
+    """Find a document by id in a transaction collection, then in its archives."""
+    for source in await with_archives(name):
+        doc = await db[source].find_one({"id": doc_id}, projection)
+        if doc:
+            return doc
+    return None
+
+def month_bounds(period: str) -> Tuple[str, str]:
+    year, month = int(period[:4]), int(period[5:7])
+    end = f"{year + 1}-01" if month == 12 else f"{year}-{month + 1:02d}"
+    return f"{period}-01", f"{end}-01"
+
+def _iso_to_date(expression) -> Dict:
+    # Stored timestamps are UTC isoformat strings; the first 19 characters parse as a date
+    return {"$toDate": {"$substrBytes": [expression, 0, 19]}}
+
+def lookup_across(sources: List[str], local_field: str, as_field: str) -> List[Dict]:
+    """$lookup by ``id`` over a collection and its archives, concatenated into ``as_field``."""
+    parts = [f"_{as_field}_{i}" for i in range(len(sources))]
+    return [
+        {"$lookup": {"from": source, "localField": local_field, "foreignField": "id", "as": part}}
+        for source, part in zip(sources, parts)
+    ] + [{"$set": {as_field: {"$concatArrays": [f"${part}" for part in parts]}}}]
+
+def supplier_score_pipeline(start: str, end: str, sources: Dict[str, List[str]], lookups: Dict[str, List[str]],
+                            supplier_id: Optional[str] = None) -> List[Dict]:
+    """GRN lead times, PO fill and QC rejections per (supplier, month) in one pipeline.
+
+    Each branch starts from a range match on an indexed date field and runs over
+    ``sources[name]`` (the live collection first, then the archives the range reaches);
+    POs and GRNs are looked up over ``lookups[name]``, every archive included. POs count
+    towards the month they were raised in, GRNs and QCs towards the month they were posted.
+    """
+    supplier = {"supplier_id": supplier_id} if supplier_id else {}
+    grn_branch = [
+        {"$match": {**supplier, "received_at": {"$gte": start, "$lt": end}}},
+        *lookup_across(lookups['purchase_orders'], "po_id", "po"),
+        {"$project": {
+            "_id": 0, "supplier_id": 1, "supplier_name": 1,
+            "period": {"$substrBytes": ["$received_at", 0, 7]},
+            "grns": {"$literal": 1},
+            "received_qty": "$qty",
+            "lead_days": {"$let": {
+                "vars": {"po": {"$arrayElemAt": ["$po", 0]}},
+                "in": {"$cond": [
+                    {"$ifNull": ["$$po", False]},
+                    {"$divide": [{"$subtract": [
+                        _iso_to_date("$received_at"),
+                        _iso_to_date({"$ifNull": ["$$po.approved_at", "$$po.created_at"]}),
+                    ]}, 86400000]},
+                    None,
+                ]},
+            }},
+        }},
+    ]
+    qc_branch = [
+        {"$match": {"inspected_at": {"$gte": start, "$lt": end}}},
+        *lookup_across(lookups['grn'], "grn_id", "grn"),
+        {"$project": {
+            "_id": 0,
+            "supplier_id": {"$arrayElemAt": ["$grn.supplier_id", 0]},
+            "supplier_name": {"$arrayElemAt": ["$grn.supplier_name", 0]},
+            "period": {"$substrBytes": ["$inspected_at", 0, 7]},
+            "accepted_qty": "$qty_accepted",
+            "rejected_qty": "$qty_rejected",
+        }},
+        {"$match": supplier},
+    ]
+    po_branch = [
+        {"$match": {**supplier, "status": ApprovalStatus.APPROVED, "created_at": {"$gte": start, "$lt": end}}},
+        {"$unwind": "$items"},
+        {"$project": {
+            "_id": 0, "supplier_id": 1, "supplier_name": 1,
+            "period": {"$substrBytes": ["$created_at", 0, 7]},
+            "ordered_qty": "$items.qty",
+            "filled_qty": {"$min": ["$items.qty", {"$ifNull": ["$items.received_qty", 0]}]},
+        }},
+    ]
+    # The pipeline runs on the live grn collection; everything else is unioned in
+    unions = [
+        {"$unionWith": {"coll": source, "pipeline": branch}}
+        for name, branch in (("grn", grn_branch), ("quality_checks", qc_branch), ("purchase_orders", po_branch))
+        for source in sources[name]
+        if source != "grn"
+    ]
+    return grn_branch + unions + [
+        {"$match": {"supplier_id": {"$ne": None}}},
+        {"$group": {
+            "_id": {"supplier_id": "$supplier_id", "period": "$period"},
+            "supplier_name": {"$max": "$supplier_name"},
+            "grn_count": {"$sum": {"$ifNull": ["$grns", 0]}},
+            "received_qty": {"$sum": {"$ifNull": ["$received_qty", 0]}},
+            "avg_lead_time_days": {"$avg": "$lead_days"},
+            "max_lead_time_days": {"$max": "$lead_days"},
+            "ordered_qty": {"$sum": {"$ifNull": ["$ordered_qty", 0]}},
+            "filled_qty": {"$sum": {"$ifNull": ["$filled_qty", 0]}},
+            "accepted_qty": {"$sum": {"$ifNull": ["$accepted_qty", 0]}},
+            "rejected_qty": {"$sum": {"$ifNull": ["$rejected_qty", 0]}},
+        }},
+    ]
+
+def supplier_score_doc(row: Dict, computed_at: str) -> Dict:
+    inspected = row['accepted_qty'] + row['rejected_qty']
+    fill_rate = row['filled_qty'] / row['ordered_qty'] if row['ordered_qty'] > 0 else None
+    rejection_rate = row['rejected_qty'] / inspected if inspected > 0 else None
+    parts = {"fill_rate": fill_rate, "quality": None if rejection_rate is None else 1 - rejection_rate}
+    weights = {name: weight for name, weight in SUPPLIER_SCORE_WEIGHTS.items() if parts[name] is not None}
+    score = (100 * sum(parts[name] * weight for name, weight in weights.items()) / sum(weights.values())) if weights else None
+    lead = row['avg_lead_time_days']
+    return {
+        **row['_id'],
+        "supplier_name": row['supplier_name'],
+        "grn_count": row['grn_count'],
+        "received_qty": row['received_qty'],
+        "avg_lead_time_days": round(lead, 2) if lead is not None else None,
+        "max_lead_time_days": round(row['max_lead_time_days'], 2) if row['max_lead_time_days'] is not None else None,
+        "ordered_qty": row['ordered_qty'],
+        "filled_qty": row['filled_qty'],
+        "fill_rate": round(fill_rate, 4) if fill_rate is not None else None,
+        "accepted_qty": row['accepted_qty'],
+        "rejected_qty": row['rejected_qty'],
+        "rejection_rate": round(rejection_rate, 4) if rejection_rate is not None else None,
+        "score": round(score, 1) if score is not None else None,
+        "computed_at": computed_at,
+    }
+
+async def refresh_supplier_scores(start: str, end: str, supplier_id: Optional[str] = None) -> int:
+    """Recompute and upsert scorecards for every (supplier, month) with activity in [start, end)."""
+    now = datetime.now(timezone.utc).isoformat()
+    # Closed months live partly or wholly in the archives; both must count or the rebuild undercounts
+    sources = {name: dated_sources(name, {}, start, end)[1] for name in ("grn", "quality_checks", "purchase_orders")}
+    lookups = {name: await with_archives(name) for name in ("grn", "purchase_orders")}
+    pipeline = supplier_score_pipeline(start, end, sources, lookups, supplier_id)
+    operations = [
+        UpdateOne({"supplier_id": row['_id']['supplier_id'], "period": row['_id']['period']},
+                  {"$set": supplier_score_doc(row, now)}, upsert=True)
+        async for row in db.grn.aggregate(pipeline, allowDiskUse=True)
+    ]
+    for offset in range(0, len(operations), 1000):
+        await db.supplier_scores.bulk_write(operations[offset:offset + 1000], ordered=False)
+    return len(operations)
+
+class SupplierScoreRefresher:
+    """Recomputes one supplier's month shortly after a GRN or QC posts, coalescing bursts."""
+
+    def __init__(self, delay_seconds: float):
+        self.delay_seconds = delay_seconds
+        self.pending = set()
+
+    def schedule(self, supplier_id: str, period: str):
+        key = (supplier_id, period)
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        spawn(self._refresh(key))
+
+    def schedule_grn(self, grn: Dict):
+        spawn(self._resolve_grn(grn))
+
+    def schedule_qc(self, qc: Dict):
+        spawn(self._resolve_qc(qc))
+
+    async def _resolve_grn(self, grn: Dict):
+        # A receipt also changes the fill rate of the month its PO was raised in
+        self.schedule(grn['supplier_id'], grn['received_at'][:7])
+        po = await find_in_archives("purchase_orders", grn['po_id'], {"_id": 0, "created_at": 1})
+        if po:
+            self.schedule(grn['supplier_id'], po['created_at'][:7])
+
+    async def _resolve_qc(self, qc: Dict):
+        # The GRN may already be archived when a late QC comes in
+        grn = await find_in_archives("grn", qc['grn_id'], {"_id": 0, "supplier_id": 1})
+        if grn:
+            self.schedule(grn['supplier_id'], qc['inspected_at'][:7])
+
+    async def _refresh(self, key: Tuple[str, str]):
+        await asyncio.sleep(self.delay_seconds)
+        self.pending.discard(key)
+        supplier_id, period = key
+        try:
+            await refresh_supplier_scores(*month_bounds(period), supplier_id=supplier_id)
+        except Exception:
+            logger.exception("Supplier score refresh failed for %s %s", supplier_id, period)
+
+supplier_score_refresher = SupplierScoreRefresher(SUPPLIER_SCORE_REFRESH_DELAY)
+
+@api_router.get("/purchase/supplier-scores", response_model=List[SupplierScore])
+async def get_supplier_scores(supplier_id: Optional[str] = None, period_from: Optional[str] = None, period_to: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    # Served from the materialized collection by the (supplier_id, period) and (period, score) indexes
+    query: Dict[str, Any] = {}
+    if supplier_id:
+        query['supplier_id'] = supplier_id
+    if period_from or period_to:
+        query['period'] = {}
+        if period_from:
+            query['period']['$gte'] = period_from
+        if period_to:
+            query['period']['$lte'] = period_to
+    projection = field_projection(fields)
+    scores = await db.supplier_scores.find(query, projection or {"_id": 0}).sort([("period", -1), ("score", -1)]).to_list(1000)
+    if projection:
+        return sparse_response(scores)
+    for score in scores:
+        if isinstance(score['computed_at'], str):
+            score['computed_at'] = datetime.fromisoformat(score['computed_at'])
+    return scores
+
+@api_router.post("/purchase/supplier-scores/refresh")
+async def rebuild_supplier_scores(period_from: str, period_to: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    """Full recompute over a range of months, e.g. after backdated corrections."""
+    if current_user.get('role') not in (UserRole.ADMIN, UserRole.PURCHASE):
+        raise HTTPException(status_code=403, detail="Only admin or purchase users can rebuild scorecards")
+    if not re.fullmatch(r"\d{4}-\d{2}", period_from) or (period_to and not re.fullmatch(r"\d{4}-\d{2}", period_to)):
+        raise HTTPException(status_code=400, detail="Periods must be YYYY-MM")
+    start = month_bounds(period_from)[0]
+    end = month_bounds(period_to)[1] if period_to else datetime.now(timezone.utc).isoformat()
+    refreshed = await refresh_supplier_scores(start, end)
+    return {"message": "Supplier scores refreshed", "refreshed": refreshed}
+
 # ============ Stock Inward Routes ============
 @api_router.post("/inventory/stock-inward", response_model=StockInward)
 async def create_stock_inward(inward: StockInward, current_user: Dict = Depends(get_current_user)):
     if not inward.inward_no:
         inward.inward_no = await get_next_number("INWARD")
+    inward.qty, inward.uom = await to_base_uom(inward.item_id, inward.qty, inward.uom)
     doc = inward.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.stock_inward.insert_one(doc)
-    
-    # Update stock balance
-    stock = await db.stock_balance.find_one({"item_id": inward.item_id, "warehouse_id": inward.warehouse_id})
-    if stock:
-        new_qty = stock['qty'] + inward.qty
-        await db.stock_balance.update_one(
-            {"item_id": inward.item_id, "warehouse_id": inward.warehouse_id},
-            {"$set": {"qty": new_qty, "last_updated": datetime.now(timezone.utc).isoformat()}}
-        )
-    else:
-        warehouse = await db.warehouses.find_one({"id": inward.warehouse_id})
-        stock_doc = {
-            "id": str(uuid.uuid4()),
-            "item_id": inward.item_id,
-            "item_name": inward.item_name,
-            "warehouse_id": inward.warehouse_id,
-            "warehouse_name": warehouse['warehouse_name'] if warehouse else "",
-            "qty": inward.qty,
-            "uom": inward.uom,
-            "last_updated": datetime.now(timezone.utc).isoformat()
-        }
-        await db.stock_balance.insert_one(stock_doc)
-    
+    if doc.get('expiry_date'):
+        doc['expiry_date'] = doc['expiry_date'].isoformat()
+    if not inward.batch_no and not inward.bin_location_id:
+        # A plain receipt can't be refused, so the document and its balance need no transaction
+        await db.stock_inward.insert_one(doc)
+        await post_stock_movement(inward.item_id, inward.item_name, inward.warehouse_id, inward.qty, inward.uom)
+        audit_trail.record("stock_inward", inward.id, "create", current_user, after=doc)
+        return inward
+
+    # BIN and lot postings can be refused, and the inward must not outlive them
+    async def post_inward(session):
+        await db.stock_inward.insert_one(doc, session=session)
+        await post_stock_movement(inward.item_id, inward.item_name, inward.warehouse_id, inward.qty, inward.uom, inward.bin_location_id, session=session)
+        if inward.batch_no:
+            await post_lot_receipt(inward.item_id, inward.item_name, inward.warehouse_id, inward.batch_no, inward.qty, inward.uom, inward.expiry_date, session=session)
+
+    await run_in_transaction(post_inward)
+    audit_trail.record("stock_inward", inward.id, "create", current_user, after=doc)
     return inward
 
 @api_router.get("/inventory/stock-inward", response_model=List[StockInward])
-async def get_stock_inwards(current_user: Dict = Depends(get_current_user)):
-    inwards = await db.stock_inward.find({}, {"_id": 0}).to_list(1000)
+async def get_stock_inwards(start_date: Optional[str] = None, end_date: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    inwards = await find_documents("stock_inward", {}, start_date, end_date, projection=projection)
+    if projection:
+        return sparse_response(inwards)
     for inward in inwards:
         if isinstance(inward['created_at'], str):
             inward['created_at'] = datetime.fromisoformat(inward['created_at'])
+        if inward.get('expiry_date') and isinstance(inward['expiry_date'], str):
+            inward['expiry_date'] = datetime.fromisoformat(inward['expiry_date'])
     return inwards
 
 # ============ Stock Transfer Routes ============
@@ -800,16 +3032,24 @@ async def get_stock_inwards(current_user: Dict = Depends(get_current_user)):
 async def create_stock_transfer(transfer: StockTransfer, current_user: Dict = Depends(get_current_user)):
     if not transfer.transfer_no:
         transfer.transfer_no = await get_next_number("TRANSFER")
+    transfer.qty, transfer.uom = await to_base_uom(transfer.item_id, transfer.qty, transfer.uom)
     doc = transfer.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     if doc.get('approved_at'):
         doc['approved_at'] = doc['approved_at'].isoformat()
+    if transfer.status == ApprovalStatus.PENDING:
+        doc.update(approval_engine.start_fields("stock_transfer", doc))
+        transfer.current_approver_role = doc['current_approver_role']
     await db.stock_transfer.insert_one(doc)
+    audit_trail.record("stock_transfer", transfer.id, "create", current_user, after=doc)
     return transfer
 
 @api_router.get("/inventory/stock-transfer", response_model=List[StockTransfer])
-async def get_stock_transfers(current_user: Dict = Depends(get_current_user)):
-    transfers = await db.stock_transfer.find({}, {"_id": 0}).to_list(1000)
+async def get_stock_transfers(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    transfers = await db.stock_transfer.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(transfers)
     for transfer in transfers:
         if isinstance(transfer['created_at'], str):
             transfer['created_at'] = datetime.fromisoformat(transfer['created_at'])
@@ -817,33 +3057,236 @@ async def get_stock_transfers(current_user: Dict = Depends(get_current_user)):
             transfer['approved_at'] = datetime.fromisoformat(transfer['approved_at'])
     return transfers
 
+# ============ Stock Reservations ============
+RESERVATION_SWEEP_SECONDS = float(os.environ.get('RESERVATION_SWEEP_SECONDS', '60'))
+RESERVATION_SWEEP_BATCH = 1000
+# Settled reservations are kept this long past their expiry, then dropped by the TTL index
+RESERVATION_RETENTION_DAYS = int(os.environ.get('RESERVATION_RETENTION_DAYS', '7'))
+
+def available_at_least(qty: float) -> Dict:
+    """stock_balance filter matching balances with at least ``qty`` not held by reservations."""
+    return {"$expr": {"$gte": [
+        {"$subtract": ["$qty", {"$ifNull": ["$reserved_qty", 0]}]}, qty - QTY_EPSILON
+    ]}}
+
+async def release_reserved_qty(totals: Dict[Tuple[str, str], float], session=None):
+    """Give back reserved quantity per (item_id, warehouse_id) with one bulk write."""
+    if not totals:
+        return
+    first_seq = await next_sync_seq(len(totals))
+    now = datetime.now(timezone.utc).isoformat()
+    await db.stock_balance.bulk_write([
+        UpdateOne(
+            {"item_id": item_id, "warehouse_id": warehouse_id},
+            {"$inc": {"reserved_qty": -qty}, "$set": {"last_updated": now, "updated_seq": first_seq + i}}
+        )
+        for i, ((item_id, warehouse_id), qty) in enumerate(totals.items())
+    ], ordered=False, session=session)
+
+async def settle_reservation(reservation_id: str, status: ReservationStatus, session, match: Optional[Dict] = None) -> Dict:
+    """Close an active reservation and return its quantity to the available balance."""
+    reservation = await db.reservations.find_one_and_update(
+        {"id": reservation_id, "status": ReservationStatus.ACTIVE, **(match or {})},
+        {"$set": {"status": status, "released_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if not reservation:
+        raise HTTPException(status_code=400, detail="Reservation is not active")
+    await release_reserved_qty({(reservation['item_id'], reservation['warehouse_id']): reservation['qty']}, session)
+    return reservation
+
+async def release_expired_reservations() -> int:
+    """Expire overdue reservations in one batch and release their stock in bulk; returns how many."""
+    now = datetime.now(timezone.utc)
+    ids = [
+        doc['id'] async for doc in db.reservations.find(
+            {"status": ReservationStatus.ACTIVE, "expires_at": {"$lte": now}}, {"_id": 0, "id": 1}
+        ).limit(RESERVATION_SWEEP_BATCH)
+    ]
+    if not ids:
+        return 0
+    sweep_id = str(uuid.uuid4())
+
+    async def expire(session):
+        # The sweep id marks what this sweep claimed, should another worker's sweep overlap
+        await db.reservations.update_many(
+            {"id": {"$in": ids}, "status": ReservationStatus.ACTIVE},
+            {"$set": {"status": ReservationStatus.EXPIRED, "released_at": now.isoformat(), "sweep_id": sweep_id}},
+            session=session
+        )
+        totals: Dict[Tuple[str, str], float] = {}
+        count = 0
+        async for doc in db.reservations.find({"sweep_id": sweep_id}, {"_id": 0, "item_id": 1, "warehouse_id": 1, "qty": 1}, session=session):
+            key = (doc['item_id'], doc['warehouse_id'])
+            totals[key] = totals.get(key, 0.0) + doc['qty']
+            count += 1
+        await release_reserved_qty(totals, session)
+        return count
+
+    return await run_in_transaction(expire)
+
+class ReservationSweeper:
+    """Background task releasing expired reservations every RESERVATION_SWEEP_SECONDS."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        while True:
+            try:
+                # Keep going while full batches come back so a backlog clears in one pass
+                while await release_expired_reservations() >= RESERVATION_SWEEP_BATCH:
+                    pass
+            except Exception:
+                logger.exception("Reservation sweep failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+reservation_sweeper = ReservationSweeper(RESERVATION_SWEEP_SECONDS)
+
+def parse_reservation(doc: Dict) -> Dict:
+    for field in ('created_at', 'released_at'):
+        if doc.get(field) and isinstance(doc[field], str):
+            doc[field] = datetime.fromisoformat(doc[field])
+    # Motor hands back naive UTC datetimes
+    if doc['expires_at'].tzinfo is None:
+        doc['expires_at'] = doc['expires_at'].replace(tzinfo=timezone.utc)
+    return doc
+
+@api_router.post("/inventory/reservations", response_model=StockReservation)
+async def create_reservation(request: StockReservationRequest, current_user: Dict = Depends(get_current_user)):
+    qty, uom = await to_base_uom(request.item_id, request.qty, request.uom)
+    item = await db.items.find_one({"id": request.item_id}, {"_id": 0, "item_name": 1})
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    now = datetime.now(timezone.utc)
+    reservation = StockReservation(
+        **request.model_dump(exclude={"qty", "uom", "ttl_minutes"}),
+        item_name=item['item_name'], qty=qty, uom=uom, reserved_by=current_user['user_id'],
+        created_at=now, expires_at=now + timedelta(minutes=request.ttl_minutes),
+    )
+    doc = reservation.model_dump()
+    doc['created_at'] = doc['created_at'].isoformat()
+    # expires_at stays a BSON date: the TTL index and the sweeper both range over it
+    seq = await next_sync_seq()
+
+    async def reserve(session):
+        result = await db.stock_balance.update_one(
+            {"item_id": request.item_id, "warehouse_id": request.warehouse_id, **available_at_least(qty)},
+            {"$inc": {"reserved_qty": qty}, "$set": {"last_updated": doc['created_at'], "updated_seq": seq}},
+            session=session
+        )
+        if not result.matched_count:
+            raise InsufficientStock()
+        await db.reservations.insert_one(doc, session=session)
+
+    try:
+        await run_in_transaction(reserve)
+    except InsufficientStock:
+        raise HTTPException(status_code=400, detail="Insufficient available stock")
+    audit_trail.record("reservation", reservation.id, "create", current_user, after=doc)
+    return reservation
+
+@api_router.get("/inventory/reservations", response_model=List[StockReservation])
+async def get_reservations(item_id: Optional[str] = None, warehouse_id: Optional[str] = None, source_id: Optional[str] = None,
+                           status: Optional[ReservationStatus] = None, current_user: Dict = Depends(get_current_user)):
+    query: Dict[str, Any] = {}
+    if item_id:
+        query['item_id'] = item_id
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    if source_id:
+        query['source_id'] = source_id
+    if status:
+        query['status'] = status
+    reservations = await db.reservations.find(query, {"_id": 0, "sweep_id": 0}).sort("created_at", -1).to_list(1000)
+    return [parse_reservation(doc) for doc in reservations]
+
+@api_router.delete("/inventory/reservations/{reservation_id}", response_model=StockReservation)
+async def release_reservation(reservation_id: str, current_user: Dict = Depends(get_current_user)):
+    reservation = await run_in_transaction(
+        lambda session: settle_reservation(reservation_id, ReservationStatus.RELEASED, session)
+    )
+    audit_trail.record("reservation", reservation_id, "update", current_user,
+                       before={"status": ReservationStatus.ACTIVE}, after={"status": reservation['status']})
+    return parse_reservation(reservation)
+
+@api_router.get("/inventory/available", response_model=AvailableStock)
+async def get_available_stock(item_id: str, warehouse_id: str, current_user: Dict = Depends(get_current_user)):
+    """Available to promise, read straight off the (item_id, warehouse_id) balance."""
+    balance = await db.stock_balance.find_one(
+        {"item_id": item_id, "warehouse_id": warehouse_id}, {"_id": 0, "qty": 1, "reserved_qty": 1}
+    ) or {}
+    qty = balance.get('qty', 0.0)
+    reserved = balance.get('reserved_qty', 0.0)
+    return AvailableStock(item_id=item_id, warehouse_id=warehouse_id, qty=qty, reserved_qty=reserved, available_qty=qty - reserved)
+
 # ============ Issue to Department Routes ============
+async def post_plain_issue(issue: IssueToDepartment):
+    """Issue untracked stock without a transaction: the conditional decrement first, the document after."""
+    await post_stock_movement(issue.item_id, issue.item_name, issue.warehouse_id, -issue.qty, issue.uom, unreserved_only=True)
+    doc = issue.model_dump()
+    doc['issued_at'] = doc['issued_at'].isoformat()
+    try:
+        await db.issues.insert_one(doc)
+    except Exception:
+        # Put the stock back so a failed insert doesn't leave an unrecorded removal
+        await post_stock_movement(issue.item_id, issue.item_name, issue.warehouse_id, issue.qty, issue.uom)
+        raise
+
 @api_router.post("/inventory/issue", response_model=IssueToDepartment)
 async def create_issue(issue: IssueToDepartment, current_user: Dict = Depends(get_current_user)):
     if not issue.issue_no:
         issue.issue_no = await get_next_number("ISSUE")
-    
-    # Check stock availability
-    stock = await db.stock_balance.find_one({"item_id": issue.item_id, "warehouse_id": issue.warehouse_id})
-    if not stock or stock['qty'] < issue.qty:
-        raise HTTPException(status_code=400, detail="Insufficient stock")
-    
-    doc = issue.model_dump()
-    doc['issued_at'] = doc['issued_at'].isoformat()
-    await db.issues.insert_one(doc)
-    
-    # Update stock balance
-    new_qty = stock['qty'] - issue.qty
-    await db.stock_balance.update_one(
-        {"item_id": issue.item_id, "warehouse_id": issue.warehouse_id},
-        {"$set": {"qty": new_qty, "last_updated": datetime.now(timezone.utc).isoformat()}}
+    issue.qty, issue.uom = await to_base_uom(issue.item_id, issue.qty, issue.uom)
+
+    async def post_issue(session):
+        if issue.reservation_id:
+            await settle_reservation(issue.reservation_id, ReservationStatus.CONSUMED, session,
+                                     {"item_id": issue.item_id, "warehouse_id": issue.warehouse_id})
+        # Stock promised to other reservations can't be issued
+        await post_stock_movement(issue.item_id, issue.item_name, issue.warehouse_id, -issue.qty, issue.uom, issue.bin_location_id, session=session, unreserved_only=True)
+        issue.lot_allocations = await allocate_lots_fefo(issue.item_id, issue.warehouse_id, issue.qty, issue.batch_no, session=session)
+        doc = issue.model_dump()
+        doc['issued_at'] = doc['issued_at'].isoformat()
+        await db.issues.insert_one(doc, session=session)
+
+    # Only lots, BINs and reservations need a multi-document transaction, which in turn needs a replica set
+    lot_tracked = issue.batch_no or await db.lot_balance.find_one(
+        {"item_id": issue.item_id, "warehouse_id": issue.warehouse_id, "qty": {"$gt": QTY_EPSILON}}, {"_id": 1}
     )
-    
+    try:
+        if lot_tracked or issue.bin_location_id or issue.reservation_id:
+            await run_in_transaction(post_issue)
+        else:
+            await post_plain_issue(issue)
+    except InsufficientStock:
+        raise HTTPException(status_code=400, detail="Insufficient stock")
+    audit_trail.record("issue", issue.id, "create", current_user, after=issue.model_dump(mode="json"))
     return issue
 
 @api_router.get("/inventory/issue", response_model=List[IssueToDepartment])
-async def get_issues(current_user: Dict = Depends(get_current_user)):
-    issues = await db.issues.find({}, {"_id": 0}).to_list(1000)
+async def get_issues(start_date: Optional[str] = None, end_date: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    issues = await find_documents("issues", {}, start_date, end_date, projection=projection)
+    if projection:
+        return sparse_response(issues)
     for issue in issues:
         if isinstance(issue['issued_at'], str):
             issue['issued_at'] = datetime.fromisoformat(issue['issued_at'])
@@ -854,25 +3297,31 @@ async def get_issues(current_user: Dict = Depends(get_current_user)):
 async def create_return(ret: ReturnFromDepartment, current_user: Dict = Depends(get_current_user)):
     if not ret.return_no:
         ret.return_no = await get_next_number("RETURN")
+    ret.qty_returned, ret.uom = await to_base_uom(ret.item_id, ret.qty_returned, ret.uom)
     doc = ret.model_dump()
     doc['returned_at'] = doc['returned_at'].isoformat()
-    await db.returns.insert_one(doc)
-    
-    # Update stock balance if condition is good
-    if ret.condition == "Good":
-        stock = await db.stock_balance.find_one({"item_id": ret.item_id, "warehouse_id": ret.warehouse_id})
-        if stock:
-            new_qty = stock['qty'] + ret.qty_returned
-            await db.stock_balance.update_one(
-                {"item_id": ret.item_id, "warehouse_id": ret.warehouse_id},
-                {"$set": {"qty": new_qty, "last_updated": datetime.now(timezone.utc).isoformat()}}
-            )
-    
+    # Only goods in good condition go back into stock
+    if ret.condition == "Good" and ret.bin_location_id:
+        # The BIN posting can be refused, and the return must not outlive it
+        async def post_return(session):
+            await db.returns.insert_one(doc, session=session)
+            await post_stock_movement(ret.item_id, ret.item_name, ret.warehouse_id, ret.qty_returned, ret.uom, ret.bin_location_id, session=session)
+
+        await run_in_transaction(post_return)
+    else:
+        await db.returns.insert_one(doc)
+        if ret.condition == "Good":
+            await post_stock_movement(ret.item_id, ret.item_name, ret.warehouse_id, ret.qty_returned, ret.uom)
+
+    audit_trail.record("return", ret.id, "create", current_user, after=doc)
     return ret
 
 @api_router.get("/inventory/return", response_model=List[ReturnFromDepartment])
-async def get_returns(current_user: Dict = Depends(get_current_user)):
-    returns = await db.returns.find({}, {"_id": 0}).to_list(1000)
+async def get_returns(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    returns = await db.returns.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(returns)
     for ret in returns:
         if isinstance(ret['returned_at'], str):
             ret['returned_at'] = datetime.fromisoformat(ret['returned_at'])
@@ -883,16 +3332,49 @@ async def get_returns(current_user: Dict = Depends(get_current_user)):
 async def create_adjustment(adjustment: StockAdjustment, current_user: Dict = Depends(get_current_user)):
     if not adjustment.adjustment_no:
         adjustment.adjustment_no = await get_next_number("ADJUSTMENT")
+    adjustment.adjustment_qty, adjustment.uom = await to_base_uom(adjustment.item_id, adjustment.adjustment_qty, adjustment.uom)
     doc = adjustment.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     if doc.get('approved_at'):
         doc['approved_at'] = doc['approved_at'].isoformat()
-    await db.adjustments.insert_one(doc)
+    if adjustment.status == ApprovalStatus.PENDING:
+        doc.update(approval_engine.start_fields("stock_adjustment", doc))
+        adjustment.current_approver_role = doc['current_approver_role']
+    if adjustment.status != ApprovalStatus.APPROVED:
+        await db.adjustments.insert_one(doc)
+    else:
+        # Created already approved: the stock moves with the insert
+        doc['stock_posted_at'] = datetime.now(timezone.utc).isoformat()
+
+        async def post_adjustment(session):
+            await post_stock_movement(adjustment.item_id, adjustment.item_name, adjustment.warehouse_id, adjustment.adjustment_qty,
+                                      adjustment.uom, adjustment.bin_location_id, session=session, unreserved_only=True)
+            await db.adjustments.insert_one(doc, session=session)
+
+        try:
+            if adjustment.bin_location_id:
+                await run_in_transaction(post_adjustment)
+            else:
+                await post_stock_movement(adjustment.item_id, adjustment.item_name, adjustment.warehouse_id,
+                                          adjustment.adjustment_qty, adjustment.uom, unreserved_only=True)
+                try:
+                    await db.adjustments.insert_one(doc)
+                except Exception:
+                    await post_stock_movement(adjustment.item_id, adjustment.item_name, adjustment.warehouse_id,
+                                              -adjustment.adjustment_qty, adjustment.uom)
+                    raise
+        except InsufficientStock:
+            raise HTTPException(status_code=400, detail="Insufficient unreserved stock to post the adjustment")
+        stock_rollup_cache.invalidate()
+    audit_trail.record("stock_adjustment", adjustment.id, "create", current_user, after=doc)
     return adjustment
 
 @api_router.get("/inventory/adjustment", response_model=List[StockAdjustment])
-async def get_adjustments(current_user: Dict = Depends(get_current_user)):
-    adjustments = await db.adjustments.find({}, {"_id": 0}).to_list(1000)
+async def get_adjustments(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    adjustments = await db.adjustments.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(adjustments)
     for adj in adjustments:
         if isinstance(adj['created_at'], str):
             adj['created_at'] = datetime.fromisoformat(adj['created_at'])
@@ -900,10 +3382,656 @@ async def get_adjustments(current_user: Dict = Depends(get_current_user)):
             adj['approved_at'] = datetime.fromisoformat(adj['approved_at'])
     return adjustments
 
+# ============ Cycle Count Routes ============
+# Days between counts per ABC class; unclassified items are counted on the C cadence
+CYCLE_COUNT_INTERVAL_DAYS = {"A": 30, "B": 90, "C": 180}
+CYCLE_COUNT_DEFAULT_INTERVAL = 180
+CYCLE_COUNT_CLASS_ORDER = {"A": 0, "B": 1, "C": 2}
+
+def cycle_count_due(abc_class: Optional[str], last_counted_at: Optional[str], now: datetime) -> bool:
+    if not last_counted_at:
+        return True
+    interval = CYCLE_COUNT_INTERVAL_DAYS.get(abc_class, CYCLE_COUNT_DEFAULT_INTERVAL)
+    return datetime.fromisoformat(last_counted_at) <= now - timedelta(days=interval)
+
+def parse_cycle_count(sheet: Dict) -> Dict:
+    for field in ('created_at', 'counted_at'):
+        if sheet.get(field) and isinstance(sheet[field], str):
+            sheet[field] = datetime.fromisoformat(sheet[field])
+    return sheet
+
+@api_router.post("/inventory/cycle-counts/generate", response_model=List[CycleCountSheet])
+async def generate_cycle_counts(request: CycleCountGenerateRequest, current_user: Dict = Depends(get_current_user)):
+    """Build count sheets for the warehouse's most overdue balances, one sheet per BIN when ``by_bin``."""
+    if not await db.warehouses.find_one({"id": request.warehouse_id}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="Warehouse not found")
+    source = db.bin_stock_balance if request.by_bin else db.stock_balance
+    # Balances on a sheet that hasn't been counted yet stay off new sheets. A warehouse-level
+    # line covers the item in every BIN; a BIN line only covers that BIN
+    pending = {
+        (line['item_id'], line.get('bin_location_id'))
+        async for sheet in db.cycle_counts.find(
+            {"warehouse_id": request.warehouse_id, "status": "Open"}, {"_id": 0, "lines.item_id": 1, "lines.bin_location_id": 1}
+        )
+        for line in sheet['lines']
+    }
+    rows = await source.find(
+        {"warehouse_id": request.warehouse_id},
+        {"_id": 0, "item_id": 1, "item_name": 1, "uom": 1, "bin_location_id": 1, "bin_code": 1, "walk_key": 1, "last_counted_at": 1}
+    ).to_list(None)
+    if request.by_bin:
+        rows = [row for row in rows if (row['item_id'], None) not in pending and (row['item_id'], row.get('bin_location_id')) not in pending]
+    else:
+        pending_items = {item_id for item_id, _ in pending}
+        rows = [row for row in rows if row['item_id'] not in pending_items]
+    classes = {
+        item['id']: item.get('abc_class')
+        async for item in db.items.find({"id": {"$in": list({row['item_id'] for row in rows})}}, {"_id": 0, "id": 1, "abc_class": 1})
+    }
+    wanted = {c.upper() for c in request.abc_classes} if request.abc_classes else None
+    now = datetime.now(timezone.utc)
+    due = [
+        row for row in rows
+        if (wanted is None or classes.get(row['item_id']) in wanted)
+        and cycle_count_due(classes.get(row['item_id']), row.get('last_counted_at'), now)
+    ]
+    # Highest-value classes first, then the longest since their last count (never counted sorts first)
+    due.sort(key=lambda row: (CYCLE_COUNT_CLASS_ORDER.get(classes.get(row['item_id']), len(CYCLE_COUNT_CLASS_ORDER)), row.get('last_counted_at') or ""))
+    due = due[:request.max_lines]
+    if not due:
+        return []
+
+    groups: Dict[Optional[str], List[Dict]] = {}
+    for row in due:
+        groups.setdefault(row.get('bin_location_id') if request.by_bin else None, []).append(row)
+    numbers = await reserve_numbers("CYCLE_COUNT", len(groups))
+    sheets = []
+    for sheet_no, rows in zip(numbers, groups.values()):
+        # Lines in walk order so a counter covers the BIN in one pass
+        rows.sort(key=lambda row: (row.get('walk_key') or "", row['item_name']))
+        sheets.append(CycleCountSheet(
+            sheet_no=sheet_no,
+            warehouse_id=request.warehouse_id,
+            bin_location_id=rows[0].get('bin_location_id'),
+            bin_code=rows[0].get('bin_code'),
+            lines=[
+                CycleCountLine(
+                    item_id=row['item_id'], item_name=row['item_name'],
+                    bin_location_id=row.get('bin_location_id'), bin_code=row.get('bin_code'),
+                    uom=row['uom'], abc_class=classes.get(row['item_id']), last_counted_at=row.get('last_counted_at'),
+                )
+                for row in rows
+            ],
+            created_by=current_user['user_id'],
+        ))
+    docs = []
+    for sheet in sheets:
+        doc = sheet.model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        for line in doc['lines']:
+            if line['last_counted_at']:
+                line['last_counted_at'] = line['last_counted_at'].isoformat()
+        docs.append(doc)
+    await db.cycle_counts.insert_many(docs)
+    for doc in docs:
+        audit_trail.record("cycle_count", doc['id'], "create", current_user, after=doc)
+    return sheets
+
+@api_router.get("/inventory/cycle-counts", response_model=List[CycleCountSheet])
+async def get_cycle_counts(warehouse_id: Optional[str] = None, status: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    query = {}
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    if status:
+        query['status'] = status
+    sheets = await db.cycle_counts.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    return [parse_cycle_count(sheet) for sheet in sheets]
+
+@api_router.post("/inventory/cycle-counts/{sheet_id}/counts", response_model=CycleCountSheet)
+async def submit_cycle_count(sheet_id: str, upload: CycleCountUpload, current_user: Dict = Depends(get_current_user)):
+    """Post counted quantities for a sheet and raise one reconciliation adjustment per variance.
+
+    Lines left out of the upload stay uncounted and keep their last-count date.
+    """
+    sheet = await db.cycle_counts.find_one({"id": sheet_id}, {"_id": 0})
+    if not sheet:
+        raise HTTPException(status_code=404, detail="Cycle count not found")
+    if sheet['status'] != "Open":
+        raise HTTPException(status_code=400, detail="Cycle count has already been submitted")
+    counts = {}
+    for entry in upload.counts:
+        if entry.item_id in counts:
+            raise HTTPException(status_code=400, detail=f"Item {entry.item_id} is counted twice")
+        counts[entry.item_id] = entry.counted_qty
+    unknown = counts.keys() - {line['item_id'] for line in sheet['lines']}
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Items not on this sheet: {', '.join(sorted(unknown))}")
+
+    # One read of the current balances for every counted line
+    key = {"warehouse_id": sheet['warehouse_id'], "item_id": {"$in": list(counts)}}
+    source = db.stock_balance
+    if sheet.get('bin_location_id'):
+        key['bin_location_id'] = sheet['bin_location_id']
+        source = db.bin_stock_balance
+    system = {row['item_id']: row['qty'] async for row in source.find(key, {"_id": 0, "item_id": 1, "qty": 1})}
+
+    now = datetime.now(timezone.utc).isoformat()
+    variances = []
+    for line in sheet['lines']:
+        if line['item_id'] not in counts:
+            continue
+        line['counted_qty'] = counts[line['item_id']]
+        line['system_qty'] = system.get(line['item_id'], 0.0)
+        line['variance'] = line['counted_qty'] - line['system_qty']
+        line['last_counted_at'] = now
+        if abs(line['variance']) > QTY_EPSILON:
+            variances.append(line)
+
+    adjustment_docs = []
+    numbers = await reserve_numbers("ADJUSTMENT", len(variances)) if variances else []
+    for adjustment_no, line in zip(numbers, variances):
+        adjustment = StockAdjustment(
+            adjustment_no=adjustment_no,
+            item_id=line['item_id'],
+            item_name=line['item_name'],
+            warehouse_id=sheet['warehouse_id'],
+            bin_location_id=line.get('bin_location_id'),
+            adjustment_qty=line['variance'],
+            uom=line['uom'],
+            reason=StockAdjustmentReason.RECONCILIATION,
+            created_by=current_user['user_id'],
+            remarks=upload.remarks or f"Cycle count {sheet['sheet_no']}",
+            cycle_count_id=sheet_id,
+        )
+        doc = adjustment.model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        doc.update(approval_engine.start_fields("stock_adjustment", doc))
+        adjustment_docs.append(doc)
+
+    update = {
+        "status": "Counted",
+        "lines": sheet['lines'],
+        "adjustment_ids": [doc['id'] for doc in adjustment_docs],
+        "counted_by": current_user['user_id'],
+        "counted_at": now,
+    }
+    stamp = {"last_counted_at": now}
+    # stock_balance is synced to clients; bin_stock_balance isn't
+    if not sheet.get('bin_location_id'):
+        stamp['updated_seq'] = await next_sync_seq()
+
+    async def submit(session):
+        result = await db.cycle_counts.update_one({"id": sheet_id, "status": "Open"}, {"$set": update}, session=session)
+        if not result.matched_count:
+            raise HTTPException(status_code=409, detail="Cycle count was submitted concurrently")
+        if adjustment_docs:
+            await db.adjustments.insert_many(adjustment_docs, ordered=False, session=session)
+        await source.update_many(key, {"$set": stamp}, session=session)
+
+    await run_in_transaction(submit)
+    audit_trail.record("cycle_count", sheet_id, "update", current_user, before={"status": sheet['status']}, after={"status": "Counted"})
+    for doc in adjustment_docs:
+        audit_trail.record("stock_adjustment", doc['id'], "create", current_user, after=doc)
+    sheet.update(update)
+    return parse_cycle_count(sheet)
+
+# ============ Approval Workflow Engine ============
+# Document types that go through approval, mapped to their collections
+APPROVAL_COLLECTIONS = {
+    "purchase_order": "purchase_orders",
+    "stock_transfer": "stock_transfer",
+    "stock_adjustment": "adjustments",
+}
+# Field compared against approver amount thresholds for each document type
+APPROVAL_AMOUNT_FIELDS = {
+    "purchase_order": "total_amount",
+    "stock_transfer": "qty",
+    "stock_adjustment": "adjustment_qty",
+}
+APPROVABLE_STATUSES = [ApprovalStatus.PENDING, ApprovalStatus.DRAFT]
+
+class CompiledApprovalFlow:
+    """Approver levels of one ApprovalFlow, sorted and ready for chain evaluation.
+
+    Each approver entry is ``{"level": int, "role": str, "min_amount": float}``;
+    a level only applies to documents whose amount is at least ``min_amount``.
+    """
+
+    def __init__(self, flow: Dict):
+        self.flow_id = flow['id']
+        self.document_type = flow['document_type']
+        levels = sorted(flow.get('approvers', []), key=lambda a: a.get('level', 0))
+        self.levels = [(a['role'], float(a.get('min_amount') or 0.0)) for a in levels if a.get('role')]
+        self.roles = {role for role, _ in self.levels}
+
+    def chain_for(self, amount: float) -> List[str]:
+        return [role for role, min_amount in self.levels if amount >= min_amount]
+
+class ApprovalEngine:
+    """In-memory state machine per document type, loaded from approval_flows.
+
+    The approver chain is resolved once when a document enters approval and
+    stored on it, so each approve/reject transition is a constant-time step.
+    """
+
+    def __init__(self):
+        self.flows: Dict[str, CompiledApprovalFlow] = {}
+
+    async def load(self):
+        flows = await db.approval_flows.find({"status": "Active"}, {"_id": 0}).to_list(None)
+        self.flows = {flow['document_type']: CompiledApprovalFlow(flow) for flow in flows}
+
+    def chain_for(self, document_type: str, doc: Dict) -> List[str]:
+        flow = self.flows.get(document_type)
+        if not flow:
+            return []
+        amount = abs(float(doc.get(APPROVAL_AMOUNT_FIELDS[document_type]) or 0.0))
+        return flow.chain_for(amount)
+
+    def start_fields(self, document_type: str, doc: Dict) -> Dict:
+        """Workflow fields to store on a document entering Pending."""
+        chain = self.chain_for(document_type, doc)
+        return {
+            "approval_chain": chain,
+            "approval_level": 0,
+            "current_approver_role": chain[0] if chain else None,
+        }
+
+    def transition(self, document_type: str, doc: Dict, action: str, current_user: Dict) -> Optional[Dict]:
+        """Return the $set for approving/rejecting ``doc`` at its current level, or None if not permitted."""
+        chain = doc.get('approval_chain')
+        if chain is None:
+            # Documents created before the flow existed get their chain now
+            chain = self.chain_for(document_type, doc)
+        level = doc.get('approval_level') or 0
+        is_admin = current_user.get('role') == UserRole.ADMIN
+        if chain:
+            if level >= len(chain):
+                level = len(chain) - 1
+            if not is_admin and current_user.get('role') != chain[level]:
+                return None
+
+        now = datetime.now(timezone.utc).isoformat()
+        update = {
+            "approval_chain": chain,
+            "approval_updated_by": current_user['user_id'],
+            "approval_updated_at": now,
+        }
+        if action == BatchApprovalAction.REJECT:
+            update.update({
+                "status": ApprovalStatus.REJECTED,
+                "current_approver_role": None,
+                "approved_by": current_user['user_id'],
+                "approved_at": now,
+            })
+        elif level + 1 < len(chain):
+            update.update({
+                "status": ApprovalStatus.PENDING,
+                "approval_level": level + 1,
+                "current_approver_role": chain[level + 1],
+            })
+        else:
+            update.update({
+                "status": ApprovalStatus.APPROVED,
+                "approval_level": len(chain),
+                "current_approver_role": None,
+                "approved_by": current_user['user_id'],
+                "approved_at": now,
+            })
+        return update
+
+approval_engine = ApprovalEngine()
+
+async def post_approved_adjustment(guard: Dict, update: Dict, adjustment: Dict) -> str:
+    """Approve an adjustment and move its quantity into stock in one step; returns the outcome.
+
+    Removals only take unreserved stock. With a BIN the warehouse and bin balances move in
+    a transaction; without one the balance moves first and is put back if the approval loses.
+    """
+    update = {**update, "stock_posted_at": update['approval_updated_at']}
+    movement = (adjustment['item_id'], adjustment['item_name'], adjustment['warehouse_id'])
+    qty, uom, bin_location_id = adjustment['adjustment_qty'], adjustment['uom'], adjustment.get('bin_location_id')
+
+    async def post(session):
+        result = await db.adjustments.update_one(guard, {"$set": update}, session=session)
+        if not result.matched_count:
+            return "conflict"
+        await post_stock_movement(*movement, qty, uom, bin_location_id, session=session, unreserved_only=True)
+        return "updated"
+
+    try:
+        if bin_location_id:
+            return await run_in_transaction(post)
+        await post_stock_movement(*movement, qty, uom, unreserved_only=True)
+    except InsufficientStock:
+        return "insufficient_stock"
+    try:
+        result = await db.adjustments.update_one(guard, {"$set": update})
+    except Exception:
+        await post_stock_movement(*movement, -qty, uom)
+        raise
+    if not result.matched_count:
+        await post_stock_movement(*movement, -qty, uom)
+        return "conflict"
+    stock_rollup_cache.invalidate()
+    return "updated"
+
+async def apply_approvals(document_type: str, ids: List[str], action: str, remarks: Optional[str], current_user: Dict) -> List[BatchApprovalOutcome]:
+    """Advance each document one workflow step with a single bulk_write and record history."""
+    collection = db[APPROVAL_COLLECTIONS[document_type]]
+    ids = list(dict.fromkeys(ids))
+    projection = {"_id": 0, "id": 1, "status": 1, "approval_chain": 1, "approval_level": 1,
+                  APPROVAL_AMOUNT_FIELDS[document_type]: 1}
+    if document_type == "stock_adjustment":
+        projection.update({"item_id": 1, "item_name": 1, "warehouse_id": 1, "uom": 1, "bin_location_id": 1})
+    current = {doc['id']: doc async for doc in collection.find({"id": {"$in": ids}}, projection)}
+
+    outcomes: Dict[str, BatchApprovalOutcome] = {}
+    operations = []
+    # Final approvals of adjustments, which also post stock, as (id, guard, update)
+    postings = []
+    history = []
+    pending_updates: Dict[str, Dict] = {}
+    first_seq = await next_sync_seq(len(ids))
+    for i, doc_id in enumerate(ids):
+        doc = current.get(doc_id)
+        if not doc:
+            outcomes[doc_id] = BatchApprovalOutcome(document_type=document_type, id=doc_id, outcome="not_found")
+            continue
+        if doc['status'] not in APPROVABLE_STATUSES:
+            outcomes[doc_id] = BatchApprovalOutcome(document_type=document_type, id=doc_id, outcome="invalid_status", status=doc['status'])
+            continue
+        update = approval_engine.transition(document_type, doc, action, current_user)
+        if update is None:
+            outcomes[doc_id] = BatchApprovalOutcome(document_type=document_type, id=doc_id, outcome="not_authorized", status=doc['status'])
+            continue
+        update['remarks'] = remarks
+        update['updated_seq'] = first_seq + i
+        # Guard on the state we read so a concurrent approver can't double-step a document
+        guard = {"id": doc_id, "status": doc['status'], "approval_level": doc.get('approval_level')}
+        if document_type == "stock_adjustment" and update['status'] == ApprovalStatus.APPROVED:
+            postings.append((doc_id, guard, update))
+        else:
+            operations.append(UpdateOne(guard, {"$set": update}))
+        pending_updates[doc_id] = update
+        history.append({
+            "id": str(uuid.uuid4()),
+            "document_type": document_type,
+            "document_id": doc_id,
+            "level": doc.get('approval_level') or 0,
+            "role": current_user.get('role'),
+            "action": action,
+            "from_status": doc['status'],
+            "to_status": update['status'],
+            "user_id": current_user['user_id'],
+            "remarks": remarks,
+            "at": update['approval_updated_at'],
+        })
+
+    if operations or postings:
+        posting_ids = {doc_id for doc_id, _, _ in postings}
+        applied = {doc_id for doc_id in pending_updates if doc_id not in posting_ids}
+        if operations:
+            result = await collection.bulk_write(operations, ordered=False)
+            if result.modified_count != len(operations):
+                applied = {
+                    doc['id'] async for doc in collection.find(
+                        {"id": {"$in": list(applied)}, "approval_updated_by": current_user['user_id'],
+                         "approval_updated_at": {"$in": list({u['approval_updated_at'] for u in pending_updates.values()})}},
+                        {"_id": 0, "id": 1}
+                    )
+                }
+        for doc_id, guard, update in postings:
+            outcome = await post_approved_adjustment(guard, update, current[doc_id])
+            if outcome == "updated":
+                applied.add(doc_id)
+            else:
+                outcomes[doc_id] = BatchApprovalOutcome(document_type=document_type, id=doc_id, outcome=outcome, status=current[doc_id]['status'])
+        history = [entry for entry in history if entry['document_id'] in applied]
+        if history:
+            await db.approval_history.insert_many(history)
+        for doc_id, update in pending_updates.items():
+            if doc_id in applied:
+                outcomes[doc_id] = BatchApprovalOutcome(document_type=document_type, id=doc_id, outcome="updated", status=update['status'])
+                audit_trail.record(document_type, doc_id, action, current_user,
+                                   before={key: current[doc_id].get(key) for key in update}, after=update)
+            elif doc_id not in outcomes:
+                outcomes[doc_id] = BatchApprovalOutcome(document_type=document_type, id=doc_id, outcome="conflict")
+    return [outcomes[doc_id] for doc_id in ids]
+
+async def approve_single(document_type: str, doc_id: str, action: str, remarks: Optional[str], current_user: Dict) -> BatchApprovalOutcome:
+    outcome = (await apply_approvals(document_type, [doc_id], action, remarks, current_user))[0]
+    if outcome.outcome == "not_found":
+        raise HTTPException(status_code=404, detail="Document not found")
+    if outcome.outcome == "not_authorized":
+        raise HTTPException(status_code=403, detail="Not an approver for the current level")
+    if outcome.outcome in ("invalid_status", "conflict"):
+        raise HTTPException(status_code=400, detail=f"Document is not awaiting approval (status: {outcome.status})")
+    if outcome.outcome == "insufficient_stock":
+        raise HTTPException(status_code=400, detail="Insufficient unreserved stock to post the adjustment")
+    return outcome
+
+# ============ Approval Flow Routes ============
+@api_router.post("/settings/approval-flows", response_model=ApprovalFlow)
+async def create_approval_flow(flow: ApprovalFlow, current_user: Dict = Depends(get_current_user)):
+    if flow.document_type not in APPROVAL_COLLECTIONS:
+        raise HTTPException(status_code=400, detail="Unknown document type")
+    doc = flow.model_dump()
+    await db.approval_flows.insert_one(doc)
+    await approval_engine.load()
+    audit_trail.record("approval_flow", flow.id, "create", current_user, after=doc)
+    return flow
+
+@api_router.get("/settings/approval-flows", response_model=List[ApprovalFlow])
+async def get_approval_flows(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    flows = await db.approval_flows.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(flows)
+    return flows
+
+@api_router.put("/settings/approval-flows/{flow_id}", response_model=ApprovalFlow)
+async def update_approval_flow(flow_id: str, flow: ApprovalFlow, current_user: Dict = Depends(get_current_user)):
+    if flow.document_type not in APPROVAL_COLLECTIONS:
+        raise HTTPException(status_code=400, detail="Unknown document type")
+    doc = flow.model_dump()
+    doc['id'] = flow_id
+    existing = await db.approval_flows.find_one_and_update({"id": flow_id}, {"$set": doc}, projection={"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Approval flow not found")
+    await approval_engine.load()
+    audit_trail.record("approval_flow", flow_id, "update", current_user, before=existing, after=doc)
+    return ApprovalFlow(**doc)
+
+@api_router.delete("/settings/approval-flows/{flow_id}")
+async def delete_approval_flow(flow_id: str, current_user: Dict = Depends(get_current_user)):
+    existing = await db.approval_flows.find_one_and_delete({"id": flow_id}, projection={"_id": 0})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Approval flow not found")
+    await approval_engine.load()
+    audit_trail.record("approval_flow", flow_id, "delete", current_user, before=existing)
+    return {"message": "Approval flow deleted successfully"}
+
+# ============ Approval Routes ============
+@api_router.post("/approvals/batch", response_model=List[BatchApprovalOutcome])
+async def batch_approve(request: BatchApprovalRequest, current_user: Dict = Depends(get_current_user)):
+    unknown = [doc_type for doc_type in request.documents if doc_type not in APPROVAL_COLLECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown document type(s): {', '.join(unknown)}")
+
+    outcomes: List[BatchApprovalOutcome] = []
+    for doc_type, ids in request.documents.items():
+        if ids:
+            outcomes.extend(await apply_approvals(doc_type, ids, request.action, request.remarks, current_user))
+    return outcomes
+
+@api_router.get("/approvals/pending")
+async def my_pending_approvals(current_user: Dict = Depends(get_current_user)):
+    role = current_user.get('role')
+    pending = {}
+    for doc_type, collection_name in APPROVAL_COLLECTIONS.items():
+        # Served by the (current_approver_role, status) index
+        docs = await db[collection_name].find(
+            {"current_approver_role": role, "status": ApprovalStatus.PENDING}, {"_id": 0}
+        ).to_list(1000)
+        pending[doc_type] = docs
+    return pending
+
+@api_router.get("/approvals/{document_type}/{doc_id}/history", response_model=List[ApprovalHistory])
+async def get_approval_history(document_type: str, doc_id: str, current_user: Dict = Depends(get_current_user)):
+    entries = await db.approval_history.find(
+        {"document_type": document_type, "document_id": doc_id}, {"_id": 0}
+    ).sort("at", ASCENDING).to_list(1000)
+    for entry in entries:
+        if isinstance(entry['at'], str):
+            entry['at'] = datetime.fromisoformat(entry['at'])
+    return entries
+
+@api_router.post("/approvals/{document_type}/{doc_id}/submit")
+async def submit_for_approval(document_type: str, doc_id: str, current_user: Dict = Depends(get_current_user)):
+    if document_type not in APPROVAL_COLLECTIONS:
+        raise HTTPException(status_code=404, detail="Unknown document type")
+    collection = db[APPROVAL_COLLECTIONS[document_type]]
+    doc = await collection.find_one({"id": doc_id}, {"_id": 0})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if doc['status'] != ApprovalStatus.DRAFT:
+        raise HTTPException(status_code=400, detail="Only draft documents can be submitted")
+    fields = approval_engine.start_fields(document_type, doc)
+    fields['status'] = ApprovalStatus.PENDING
+    fields['updated_seq'] = await next_sync_seq()
+    result = await collection.update_one({"id": doc_id, "status": ApprovalStatus.DRAFT}, {"$set": fields})
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Only draft documents can be submitted")
+    audit_trail.record(document_type, doc_id, "submit", current_user,
+                       before={key: doc.get(key) for key in fields}, after=fields)
+    await db.approval_history.insert_one({
+        "id": str(uuid.uuid4()),
+        "document_type": document_type,
+        "document_id": doc_id,
+        "level": 0,
+        "role": current_user.get('role'),
+        "action": "submit",
+        "from_status": ApprovalStatus.DRAFT,
+        "to_status": ApprovalStatus.PENDING,
+        "user_id": current_user['user_id'],
+        "remarks": None,
+        "at": datetime.now(timezone.utc).isoformat(),
+    })
+    return {"message": "Document submitted for approval", "current_approver_role": fields['current_approver_role']}
+
+@api_router.put("/approvals/{document_type}/{doc_id}/{action}", response_model=BatchApprovalOutcome)
+async def approve_document(document_type: str, doc_id: str, action: BatchApprovalAction, remarks: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    if document_type not in APPROVAL_COLLECTIONS:
+        raise HTTPException(status_code=404, detail="Unknown document type")
+    return await approve_single(document_type, doc_id, action, remarks, current_user)
+
+# ============ BIN Stock Routes ============
+@api_router.get("/inventory/bin-stock", response_model=List[BinStockBalance])
+async def get_bin_stock(item_id: Optional[str] = None, warehouse_id: Optional[str] = None, bin_location_id: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    query = {}
+    if item_id:
+        query['item_id'] = item_id
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    if bin_location_id:
+        query['bin_location_id'] = bin_location_id
+    projection = field_projection(fields)
+    stocks = await db.bin_stock_balance.find(query, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(stocks)
+    for stock in stocks:
+        if isinstance(stock['last_updated'], str):
+            stock['last_updated'] = datetime.fromisoformat(stock['last_updated'])
+    return stocks
+
+@api_router.get("/inventory/pick-suggestions", response_model=List[PickSuggestion])
+async def get_pick_suggestions(item_id: str, warehouse_id: str, qty: float, current_user: Dict = Depends(get_current_user)):
+    # Walks the (item_id, warehouse_id, walk_key) index and stops as soon as qty is covered
+    cursor = db.bin_stock_balance.find(
+        {"item_id": item_id, "warehouse_id": warehouse_id, "qty": {"$gt": QTY_EPSILON}},
+        {"_id": 0, "bin_location_id": 1, "bin_code": 1, "qty": 1}
+    ).sort("walk_key", ASCENDING)
+    suggestions = []
+    remaining = qty
+    async for stock in cursor:
+        pick_qty = min(stock['qty'], remaining)
+        suggestions.append(PickSuggestion(
+            bin_location_id=stock['bin_location_id'],
+            bin_code=stock['bin_code'],
+            available_qty=stock['qty'],
+            pick_qty=pick_qty,
+        ))
+        remaining -= pick_qty
+        if remaining <= QTY_EPSILON:
+            break
+    if remaining > QTY_EPSILON:
+        raise HTTPException(status_code=400, detail=f"Insufficient bin stock, short by {remaining}")
+    return suggestions
+
+@api_router.get("/inventory/putaway-suggestions", response_model=List[BINLocationMaster])
+async def get_putaway_suggestions(item_id: str, warehouse_id: str, limit: int = 10, current_user: Dict = Depends(get_current_user)):
+    limit = max(1, min(limit, 100))
+    # Consolidate into bins already holding the item, then fall back to the warehouse walk order
+    holding = await db.bin_stock_balance.find(
+        {"item_id": item_id, "warehouse_id": warehouse_id, "qty": {"$gt": QTY_EPSILON}},
+        {"_id": 0, "bin_location_id": 1}
+    ).sort("walk_key", ASCENDING).limit(limit).to_list(limit)
+    holding_ids = [stock['bin_location_id'] for stock in holding]
+    bins = await db.bin_locations.find({"id": {"$in": holding_ids}}, {"_id": 0}).to_list(limit)
+    bins.sort(key=lambda b: holding_ids.index(b['id']))
+    if len(bins) < limit:
+        bins += await db.bin_locations.find(
+            {"warehouse_id": warehouse_id, "status": "Active", "id": {"$nin": holding_ids}}, {"_id": 0}
+        ).sort("walk_key", ASCENDING).limit(limit - len(bins)).to_list(limit)
+    for bin_loc in bins:
+        if isinstance(bin_loc['created_at'], str):
+            bin_loc['created_at'] = datetime.fromisoformat(bin_loc['created_at'])
+    return bins
+
+# ============ Lot Routes ============
+def parse_lot_dates(lots: List[Dict]) -> List[Dict]:
+    for lot in lots:
+        for field in ('expiry_date', 'received_at', 'last_updated'):
+            if lot.get(field) and isinstance(lot[field], str):
+                lot[field] = datetime.fromisoformat(lot[field])
+    return lots
+
+@api_router.get("/inventory/lots", response_model=List[LotBalance])
+async def get_lots(item_id: Optional[str] = None, warehouse_id: Optional[str] = None, include_empty: bool = False, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    query: Dict[str, Any] = {}
+    if item_id:
+        query['item_id'] = item_id
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    if not include_empty:
+        query['qty'] = {"$gt": QTY_EPSILON}
+    projection = field_projection(fields)
+    lots = await db.lot_balance.find(query, projection or {"_id": 0}).sort("expiry_sort", ASCENDING).to_list(1000)
+    if projection:
+        return sparse_response(lots)
+    return parse_lot_dates(lots)
+
+@api_router.get("/inventory/lots/expiring", response_model=List[LotBalance])
+async def get_expiring_lots(days: int = 30, warehouse_id: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    cutoff = (datetime.now(timezone.utc) + timedelta(days=days)).date().isoformat()
+    # Range on the expiry_sort index; undated lots sort last and never match
+    query: Dict[str, Any] = {"expiry_sort": {"$lte": cutoff}, "qty": {"$gt": QTY_EPSILON}}
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    projection = field_projection(fields)
+    lots = await db.lot_balance.find(query, projection or {"_id": 0}).sort("expiry_sort", ASCENDING).to_list(1000)
+    if projection:
+        return sparse_response(lots)
+    return parse_lot_dates(lots)
+
 # ============ Stock Balance Routes ============
 @api_router.get("/inventory/stock-balance", response_model=List[StockBalance])
-async def get_stock_balance(current_user: Dict = Depends(get_current_user)):
-    stocks = await db.stock_balance.find({}, {"_id": 0}).to_list(1000)
+async def get_stock_balance(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    stocks = await db.stock_balance.find({}, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(stocks)
     for stock in stocks:
         if isinstance(stock['last_updated'], str):
             stock['last_updated'] = datetime.fromisoformat(stock['last_updated'])
@@ -911,14 +4039,19 @@ async def get_stock_balance(current_user: Dict = Depends(get_current_user)):
 
 # ============ Dashboard Stats ============
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: Dict = Depends(get_current_user)):
-    total_items = await db.items.count_documents({"status": "Active"})
+async def get_dashboard_stats(abc_class: Optional[str] = None, xyz_class: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    item_query = {"status": "Active"}
+    if abc_class:
+        item_query['abc_class'] = abc_class.upper()
+    if xyz_class:
+        item_query['xyz_class'] = xyz_class.upper()
+    total_items = await db.items.count_documents(item_query)
     total_suppliers = await db.suppliers.count_documents({"status": "Active"})
     pending_pos = await db.purchase_orders.count_documents({"status": ApprovalStatus.PENDING})
     pending_approvals = await db.purchase_orders.count_documents({"status": ApprovalStatus.PENDING})
     
     # Low stock items
-    items = await db.items.find({"status": "Active"}, {"_id": 0}).to_list(1000)
+    items = await db.items.find(item_query, {"_id": 0}).to_list(1000)
     low_stock_count = 0
     for item in items:
         stock = await db.stock_balance.find_one({"item_id": item['id']})
@@ -926,52 +4059,1272 @@ async def get_dashboard_stats(current_user: Dict = Depends(get_current_user)):
         if total_stock <= item['reorder_level']:
             low_stock_count += 1
     
+    item_classes = {
+        f"{row['_id']['abc'] or ''}{row['_id']['xyz'] or ''}" or "Unclassified": row['count']
+        async for row in db.items.aggregate([
+            {"$match": item_query},
+            {"$group": {"_id": {"abc": "$abc_class", "xyz": "$xyz_class"}, "count": {"$sum": 1}}},
+        ])
+    }
+    
     return {
         "total_items": total_items,
         "total_suppliers": total_suppliers,
         "low_stock_alerts": low_stock_count,
         "pending_pos": pending_pos,
-        "pending_approvals": pending_approvals
+        "pending_approvals": pending_approvals,
+        "item_classes": item_classes,
     }
 
+# ============ Stock Rollups ============
+class StockRollupCache:
+    """Subtree stock sums keyed by (warehouse node, category node, grouping).
+
+    Cleared on every stock movement; the TTL only bounds staleness from other workers.
+    """
+
+    def __init__(self, ttl_seconds: float = 60.0):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[tuple, tuple] = {}
+
+    def invalidate(self):
+        self._entries.clear()
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl_seconds:
+            return entry[1]
+        return None
+
+    def put(self, key: tuple, value):
+        self._entries[key] = (time.monotonic(), value)
+
+stock_rollup_cache = StockRollupCache()
+
+# Grouping keys accepted by the rollup report; quantities are only added within a UOM
+ROLLUP_GROUPS = {
+    "none": {"uom": "$uom"},
+    "item": {"item_id": "$item_id", "item_name": "$item_name", "uom": "$uom"},
+    "warehouse": {"warehouse_id": "$warehouse_id", "warehouse_name": "$warehouse_name", "uom": "$uom"},
+    "category": {"category_id": "$category_id", "uom": "$uom"},
+}
+
+@api_router.get("/reports/stock-rollup")
+async def stock_rollup_report(warehouse_node: Optional[str] = None, category_node: Optional[str] = None, group_by: str = "item", current_user: Dict = Depends(get_current_user)):
+    if group_by not in ROLLUP_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(ROLLUP_GROUPS)}")
+    key = (warehouse_node, category_node, group_by)
+    cached = stock_rollup_cache.get(key)
+    if cached is not None:
+        return cached
+
+    match: Dict[str, Any] = {}
+    if warehouse_node:
+        match['warehouse_path'] = warehouse_node
+    if category_node:
+        match['category_path'] = category_node
+    rows = await db.stock_balance.aggregate([
+        {"$match": match},
+        {"$group": {"_id": ROLLUP_GROUPS[group_by], "qty": {"$sum": "$qty"}}},
+        {"$sort": {"qty": -1}},
+    ]).to_list(None)
+    totals: Dict[str, float] = {}
+    for row in rows:
+        totals[row['_id']['uom']] = totals.get(row['_id']['uom'], 0.0) + row['qty']
+    result = {
+        "warehouse_node": warehouse_node,
+        "category_node": category_node,
+        "group_by": group_by,
+        # Per UOM: balances are held in each item's base UOM, and those don't add up across items
+        "totals": [{"uom": uom, "qty": qty} for uom, qty in totals.items()],
+        "rows": [{**row['_id'], "qty": row['qty']} for row in rows],
+    }
+    stock_rollup_cache.put(key, result)
+    return result
+
+# ============ Report Export ============
+class ExportFormat(str, Enum):
+    JSON = "json"
+    CSV = "csv"
+    XLSX = "xlsx"
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.CSV: "text/csv; charset=utf-8",
+    ExportFormat.XLSX: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+# Documents fetched per cursor batch, and rows per chunk handed to the response
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '2000'))
+EXPORT_CHUNK_ROWS = 500
+# Excel's sheet limit, header row included; rows past it are left out of xlsx exports
+XLSX_MAX_ROWS = 1048576
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+_XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Report" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def export_columns(fields: Optional[str], default: List[str]) -> List[str]:
+    if not fields:
+        return default
+    field_projection(fields)  # validates the names
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+def export_value(doc: Dict, column: str):
+    value = doc
+    for part in column.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return value
+
+async def iter_export_documents(sources: List[Tuple[str, Dict]], columns: List[str]):
+    projection = {"_id": 0, **{column: 1 for column in columns}}
+    for collection_name, query in sources:
+        async for doc in db[collection_name].find(query, projection).batch_size(EXPORT_BATCH_SIZE):
+            yield doc
+
+async def csv_chunks(docs, columns: List[str]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # The BOM makes Excel read the file as UTF-8
+    buffer.write("\ufeff")
+    writer.writerow(columns)
+    yield buffer.getvalue().encode("utf-8")
+    buffer.seek(0)
+    buffer.truncate()
+    rows = 0
+    async for doc in docs:
+        writer.writerow([export_value(doc, column) for column in columns])
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+class _ChunkSink:
+    """Write-only file for ZipFile that hands its bytes out as they are produced.
+
+    It has tell() but no seek(), so ZipFile streams entries with data descriptors
+    instead of going back to patch headers.
+    """
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.offset = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def xlsx_cell(value) -> str:
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)) and math.isfinite(value):
+        return f"<c><v>{value}</v></c>"
+    text = escape(_XML_ILLEGAL.sub("", str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def xlsx_row(values) -> str:
+    return "<row>" + "".join(xlsx_cell(value) for value in values) + "</row>"
+
+async def xlsx_chunks(docs, columns: List[str]):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(xlsx_row(columns).encode("utf-8"))
+            yield sink.drain()
+            rows = 1
+            async for doc in docs:
+                if rows >= XLSX_MAX_ROWS:
+                    break
+                sheet.write(xlsx_row(export_value(doc, column) for column in columns).encode("utf-8"))
+                rows += 1
+                if rows % EXPORT_CHUNK_ROWS == 0 and sink.chunks:
+                    yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+def export_response(report: str, sources: List[Tuple[str, Dict]], columns: List[str], format: ExportFormat) -> StreamingResponse:
+    """Stream a report straight from its cursors, so memory stays flat however many rows it has."""
+    docs = iter_export_documents(sources, columns)
+    chunks = csv_chunks(docs, columns) if format == ExportFormat.CSV else xlsx_chunks(docs, columns)
+    filename = f"{report}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{format.value}"
+    return StreamingResponse(
+        chunks, media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # ============ Reports ============
+# Columns exported when the request doesn't name its own ``fields``
+REPORT_EXPORT_COLUMNS = {
+    "stock-ledger": ["item_id", "item_name", "warehouse_id", "warehouse_name", "qty", "uom", "last_updated"],
+    "issue-register": ["issue_no", "issued_at", "department", "item_id", "item_name", "qty", "uom",
+                       "warehouse_name", "batch_no", "issued_by", "remarks"],
+    "pending-po": ["po_no", "created_at", "supplier_name", "status", "current_approver_role",
+                   "subtotal", "tax_amount", "total_amount", "open_qty"],
+}
+
 @api_router.get("/reports/stock-ledger")
-async def stock_ledger_report(item_id: Optional[str] = None, warehouse_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def stock_ledger_report(item_id: Optional[str] = None, warehouse_id: Optional[str] = None, fields: Optional[str] = None, format: ExportFormat = ExportFormat.JSON, current_user: Dict = Depends(get_current_user)):
     query = {}
     if item_id:
         query['item_id'] = item_id
     if warehouse_id:
         query['warehouse_id'] = warehouse_id
+    if format != ExportFormat.JSON:
+        columns = export_columns(fields, REPORT_EXPORT_COLUMNS["stock-ledger"])
+        return export_response("stock-ledger", [("stock_balance", query)], columns, format)
     
-    stocks = await db.stock_balance.find(query, {"_id": 0}).to_list(1000)
+    stocks = await db.stock_balance.find(query, field_projection(fields) or {"_id": 0}).to_list(1000)
     return stocks
 
 @api_router.get("/reports/issue-register")
-async def issue_register_report(start_date: Optional[str] = None, end_date: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
-    issues = await db.issues.find({}, {"_id": 0}).to_list(1000)
+async def issue_register_report(start_date: Optional[str] = None, end_date: Optional[str] = None, fields: Optional[str] = None, format: ExportFormat = ExportFormat.JSON, current_user: Dict = Depends(get_current_user)):
+    if format != ExportFormat.JSON:
+        columns = export_columns(fields, REPORT_EXPORT_COLUMNS["issue-register"])
+        query, sources = dated_sources("issues", {}, start_date, end_date)
+        return export_response("issue-register", [(source, query) for source in sources], columns, format)
+    projection = field_projection(fields)
+    issues = await find_documents("issues", {}, start_date, end_date, projection=projection)
+    if projection:
+        return sparse_response(issues)
     for issue in issues:
         if isinstance(issue['issued_at'], str):
             issue['issued_at'] = datetime.fromisoformat(issue['issued_at'])
     return issues
 
 @api_router.get("/reports/pending-po")
-async def pending_po_report(current_user: Dict = Depends(get_current_user)):
-    pos = await db.purchase_orders.find({"status": {"$in": [ApprovalStatus.PENDING, ApprovalStatus.DRAFT]}}, {"_id": 0}).to_list(1000)
+async def pending_po_report(fields: Optional[str] = None, format: ExportFormat = ExportFormat.JSON, current_user: Dict = Depends(get_current_user)):
+    # POs awaiting approval or still awaiting delivery, served by the (status, open_qty) index
+    query = {"status": {"$in": [ApprovalStatus.PENDING, ApprovalStatus.DRAFT, ApprovalStatus.APPROVED]}, "open_qty": {"$gt": QTY_EPSILON}}
+    if format != ExportFormat.JSON:
+        columns = export_columns(fields, REPORT_EXPORT_COLUMNS["pending-po"])
+        return export_response("pending-po", [("purchase_orders", query)], columns, format)
+    projection = field_projection(fields)
+    pos = await db.purchase_orders.find(query, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(pos)
     for po in pos:
         if isinstance(po['created_at'], str):
             po['created_at'] = datetime.fromisoformat(po['created_at'])
     return pos
 
-# Include router
-app.include_router(api_router)
+# ============ Demand Forecasting ============
+FORECAST_WORKERS = int(os.environ.get('FORECAST_WORKERS', str(os.cpu_count() or 1)))
+# Series per process-pool task
+FORECAST_CHUNK_SIZE = 5000
+def reorder_policy(daily: "np.ndarray", std: "np.ndarray", request: DemandForecastRequest) -> Dict[str, "np.ndarray"]:
+    """Safety stock covers lead-time demand variance at the requested service level."""
+    import numpy as np
+    z = statistics.NormalDist().inv_cdf(request.service_level)
+    safety = z * std * math.sqrt(request.lead_time_days)
+    reorder = daily * request.lead_time_days + safety
+    return {
+        "safety_stock": np.round(safety, 2),
+        "reorder_level": np.round(reorder, 2),
+        "min_stock": np.round(safety, 2),
+        "max_stock": np.round(reorder + daily * request.review_days, 2),
+    }
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def load_demand_history(history_days: int) -> Tuple[List[Tuple[str, str]], "np.ndarray"]:
+    """Daily issue quantities per item-warehouse over the last ``history_days`` days, today included."""
+    import numpy as np
+    today = datetime.now(timezone.utc).date()
+    start = today - timedelta(days=history_days - 1)
+    query, sources = dated_sources("issues", {}, start.isoformat(), None)
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": {"item_id": "$item_id", "warehouse_id": "$warehouse_id", "day": {"$substrBytes": ["$issued_at", 0, 10]}},
+            "qty": {"$sum": "$qty"},
+        }},
+        {"$group": {
+            "_id": {"item_id": "$_id.item_id", "warehouse_id": "$_id.warehouse_id"},
+            "days": {"$push": {"day": "$_id.day", "qty": "$qty"}},
+        }},
+    ]
+    keys: Dict[Tuple[str, str], int] = {}
+    cells: List[Tuple[int, int, float]] = []
+    start_ordinal = start.toordinal()
+    for source in sources:
+        async for row in db[source].aggregate(pipeline, allowDiskUse=True):
+            key = (row['_id']['item_id'], row['_id']['warehouse_id'])
+            index = keys.setdefault(key, len(keys))
+            for point in row['days']:
+                day = datetime.fromisoformat(point['day']).toordinal() - start_ordinal
+                if 0 <= day < history_days:
+                    cells.append((index, day, point['qty']))
+    history = np.zeros((len(keys), history_days))
+    if cells:
+        rows, cols, qtys = zip(*cells)
+        np.add.at(history, (np.array(rows), np.array(cols)), np.array(qtys, dtype=float))
+    return list(keys), history
+
+async def fit_demand_parallel(history: "np.ndarray", alpha: float):
+    import multiprocessing
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+    from forecasting import fit_demand
+    if FORECAST_WORKERS <= 1 or len(history) <= FORECAST_CHUNK_SIZE:
+        return await asyncio.to_thread(fit_demand, history, alpha)
+    chunks = np.array_split(history, math.ceil(len(history) / FORECAST_CHUNK_SIZE))
+    loop = asyncio.get_running_loop()
+    # Spawned rather than forked, as the parent has Motor's threads running; the workers
+    # only import the numpy-only forecasting module, never server
+    with ProcessPoolExecutor(max_workers=FORECAST_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        fits = await asyncio.gather(*(loop.run_in_executor(pool, fit_demand, chunk, alpha) for chunk in chunks))
+    return tuple(np.concatenate(parts) for parts in zip(*fits))
+
+async def run_demand_forecast(run_id: str, request: DemandForecastRequest, current_user: Dict):
+    import numpy as np
+    try:
+        keys, history = await load_demand_history(request.history_days)
+        await db.demand_forecast_runs.update_one({"id": run_id}, {"$set": {"series": len(keys)}})
+        daily, std, intermittent = await fit_demand_parallel(history, request.alpha)
+
+        # Item totals: demands add across warehouses, and so do variances if independent
+        item_ids = list(dict.fromkeys(item_id for item_id, _ in keys))
+        item_index = {item_id: i for i, item_id in enumerate(item_ids)}
+        owner = np.array([item_index[item_id] for item_id, _ in keys], dtype=np.intp)
+        item_daily = np.zeros(len(item_ids))
+        item_var = np.zeros(len(item_ids))
+        item_croston = np.zeros(len(item_ids), dtype=bool)
+        np.add.at(item_daily, owner, daily)
+        np.add.at(item_var, owner, std ** 2)
+        np.logical_or.at(item_croston, owner, intermittent)
+        item_std = np.sqrt(item_var)
+
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [(item_id, warehouse_id) for item_id, warehouse_id in keys] + [(item_id, None) for item_id in item_ids]
+        all_daily = np.concatenate([daily, item_daily])
+        all_std = np.concatenate([std, item_std])
+        methods = np.concatenate([intermittent, item_croston])
+        policy = reorder_policy(all_daily, all_std, request)
+        operations = []
+        for i, (item_id, warehouse_id) in enumerate(rows):
+            operations.append(UpdateOne({"item_id": item_id, "warehouse_id": warehouse_id}, {"$set": {
+                "item_id": item_id,
+                "warehouse_id": warehouse_id,
+                "method": "Croston" if methods[i] else "SES",
+                "daily_demand": round(float(all_daily[i]), 4),
+                "demand_std": round(float(all_std[i]), 4),
+                **{field: float(values[i]) for field, values in policy.items()},
+                "run_id": run_id,
+                "computed_at": now,
+            }}, upsert=True))
+        for offset in range(0, len(operations), 1000):
+            await db.demand_forecasts.bulk_write(operations[offset:offset + 1000], ordered=False)
+        # Series without issues in this window (or deleted items) would otherwise keep an old forecast
+        await db.demand_forecasts.delete_many({"run_id": {"$ne": run_id}})
+
+        applied = 0
+        if request.apply and item_ids:
+            applied = await apply_item_forecasts(item_ids, policy, len(keys), current_user)
+        await db.demand_forecast_runs.update_one({"id": run_id}, {"$set": {
+            "status": "Completed", "items_applied": applied, "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+    except Exception as e:
+        logger.exception("Demand forecast %s failed", run_id)
+        await db.demand_forecast_runs.update_one({"id": run_id}, {"$set": {
+            "status": "Failed", "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+
+async def apply_item_forecasts(item_ids: List[str], policy: Dict[str, "np.ndarray"], offset: int, current_user: Dict) -> int:
+    """Copy item-level suggestions onto ItemMaster; ``offset`` is where item rows start in ``policy``."""
+    fields = ("reorder_level", "min_stock", "max_stock")
+    current = {item['id']: item async for item in db.items.find({"id": {"$in": item_ids}}, {"_id": 0, "id": 1, **{f: 1 for f in fields}})}
+    first_seq = await next_sync_seq(len(item_ids))
+    operations = []
+    for i, item_id in enumerate(item_ids):
+        if item_id not in current:
+            continue
+        suggested = {field: float(policy[field][offset + i]) for field in fields}
+        audit_trail.record("item", item_id, "update", current_user, before=current[item_id], after={**current[item_id], **suggested})
+        operations.append(UpdateOne({"id": item_id}, {"$set": {**suggested, "updated_seq": first_seq + i}}))
+    for start in range(0, len(operations), 1000):
+        await db.items.bulk_write(operations[start:start + 1000], ordered=False)
+    return len(operations)
+
+@api_router.post("/admin/demand-forecast", response_model=DemandForecastRun)
+async def start_demand_forecast(request: DemandForecastRequest, current_user: Dict = Depends(get_current_user)):
+    if current_user.get('role') not in (UserRole.ADMIN, UserRole.PURCHASE):
+        raise HTTPException(status_code=403, detail="Only admin or purchase users can run forecasts")
+    run = DemandForecastRun(params=request, started_by=current_user['user_id'])
+    doc = run.model_dump()
+    doc['started_at'] = doc['started_at'].isoformat()
+    await claim_run("demand_forecast_runs", doc, "A demand forecast is already running")
+    spawn_run("demand_forecast_runs", run.id, run_demand_forecast(run.id, request, current_user))
+    return run
+
+@api_router.get("/admin/demand-forecast", response_model=List[DemandForecastRun])
+async def get_demand_forecast_runs(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    runs = await db.demand_forecast_runs.find({}, projection or {"_id": 0}).sort("started_at", -1).to_list(100)
+    if projection:
+        return sparse_response(runs)
+    for run in runs:
+        for field in ('started_at', 'finished_at'):
+            if run.get(field) and isinstance(run[field], str):
+                run[field] = datetime.fromisoformat(run[field])
+    return runs
+
+@api_router.get("/inventory/demand-forecasts", response_model=List[DemandForecast])
+async def get_demand_forecasts(item_id: Optional[str] = None, warehouse_id: Optional[str] = None, fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    query: Dict[str, Any] = {}
+    if item_id:
+        query['item_id'] = item_id
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    projection = field_projection(fields)
+    forecasts = await db.demand_forecasts.find(query, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return sparse_response(forecasts)
+    for forecast in forecasts:
+        if isinstance(forecast['computed_at'], str):
+            forecast['computed_at'] = datetime.fromisoformat(forecast['computed_at'])
+    return forecasts
+
+# ============ Item Classification ============
+async def load_item_unit_costs(items: Dict[str, Dict]) -> Dict[str, float]:
+    """Average purchase cost per base unit, from approved PO lines, archived years included."""
+    converter = await uom_converter.get()
+    totals: Dict[str, List[float]] = {}
+    pipeline = [
+        {"$match": {"status": ApprovalStatus.APPROVED}},
+        {"$unwind": "$items"},
+        {"$group": {"_id": {"item_id": "$items.item_id", "uom": "$items.uom"},
+                    "qty": {"$sum": "$items.qty"}, "amount": {"$sum": "$items.amount"}}},
+    ]
+    for source in await with_archives("purchase_orders"):
+        async for row in db[source].aggregate(pipeline, allowDiskUse=True):
+            item = items.get(row['_id']['item_id'])
+            factor = converter.factor(row['_id']['uom'], item['uom']) if item else None
+            if not factor:
+                continue
+            total = totals.setdefault(row['_id']['item_id'], [0.0, 0.0])
+            total[0] += row['qty'] * factor
+            total[1] += row['amount']
+    return {item_id: amount / qty for item_id, (qty, amount) in totals.items() if qty > 0}
+
+def classify_items(value: "np.ndarray", weekly: "np.ndarray", request: ItemClassificationRequest) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+    """ABC by cumulative share of consumption value, XYZ by weekly coefficient of variation."""
+    import numpy as np
+    order = np.argsort(-value, kind="stable")
+    total = value.sum()
+    # Share consumed by the items ranked above each item decides its class
+    share_before = np.empty_like(value)
+    share_before[order] = (np.cumsum(value[order]) - value[order]) / total if total > 0 else 1.0
+    abc = np.where(value <= 0, "C", np.where(share_before < request.a_cutoff, "A", np.where(share_before < request.b_cutoff, "B", "C")))
+    mean = weekly.mean(axis=1)
+    cv = np.divide(weekly.std(axis=1), mean, out=np.full(len(mean), np.inf), where=mean > 0)
+    xyz = np.where(cv <= request.x_cv, "X", np.where(cv <= request.y_cv, "Y", "Z"))
+    return abc, xyz, cv
+
+@api_router.post("/admin/item-classification")
+async def run_item_classification(request: ItemClassificationRequest, current_user: Dict = Depends(get_current_user)):
+    import numpy as np
+    if current_user.get('role') != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admins can reclassify items")
+    if request.b_cutoff <= request.a_cutoff or request.y_cv <= request.x_cv:
+        raise HTTPException(status_code=400, detail="Class B and Y limits must be above A and X")
+    items = {item['id']: item async for item in db.items.find({}, {"_id": 0, "id": 1, "uom": 1, "abc_class": 1, "xyz_class": 1})}
+    if not items:
+        return {"message": "No items to classify", "classified": 0, "classes": {}}
+    item_ids = list(items)
+    item_index = {item_id: i for i, item_id in enumerate(item_ids)}
+
+    keys, history = await load_demand_history(request.history_days)
+    weeks = request.history_days // 7
+    # Most recent whole weeks only, so a partial week doesn't look like a demand drop
+    series_weekly = history[:, request.history_days - weeks * 7:].reshape(len(keys), weeks, 7).sum(axis=2)
+    consumed = np.zeros(len(item_ids))
+    weekly = np.zeros((len(item_ids), weeks))
+    known = [i for i, (item_id, _) in enumerate(keys) if item_id in item_index]
+    if known:
+        owner = np.array([item_index[keys[i][0]] for i in known], dtype=np.intp)
+        np.add.at(consumed, owner, history[known].sum(axis=1))
+        np.add.at(weekly, owner, series_weekly[known])
+
+    costs = await load_item_unit_costs(items)
+    unit_cost = np.array([costs.get(item_id, 0.0) for item_id in item_ids])
+    value = consumed * unit_cost
+    abc, xyz, cv = classify_items(value, weekly, request)
+
+    now = datetime.now(timezone.utc).isoformat()
+    first_seq = await next_sync_seq(len(item_ids))
+    operations = [
+        UpdateOne({"id": item_id}, {"$set": {
+            "abc_class": str(abc[i]),
+            "xyz_class": str(xyz[i]),
+            "consumption_value": round(float(value[i]), 2),
+            "demand_cv": round(float(cv[i]), 4) if np.isfinite(cv[i]) else None,
+            "classified_at": now,
+            "updated_seq": first_seq + i,
+        }})
+        for i, item_id in enumerate(item_ids)
+    ]
+    for offset in range(0, len(operations), 1000):
+        await db.items.bulk_write(operations[offset:offset + 1000], ordered=False)
+    item_search_index.invalidate()
+    classes = dict(zip(*np.unique(np.char.add(abc.astype(str), xyz.astype(str)), return_counts=True)))
+    return {
+        "message": "Items classified",
+        "classified": len(item_ids),
+        "classes": {str(name): int(count) for name, count in classes.items()},
+    }
+
+# ============ Delta Sync ============
+# Entities served by /sync, with the filter a document must match to be on the client
+SYNC_ENTITIES = {
+    "items": ("items", {}),
+    "warehouses": ("warehouses", {}),
+    "bin_locations": ("bin_locations", {}),
+    "stock_balance": ("stock_balance", {}),
+    "purchase_orders": ("purchase_orders", {"status": ApprovalStatus.APPROVED, "open_qty": {"$gt": QTY_EPSILON}}),
+}
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', '500'))
+# The final version handed out trails the counter by this many sequence numbers, so a write that
+# took its number before a sync but committed after it is picked up on the next sync
+SYNC_SEQ_OVERLAP = int(os.environ.get('SYNC_SEQ_OVERLAP', '100'))
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', '30'))
+
+async def next_sync_seq(count: int = 1) -> int:
+    """Reserve ``count`` sequence numbers and return the first.
+
+    Deliberately outside any caller's transaction: a counter inside transactions would
+    make every concurrent stock posting conflict on this one document.
+    """
+    counter = await db.counters.find_one_and_update(
+        {"id": "sync_seq"}, {"$inc": {"seq": count}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return counter['seq'] - count + 1
+
+async def record_tombstone(entity: str, entity_id: str):
+    await db.sync_tombstones.insert_one({
+        "entity": entity,
+        "id": entity_id,
+        "updated_seq": await next_sync_seq(),
+        "deleted_at": datetime.now(timezone.utc).isoformat(),
+    })
+
+async def prune_sync_tombstones():
+    """Drop old tombstones; clients older than the newest dropped one must resync in full."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_DAYS)).isoformat()
+    newest = await db.sync_tombstones.find_one({"deleted_at": {"$lt": cutoff}}, {"_id": 0, "updated_seq": 1}, sort=[("updated_seq", -1)])
+    if not newest:
+        return
+    await db.counters.update_one({"id": "sync_seq"}, {"$max": {"tombstone_horizon": newest['updated_seq']}}, upsert=True)
+    await db.sync_tombstones.delete_many({"updated_seq": {"$lte": newest['updated_seq']}})
+
+async def backfill_sync_seq():
+    """Number documents written before sequence stamping, one number each so paging stays exact."""
+    for collection_name, _ in SYNC_ENTITIES.values():
+        ids = [doc['id'] async for doc in db[collection_name].find({"updated_seq": {"$exists": False}}, {"_id": 0, "id": 1})]
+        if not ids:
+            continue
+        first = await next_sync_seq(len(ids))
+        await db[collection_name].bulk_write(
+            [UpdateOne({"id": doc_id}, {"$set": {"updated_seq": first + i}}) for i, doc_id in enumerate(ids)],
+            ordered=False
+        )
+
+async def sync_page(collection_name: str, query: Dict) -> Tuple[List[Dict], bool]:
+    """One page of changed documents in sequence order; returns (docs, truncated)."""
+    docs = await db[collection_name].find(query, {"_id": 0}).sort("updated_seq", ASCENDING).to_list(SYNC_PAGE_SIZE + 1)
+    if len(docs) <= SYNC_PAGE_SIZE:
+        return docs, False
+    docs = docs[:SYNC_PAGE_SIZE]
+    # Bulk writes share a sequence number; finish that group so the next page can start after it
+    last_seq = docs[-1]['updated_seq']
+    seen = {doc['id'] for doc in docs}
+    docs.extend(doc for doc in await db[collection_name].find({**query, "updated_seq": last_seq}, {"_id": 0}).to_list(None)
+                if doc['id'] not in seen)
+    return docs, True
+
+@api_router.get("/sync", response_model=SyncResponse)
+async def delta_sync(since: int = 0, entities: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    names = [name.strip() for name in entities.split(",") if name.strip()] if entities else list(SYNC_ENTITIES)
+    unknown = [name for name in names if name not in SYNC_ENTITIES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown entities: {', '.join(unknown)}")
+
+    counter = await db.counters.find_one({"id": "sync_seq"}, {"_id": 0}) or {}
+    current_seq = counter.get('seq', 0)
+    reset = since <= 0 or since < counter.get('tombstone_horizon', 0) or since > current_seq
+    if reset:
+        since = 0
+
+    response = SyncResponse(version=max(since, current_seq - SYNC_SEQ_OVERLAP), reset=reset)
+    page_ends = []
+    for name in names:
+        collection_name, open_filter = SYNC_ENTITIES[name]
+        # A full download only needs what is on the client, not what left it
+        docs, truncated = await sync_page(collection_name, dict(open_filter) if reset else {"updated_seq": {"$gt": since}})
+        if truncated:
+            page_ends.append(docs[-1]['updated_seq'])
+        if not reset:
+            deleted = [t['id'] async for t in db.sync_tombstones.find(
+                {"entity": name, "updated_seq": {"$gt": since}}, {"_id": 0, "id": 1}
+            )]
+            if open_filter:
+                # Changed documents that no longer match (e.g. a fully received PO) leave the client
+                kept = {doc['id'] async for doc in db[collection_name].find(
+                    {"id": {"$in": [doc['id'] for doc in docs]}, **open_filter}, {"_id": 0, "id": 1}
+                )}
+                deleted.extend(doc['id'] for doc in docs if doc['id'] not in kept)
+                docs = [doc for doc in docs if doc['id'] in kept]
+            response.deleted[name] = deleted
+        response.changes[name] = docs
+    if page_ends:
+        response.has_more = True
+        response.version = min(page_ends)
+    return response
+
+# ============ Period Close Routes ============
+@api_router.post("/admin/period-close", response_model=PeriodClose)
+async def start_period_close(request: PeriodCloseRequest, current_user: Dict = Depends(get_current_user)):
+    if current_user.get('role') != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admins can close periods")
+    # Dates and naive timestamps are taken as UTC, so the archive cut compares with the stored dates
+    period_end = request.period_end
+    if period_end.tzinfo is None:
+        period_end = period_end.replace(tzinfo=timezone.utc)
+    period_end = period_end.astimezone(timezone.utc)
+    if period_end > datetime.now(timezone.utc):
+        raise HTTPException(status_code=400, detail="Cannot close a period that has not ended")
+    close = PeriodClose(period_end=period_end, closed_by=current_user['user_id'])
+    doc = close.model_dump()
+    doc['period_end'] = doc['period_end'].isoformat()
+    doc['started_at'] = doc['started_at'].isoformat()
+    await claim_run("period_closes", doc, "A period close is already running")
+    spawn_run("period_closes", close.id, run_period_close(close.id, doc['period_end']))
+    audit_trail.record("period_close", close.id, "create", current_user, after=doc)
+    return close
+
+# ============ Stock Reconciliation ============
+# Transactions that move stock_balance: (collection, quantity field, sign, date field, extra match)
+RECONCILE_SOURCES = [
+    ("stock_inward", "qty", 1, "created_at", {}),
+    ("issues", "qty", -1, "issued_at", {}),
+    ("returns", "qty_returned", 1, "returned_at", {"condition": "Good"}),
+    # Only adjustments whose approval posted them; older Approved rows never moved stock
+    ("adjustments", "adjustment_qty", 1, "stock_posted_at", {"status": ApprovalStatus.APPROVED, "stock_posted_at": {"$exists": True}}),
+]
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '8'))
+RECONCILE_TOLERANCE = 1e-6
+RECONCILE_REPORT_LIMIT = 1000
+# Balances or transactions this recent may belong to a posting still in flight; they're reported, not repaired
+RECONCILE_SETTLE_SECONDS = float(os.environ.get('RECONCILE_SETTLE_SECONDS', '60'))
+
+def reconcile_ranges() -> List[Dict]:
+    """Split the item_id space on two-character prefixes.
+
+    IDs are uuid4 hex, so the 256 ranges come out evenly sized; the open first
+    and last ranges keep any other ID shape covered too.
+    """
+    bounds = [None] + [f"{i:02x}" for i in range(1, 256)] + [None]
+    ranges = []
+    for low, high in zip(bounds, bounds[1:]):
+        condition = {}
+        if low is not None:
+            condition['$gte'] = low
+        if high is not None:
+            condition['$lt'] = high
+        ranges.append({"item_id": condition})
+    return ranges
+
+async def expected_balances(sources: List[Tuple[str, str, int, str, Dict]], item_range: Dict) -> Tuple[Dict[Tuple[str, str], float], Dict[Tuple[str, str], str], int]:
+    """Sum every source's movements per (item_id, warehouse_id) within one item range.
+
+    Also returns the latest transaction date per key.
+    """
+    async def aggregate(name, field, sign, date_field, match):
+        pipeline = [
+            {"$match": {**match, **item_range}},
+            {"$group": {"_id": {"item_id": "$item_id", "warehouse_id": "$warehouse_id"}, "qty": {"$sum": f"${field}"},
+                        "n": {"$sum": 1}, "last_at": {"$max": f"${date_field}"}}},
+        ]
+        return sign, await db[name].aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+    expected: Dict[Tuple[str, str], float] = {}
+    last_at: Dict[Tuple[str, str], str] = {}
+    transactions = 0
+    for sign, rows in await asyncio.gather(*(aggregate(*source) for source in sources)):
+        for row in rows:
+            key = (row['_id']['item_id'], row['_id']['warehouse_id'])
+            expected[key] = expected.get(key, 0.0) + sign * row['qty']
+            if isinstance(row['last_at'], str) and row['last_at'] > last_at.get(key, ""):
+                last_at[key] = row['last_at']
+            transactions += row['n']
+    return expected, last_at, transactions
+
+async def held_balances(item_range: Dict) -> set:
+    """(item_id, warehouse_id) keys with stock in BIN or lot balances, which a repair would put out of step."""
+    held = set()
+    for collection in (db.bin_stock_balance, db.lot_balance):
+        pipeline = [
+            {"$match": {**item_range, "$or": [{"qty": {"$gt": QTY_EPSILON}}, {"qty": {"$lt": -QTY_EPSILON}}]}},
+            {"$group": {"_id": {"item_id": "$item_id", "warehouse_id": "$warehouse_id"}}},
+        ]
+        async for row in collection.aggregate(pipeline):
+            held.add((row['_id']['item_id'], row['_id']['warehouse_id']))
+    return held
+
+def repair_blocker(d: Dict, balance: Optional[Dict], last_at: Optional[str], held: set, settle_after: str) -> Optional[str]:
+    """Why a drifted balance mustn't be overwritten, or None if it can be."""
+    if (d['item_id'], d['warehouse_id']) in held:
+        return "has BIN or lot balances"
+    if max((balance or {}).get('last_updated') or "", last_at or "") >= settle_after:
+        return "moved within the settle window"
+    if balance and (balance.get('reserved_qty') or 0.0) > d['expected'] + RECONCILE_TOLERANCE:
+        return "reserved quantity exceeds the recomputed balance"
+    return None
+
+async def repair_balances(drifted: List[Dict], balances: Dict[Tuple[str, str], Dict]) -> int:
+    """Write recomputed quantities back; a balance that moved since it was read is left alone."""
+    missing_items = {d['item_id'] for d in drifted if d['actual'] is None}
+    items = {
+        item['id']: item async for item in db.items.find({"id": {"$in": list(missing_items)}}, {"_id": 0, "id": 1, "item_name": 1, "uom": 1})
+    } if missing_items else {}
+    first_seq = await next_sync_seq(len(drifted))
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    for i, d in enumerate(drifted):
+        key = {"item_id": d['item_id'], "warehouse_id": d['warehouse_id']}
+        stamp = {"last_updated": now, "updated_seq": first_seq + i}
+        if d['actual'] is not None:
+            # Every posting restamps last_updated, so this also misses a balance that moved and came back
+            balance = balances[(d['item_id'], d['warehouse_id'])]
+            operations.append(UpdateOne(
+                {**key, "qty": balance['qty'], "last_updated": balance.get('last_updated')},
+                {"$set": {"qty": d['expected'], **stamp}}
+            ))
+        elif d['item_id'] in items:
+            item = items[d['item_id']]
+            operations.append(UpdateOne(key, {
+                "$set": stamp,
+                "$setOnInsert": {
+                    "id": str(uuid.uuid4()), "qty": d['expected'], "item_name": item['item_name'], "uom": item['uom'],
+                    **await stock_path_fields(d['item_id'], d['warehouse_id']),
+                },
+            }, upsert=True))
+    if not operations:
+        return 0
+    result = await db.stock_balance.bulk_write(operations, ordered=False)
+    return result.modified_count + result.upserted_count
+
+async def reconcile_range(sources: List[Tuple[str, str, int, str, Dict]], item_range: Dict, repair: bool, limit: asyncio.Semaphore) -> Dict:
+    async with limit:
+        # Balances before transactions: a posting that lands in between is in the sum but not
+        # the balance, and restamps the balance, so the repair's compare-and-set skips it
+        checked_at = datetime.now(timezone.utc)
+        balances = {
+            (row['item_id'], row['warehouse_id']): row
+            async for row in db.stock_balance.find(
+                item_range, {"_id": 0, "item_id": 1, "warehouse_id": 1, "qty": 1, "reserved_qty": 1, "last_updated": 1}
+            )
+        }
+        expected, last_at, transactions = await expected_balances(sources, item_range)
+        drifted = []
+        for key in expected.keys() | balances.keys():
+            want = expected.get(key, 0.0)
+            have = balances[key]['qty'] if key in balances else None
+            if abs(want - (have or 0.0)) > RECONCILE_TOLERANCE:
+                drifted.append({"item_id": key[0], "warehouse_id": key[1], "expected": want, "actual": have,
+                                "difference": want - (have or 0.0)})
+        repaired = skipped = 0
+        if repair and drifted:
+            held = await held_balances(item_range)
+            settle_after = (checked_at - timedelta(seconds=RECONCILE_SETTLE_SECONDS)).isoformat()
+            repairable = []
+            for d in drifted:
+                key = (d['item_id'], d['warehouse_id'])
+                reason = repair_blocker(d, balances.get(key), last_at.get(key), held, settle_after)
+                if reason:
+                    d['repair_skipped'] = reason
+                    skipped += 1
+                else:
+                    repairable.append(d)
+            repaired = await repair_balances(repairable, balances) if repairable else 0
+        return {"transactions": transactions, "balances_checked": len(balances), "drifted": drifted,
+                "repaired": repaired, "repair_skipped": skipped}
+
+async def reconcile_stock(repair: bool = False) -> Dict:
+    """Recompute every balance from its transactions, archives included, and diff it against stock_balance.
+
+    Adjustments count once their approval has posted them. Item ranges are
+    aggregated RECONCILE_CONCURRENCY at a time. A repair leaves alone balances with
+    BIN or lot rows, reservations above the recomputed quantity, or movements within
+    RECONCILE_SETTLE_SECONDS; those are reported with a ``repair_skipped`` reason.
+    """
+    sources = [
+        (source, field, sign, date_field, match)
+        for name, field, sign, date_field, match in RECONCILE_SOURCES
+        for source in await with_archives(name)
+    ]
+    # Each range query needs the (item_id, warehouse_id) index, archives included
+    for source in {source for source, *_ in sources}:
+        await db[source].create_index([("item_id", ASCENDING), ("warehouse_id", ASCENDING)])
+    limit = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    results = await asyncio.gather(*(reconcile_range(sources, item_range, repair, limit) for item_range in reconcile_ranges()))
+    drifted = [d for result in results for d in result['drifted']]
+    drifted.sort(key=lambda d: abs(d['difference']), reverse=True)
+    if repair:
+        stock_rollup_cache.invalidate()
+    return {
+        "transactions": sum(result['transactions'] for result in results),
+        "balances_checked": sum(result['balances_checked'] for result in results),
+        "discrepancy_count": len(drifted),
+        "repaired": sum(result['repaired'] for result in results),
+        "repair_skipped": sum(result['repair_skipped'] for result in results),
+        "discrepancies": drifted[:RECONCILE_REPORT_LIMIT],
+    }
+
+async def run_stock_reconciliation(run_id: str, repair: bool):
+    try:
+        summary = await reconcile_stock(repair)
+        await db.stock_reconciliations.update_one({"id": run_id}, {"$set": {
+            **summary, "status": "Completed", "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+    except Exception as e:
+        logger.exception("Stock reconciliation %s failed", run_id)
+        await db.stock_reconciliations.update_one({"id": run_id}, {"$set": {
+            "status": "Failed", "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+
+@api_router.post("/admin/stock-reconciliation", response_model=StockReconciliationRun)
+async def start_stock_reconciliation(request: StockReconciliationRequest, current_user: Dict = Depends(get_current_user)):
+    if current_user.get('role') != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admins can reconcile stock")
+    run = StockReconciliationRun(repair=request.repair, started_by=current_user['user_id'])
+    doc = run.model_dump()
+    doc['started_at'] = doc['started_at'].isoformat()
+    await claim_run("stock_reconciliations", doc, "A stock reconciliation is already running")
+    spawn_run("stock_reconciliations", run.id, run_stock_reconciliation(run.id, request.repair))
+    audit_trail.record("stock_reconciliation", run.id, "create", current_user, after=doc)
+    return run
+
+@api_router.get("/admin/stock-reconciliation", response_model=List[StockReconciliationRun])
+async def get_stock_reconciliations(current_user: Dict = Depends(get_current_user)):
+    if current_user.get('role') != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admins can reconcile stock")
+    runs = await db.stock_reconciliations.find({}, {"_id": 0}).sort("started_at", -1).to_list(100)
+    for run in runs:
+        for field in ('started_at', 'finished_at'):
+            if run.get(field) and isinstance(run[field], str):
+                run[field] = datetime.fromisoformat(run[field])
+    return runs
+
+# ============ Audit Routes ============
+@api_router.get("/audit", response_model=List[AuditEntry])
+async def get_audit_log(entity: Optional[str] = None, entity_id: Optional[str] = None, user_id: Optional[str] = None,
+                        start_date: Optional[str] = None, end_date: Optional[str] = None, limit: int = 100,
+                        fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    if current_user.get('role') != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admins can read the audit log")
+    if not entity and not user_id:
+        raise HTTPException(status_code=400, detail="Filter by entity or user_id")
+    # Served by the (entity, entity_id, at) and (user_id, at) indexes
+    query: Dict[str, Any] = {}
+    if entity:
+        query['entity'] = entity
+        if entity_id:
+            query['entity_id'] = entity_id
+    if user_id:
+        query['user_id'] = user_id
+    if start_date or end_date:
+        query['at'] = {}
+        if start_date:
+            query['at']['$gte'] = start_date
+        if end_date:
+            query['at']['$lt'] = end_date
+    projection = field_projection(fields)
+    limit = max(1, min(limit, 1000))
+    entries = await db.audit_log.find(query, projection or {"_id": 0}).sort("at", -1).to_list(limit)
+    if projection:
+        return sparse_response(entries)
+    for entry in entries:
+        if isinstance(entry['at'], str):
+            entry['at'] = datetime.fromisoformat(entry['at'])
+    return entries
+
+@api_router.get("/admin/period-close", response_model=List[PeriodClose])
+async def get_period_closes(fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    projection = field_projection(fields)
+    closes = await db.period_closes.find({}, projection or {"_id": 0}).sort("started_at", -1).to_list(1000)
+    if projection:
+        return sparse_response(closes)
+    for close in closes:
+        for field in ('period_end', 'started_at', 'finished_at'):
+            if close.get(field) and isinstance(close[field], str):
+                close[field] = datetime.fromisoformat(close[field])
+    return closes
+
+# ============ Batch Reads ============
+# Section name -> (route handler, response model); the handlers run as-is, with the caller's token decoded once
+BATCH_SECTIONS = {
+    "me": (get_me, User),
+    "item_categories": (get_item_categories, List[ItemCategory]),
+    "items": (get_items, List[ItemMaster]),
+    "uoms": (get_uoms, List[UOMMaster]),
+    "suppliers": (get_suppliers, List[SupplierMaster]),
+    "warehouses": (get_warehouses, List[WarehouseMaster]),
+    "bin_locations": (get_bin_locations, List[BINLocationMaster]),
+    "tax_hsn": (get_tax_hsn, List[TaxHSNMaster]),
+    "dashboard": (get_dashboard_stats, None),
+    "indents": (get_indents, List[PurchaseIndent]),
+    "purchase_orders": (get_pos, List[PurchaseOrder]),
+    "grn": (get_grns, List[GRN]),
+    "stock_balance": (get_stock_balance, List[StockBalance]),
+    "pending_approvals": (my_pending_approvals, None),
+}
+# What the app needs for its first screen after login
+BOOTSTRAP_SECTIONS = ("me", "item_categories", "items", "uoms", "suppliers", "warehouses", "bin_locations", "tax_hsn", "dashboard")
+BATCH_ADAPTERS = {name: TypeAdapter(model) for name, (_, model) in BATCH_SECTIONS.items() if model is not None}
+
+def section_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+async def render_section(name: str, params: Dict[str, str], current_user: Dict) -> Tuple[int, bytes]:
+    """Run one section's handler and return its status and JSON body, serialized as the route itself would."""
+    handler, _ = BATCH_SECTIONS[name]
+    try:
+        result = await handler(**params, current_user=current_user)
+    except HTTPException as exc:
+        return exc.status_code, json.dumps({"detail": exc.detail}).encode()
+    if isinstance(result, Response):
+        return result.status_code, result.body
+    if name in BATCH_ADAPTERS:
+        adapter = BATCH_ADAPTERS[name]
+        return 200, adapter.dump_json(adapter.validate_python(result))
+    return 200, json.dumps(jsonable_encoder(result), separators=(",", ":")).encode()
+
+async def batch_response(request: Request, sections: Dict[str, Dict[str, str]], current_user: Dict) -> Response:
+    """Render sections concurrently into one body, each with its own ETag.
+
+    Sections whose ETag the client sends back in If-None-Match come back as ``not_modified``
+    without data; a 304 is returned when every section is unchanged.
+    """
+    for name, params in sections.items():
+        if name not in BATCH_SECTIONS:
+            raise HTTPException(status_code=400, detail=f"Unknown section: {name}")
+        allowed = inspect.signature(BATCH_SECTIONS[name][0]).parameters.keys() - {"current_user"}
+        unknown = params.keys() - allowed
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown parameters for {name}: {', '.join(sorted(unknown))}")
+    rendered = await asyncio.gather(*(render_section(name, params, current_user) for name, params in sections.items()))
+
+    known = {tag.strip() for tag in request.headers.get("if-none-match", "").split(",") if tag.strip()}
+    etags = [section_etag(body) for _, body in rendered]
+    # Weak, since the compression middleware may re-encode the body
+    etag = "W/" + section_etag("".join(etags).encode())
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in known:
+        return Response(status_code=304, headers=headers)
+    # Section bodies are already JSON, so they are spliced in rather than decoded and encoded again
+    parts = []
+    for name, (status_code, body), section_tag in zip(sections, rendered, etags):
+        head = json.dumps({"status": status_code, "etag": section_tag})[:-1]
+        if section_tag in known:
+            parts.append(f'{json.dumps(name)}:{head},"not_modified":true}}'.encode())
+        else:
+            parts.append(f'{json.dumps(name)}:{head},"data":'.encode() + body + b"}")
+    return Response(content=b"{" + b",".join(parts) + b"}", media_type="application/json", headers=headers)
+
+@api_router.get("/bootstrap")
+async def bootstrap(request: Request, current_user: Dict = Depends(get_current_user)):
+    return await batch_response(request, {name: {} for name in BOOTSTRAP_SECTIONS}, current_user)
+
+@api_router.post("/batch")
+async def batch(request: Request, batch_request: BatchRequest, current_user: Dict = Depends(get_current_user)):
+    if not batch_request.sections:
+        raise HTTPException(status_code=400, detail="No sections requested")
+    return await batch_response(request, batch_request.sections, current_user)
+
+# ============ Admission Control ============
+# Token cost and concurrent-request cap per endpoint class
+ENDPOINT_COSTS = {"report": 5.0, "transactional": 2.0, "read": 1.0}
+ENDPOINT_CONCURRENCY = {
+    "report": int(os.environ.get('MAX_CONCURRENT_REPORTS', '4')),
+    "transactional": int(os.environ.get('MAX_CONCURRENT_WRITES', '32')),
+    "read": int(os.environ.get('MAX_CONCURRENT_READS', '64')),
+}
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '60'))
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', '10'))
+# Admins run period closes and reconciliations, so they get a larger bucket
+ROLE_RATE_MULTIPLIERS = {UserRole.ADMIN: 2.0}
+RATE_LIMIT_SHARED = os.environ.get('RATE_LIMIT_BACKEND', 'memory') == 'mongo'
+# How often idle, refilled in-process buckets are swept out
+RATE_LIMIT_PRUNE_SECONDS = float(os.environ.get('RATE_LIMIT_PRUNE_SECONDS', '60'))
+
+def endpoint_class(request: Request) -> str:
+    path = request.url.path
+    if path.startswith(("/api/reports/", "/api/dashboard/")):
+        return "report"
+    if request.method in ("POST", "PUT", "PATCH", "DELETE"):
+        return "transactional"
+    return "read"
+
+class TokenBucketLimiter:
+    """Per-caller token buckets, in-process or shared between workers through Mongo."""
+
+    def __init__(self, prune_interval: float = RATE_LIMIT_PRUNE_SECONDS):
+        # key -> [tokens, updated, full_at]
+        self._buckets: Dict[str, List[float]] = {}
+        self.prune_interval = prune_interval
+        self._next_prune = time.monotonic() + prune_interval
+
+    async def acquire(self, key: str, capacity: float, rate: float, cost: float) -> float:
+        """Take ``cost`` tokens; returns 0 when admitted, else the seconds until enough have refilled."""
+        if RATE_LIMIT_SHARED:
+            return await self._acquire_shared(key, capacity, rate, cost)
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self.prune(now)
+        tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        admitted = tokens >= cost
+        if admitted:
+            tokens -= cost
+        self._buckets[key] = [tokens, now, now + (capacity - tokens) / rate]
+        return 0.0 if admitted else (cost - tokens) / rate
+
+    def prune(self, now: float):
+        """Drop buckets that have refilled to capacity; a missing key starts full, so nothing changes for the caller."""
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        self._next_prune = now + self.prune_interval
+
+    async def _acquire_shared(self, key: str, capacity: float, rate: float, cost: float) -> float:
+        now = time.time()
+        refilled = {"$min": [capacity, {"$add": [
+            {"$ifNull": ["$tokens", capacity]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, rate]},
+        ]}]}
+        # Refill and spend in one atomic pipeline update so workers can't double-spend
+        bucket = await db.rate_limits.find_one_and_update(
+            {"key": key},
+            [
+                {"$set": {"tokens": refilled, "updated": now}},
+                {"$set": {
+                    "admitted": {"$gte": ["$tokens", cost]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", cost]}, {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                    "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if bucket['admitted']:
+            return 0.0
+        return (cost - bucket['tokens']) / rate
+
+class ConcurrencyLimiter:
+    """Non-blocking per-class slot counter; a full class sheds load instead of queueing."""
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        self.active = {name: 0 for name in limits}
+
+    def try_acquire(self, name: str) -> bool:
+        if self.active[name] >= self.limits[name]:
+            return False
+        self.active[name] += 1
+        return True
+
+    def release(self, name: str):
+        self.active[name] -= 1
+
+rate_limiter = TokenBucketLimiter()
+concurrency_limiter = ConcurrencyLimiter(ENDPOINT_CONCURRENCY)
+
+async def admission_control(request: Request, auth: Tuple[Optional[Dict], Optional[HTTPException]] = Depends(authenticate)):
+    # A bad or missing token is reported by the route's own get_current_user
+    user, _ = auth
+    if user:
+        key = f"user:{user['user_id']}:{user.get('role')}"
+        multiplier = ROLE_RATE_MULTIPLIERS.get(user.get('role'), 1.0)
+    else:
+        key = f"ip:{request.client.host if request.client else 'unknown'}"
+        multiplier = 1.0
+
+    kind = endpoint_class(request)
+    retry_after = await rate_limiter.acquire(
+        key, RATE_LIMIT_BURST * multiplier, RATE_LIMIT_PER_SECOND * multiplier, ENDPOINT_COSTS[kind]
+    )
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+    if not concurrency_limiter.try_acquire(kind):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Too many concurrent {kind} requests",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        yield
+    finally:
+        concurrency_limiter.release(kind)
+
+# ============ Response Compression ============
+class _GzipEncoder:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+class _BrotliEncoder:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+class CompressionMiddleware:
+    """Negotiated brotli/gzip compression for responses over ``minimum_size`` bytes.
+
+    Streaming responses are compressed chunk by chunk and flushed, so exports
+    still start sending immediately.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        accepted: Dict[str, bool] = {}
+        for token in accept_encoding.lower().split(","):
+            coding, *params = [part.strip() for part in token.split(";")]
+            if not coding:
+                continue
+            q = 1.0
+            for param in params:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            accepted[coding] = q > 0
+        # q=0 refuses a coding; "*" covers codings not listed on their own
+        def acceptable(coding: str) -> bool:
+            return accepted.get(coding, accepted.get("*", False))
+
+        if brotli is not None and acceptable("br"):
+            return "br"
+        if acceptable("gzip"):
+            return "gzip"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = self.negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        encoder = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, encoder, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                passthrough = "content-encoding" in Headers(raw=message["headers"])
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                initial, start_message = start_message, None
+                if passthrough or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(initial)
+                    await send(message)
+                    return
+                encoder = _BrotliEncoder(self.brotli_quality) if encoding == "br" else _GzipEncoder(self.gzip_level)
+                headers = MutableHeaders(raw=initial["headers"])
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                    body = encoder.chunk(body)
+                else:
+                    body = encoder.finish(body)
+                    headers["Content-Length"] = str(len(body))
+                await send(initial)
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+                return
+            if passthrough:
+                await send(message)
+                return
+            body = encoder.chunk(body) if more_body else encoder.finish(body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -979,6 +5332,170 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+async def load_runtime_state():
+    """In-memory state a worker needs before it serves its first request."""
+    await archive_state.load()
+    await approval_engine.load()
+    for collection_name in RUN_COLLECTIONS:
+        await fail_stale_runs(collection_name)
+    # Built before serving: the single-run guards rely on them, and the collections are small
+    for collection_name in SINGLE_RUN_COLLECTIONS:
+        await ensure_index(
+            collection_name, "status", name="single_running", unique=True,
+            partialFilterExpression={"status": "Running"}
+        )
+
+async def ensure_index(collection_name: str, keys, **options):
+    """Build one index; a failure is logged and doesn't stop the builds after it."""
+    try:
+        await db[collection_name].create_index(keys, **options)
+    except Exception:
+        logger.exception("Building index %s on %s failed", keys, collection_name)
+
+async def run_backfills():
+    """Data migrations the routes depend on, e.g. GRNs need open_qty on every PO line.
+
+    They run before the worker serves; a failure aborts startup rather than serve half-migrated data.
+    """
+    for backfill in (normalize_blank_barcodes, backfill_bin_walk_keys, backfill_hierarchy_paths, backfill_po_line_quantities, backfill_sync_seq):
+        started = time.perf_counter()
+        await backfill()
+        logger.info("%s finished in %.0f ms", backfill.__name__, (time.perf_counter() - started) * 1000)
+
+async def create_indexes():
+    await ensure_index("items", "id", unique=True)
+    # Partial filter so items without a barcode don't collide on null
+    await ensure_index(
+        "items", "barcode", unique=True,
+        partialFilterExpression={"barcode": {"$type": "string"}}
+    )
+    await ensure_index("items", "item_code", collation=ITEM_COLLATION)
+    await ensure_index("items", "item_name", collation=ITEM_COLLATION)
+    await ensure_index("items", [("abc_class", ASCENDING), ("xyz_class", ASCENDING)])
+    await ensure_index("items", "xyz_class")
+    for collection_name in APPROVAL_COLLECTIONS.values():
+        await ensure_index(collection_name, "id", unique=True)
+        await ensure_index(collection_name, "status")
+        await ensure_index(collection_name, [("current_approver_role", ASCENDING), ("status", ASCENDING)])
+    await ensure_index("approval_history", [("document_type", ASCENDING), ("document_id", ASCENDING), ("at", ASCENDING)])
+    await ensure_index("approval_flows", "document_type")
+    await ensure_index("purchase_orders", [("status", ASCENDING), ("open_qty", ASCENDING)])
+    await ensure_index("purchase_orders", [("status", ASCENDING), ("items.hsn", ASCENDING)])
+    await ensure_index("tax_hsn", "hsn_code")
+    await ensure_index("grn", "po_id")
+    await ensure_index("grn", "id", unique=True)
+    await ensure_index("grn", [("supplier_id", ASCENDING), ("received_at", ASCENDING)])
+    await ensure_index("purchase_orders", [("supplier_id", ASCENDING), ("created_at", ASCENDING)])
+    await ensure_index("supplier_scores", [("supplier_id", ASCENDING), ("period", ASCENDING)], unique=True)
+    await ensure_index("supplier_scores", [("period", ASCENDING), ("score", ASCENDING)])
+    await ensure_index("quality_checks", "grn_id")
+    await ensure_index("stock_balance", [("item_id", ASCENDING), ("warehouse_id", ASCENDING)], unique=True)
+    await ensure_index(
+        "bin_stock_balance", [("item_id", ASCENDING), ("warehouse_id", ASCENDING), ("bin_location_id", ASCENDING)], unique=True
+    )
+    await ensure_index("bin_stock_balance", [("item_id", ASCENDING), ("warehouse_id", ASCENDING), ("walk_key", ASCENDING)])
+    await ensure_index("bin_locations", "id", unique=True)
+    await ensure_index("bin_locations", [("warehouse_id", ASCENDING), ("status", ASCENDING), ("walk_key", ASCENDING)])
+    await ensure_index("warehouses", "id", unique=True)
+    await ensure_index("warehouses", "path_ids")
+    await ensure_index("item_categories", "id", unique=True)
+    await ensure_index("item_categories", "path_ids")
+    await ensure_index("stock_balance", "warehouse_path")
+    await ensure_index("stock_balance", "category_path")
+    await ensure_index("stock_balance", "category_id")
+    await ensure_index("number_series", "series_type", unique=True)
+    await ensure_index("cycle_counts", "id", unique=True)
+    await ensure_index("cycle_counts", [("warehouse_id", ASCENDING), ("status", ASCENDING)])
+    await ensure_index("adjustments", "cycle_count_id")
+    await ensure_index("reservations", "id", unique=True)
+    await ensure_index("reservations", [("status", ASCENDING), ("expires_at", ASCENDING)])
+    await ensure_index("reservations", [("item_id", ASCENDING), ("warehouse_id", ASCENDING)])
+    await ensure_index("reservations", "source_id")
+    await ensure_index("rename_jobs", [("entity", ASCENDING), ("entity_id", ASCENDING), ("status", ASCENDING)])
+    await ensure_index("rename_jobs", "started_at")
+    await ensure_index("stock_reconciliations", "started_at")
+    await ensure_index("reservations", "sweep_id", sparse=True)
+    # Only settled reservations age out; active ones wait for the sweeper to release their stock
+    await ensure_index(
+        "reservations", "expires_at", name="expires_at_ttl",
+        expireAfterSeconds=RESERVATION_RETENTION_DAYS * 86400,
+        partialFilterExpression={"released_at": {"$type": "string"}}
+    )
+    for name, date_field in ARCHIVE_COLLECTIONS.items():
+        await ensure_index(name, date_field)
+    await ensure_index("stock_balance_snapshots", [("period_end", ASCENDING), ("item_id", ASCENDING)])
+    await ensure_index("period_closes", "period_end")
+    await ensure_index("rate_limits", "key", unique=True)
+    await ensure_index("rate_limits", "expires_at", expireAfterSeconds=0)
+    await ensure_index(
+        "lot_balance", [("item_id", ASCENDING), ("warehouse_id", ASCENDING), ("batch_no", ASCENDING)], unique=True
+    )
+    await ensure_index(
+        "lot_balance", [("item_id", ASCENDING), ("warehouse_id", ASCENDING), ("expiry_sort", ASCENDING), ("received_at", ASCENDING)]
+    )
+    await ensure_index("lot_balance", [("expiry_sort", ASCENDING), ("warehouse_id", ASCENDING)])
+    for collection_name, _ in SYNC_ENTITIES.values():
+        await ensure_index(collection_name, "updated_seq")
+    await ensure_index("counters", "id", unique=True)
+    await ensure_index("sync_tombstones", [("entity", ASCENDING), ("updated_seq", ASCENDING)])
+    await ensure_index("sync_tombstones", "deleted_at")
+    try:
+        await prune_sync_tombstones()
+    except Exception:
+        logger.exception("Pruning sync tombstones failed")
+    await ensure_index("demand_forecasts", [("item_id", ASCENDING), ("warehouse_id", ASCENDING)], unique=True)
+    await ensure_index("demand_forecast_runs", "started_at")
+    await ensure_index("audit_log", "id", unique=True)
+    await ensure_index("audit_log", [("entity", ASCENDING), ("entity_id", ASCENDING), ("at", ASCENDING)])
+    await ensure_index("audit_log", [("user_id", ASCENDING), ("at", ASCENDING)])
+
+async def run_startup_maintenance():
+    started = time.perf_counter()
+    await create_indexes()
+    logger.info("Startup maintenance finished in %.0f ms", (time.perf_counter() - started) * 1000)
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """Build the ASGI app; nothing connects to MongoDB until its lifespan starts.
+
+    The Motor client is bound to the module-level ``client``/``db`` handles, so
+    one process serves one app at a time.
+    """
+    settings = settings or Settings.from_env()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if not settings.mongo_url or not settings.db_name:
+            raise RuntimeError("MONGO_URL and DB_NAME must be set")
+        motor_client = AsyncIOMotorClient(settings.mongo_url)
+        client.bind(motor_client)
+        db.bind(motor_client[settings.db_name])
+        await load_runtime_state()
+        if settings.startup_maintenance:
+            await run_backfills()
+        maintenance = asyncio.create_task(run_startup_maintenance()) if settings.startup_maintenance else None
+        audit_trail.start()
+        reservation_sweeper.start()
+        try:
+            yield
+        finally:
+            if maintenance and not maintenance.done():
+                maintenance.cancel()
+            await reservation_sweeper.stop()
+            await audit_trail.stop()
+            motor_client.close()
+            client.bind(None)
+            db.bind(None)
+
+    app = FastAPI(title="ERP Inventory Management System", lifespan=lifespan)
+    app.include_router(api_router, dependencies=[Depends(admission_control)])
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=settings.cors_origins,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(CompressionMiddleware, minimum_size=settings.compression_min_size)
+    return app
+
+app = create_app()
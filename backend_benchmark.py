@@ -0,0 +1,120 @@
+import json
+import os
+import requests
+import statistics
+import subprocess
+import sys
+import time
+
+class ERPBackendBenchmark:
+    def __init__(self, base_url="https://texinventory.preview.emergentagent.com", runs=30):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.runs = runs
+        self.token = None
+        self.results = []
+        self.startup_results = []
+
+    def login(self, email, password):
+        response = requests.post(f"{self.api_url}/auth/login", json={"email": email, "password": password}, timeout=10)
+        if response.status_code != 200:
+            print(f"❌ Login failed - Status: {response.status_code}")
+            return False
+        self.token = response.json()['access_token']
+        return True
+
+    def measure(self, name, endpoint, params=None, encoding="identity"):
+        """Time an endpoint and record the compressed bytes actually sent over the wire"""
+        headers = {'Authorization': f'Bearer {self.token}', 'Accept-Encoding': encoding}
+        latencies = []
+        wire_bytes = 0
+        for _ in range(self.runs):
+            start = time.perf_counter()
+            response = requests.get(f"{self.api_url}/{endpoint}", params=params, headers=headers, timeout=30, stream=True)
+            # Read the raw stream so the size is measured before requests decompresses it
+            body = response.raw.read(decode_content=False)
+            latencies.append((time.perf_counter() - start) * 1000)
+            wire_bytes = len(body)
+        latencies.sort()
+        p95 = latencies[max(0, int(round(0.95 * len(latencies))) - 1)]
+        self.results.append({
+            "name": name,
+            "encoding": encoding,
+            "bytes": wire_bytes,
+            "p50_ms": statistics.median(latencies),
+            "p95_ms": p95,
+        })
+
+    def bench_list_payloads(self):
+        """PO and GRN lists: full documents vs sparse fieldsets, uncompressed vs negotiated compression"""
+        cases = [
+            ("PO list (full)", "purchase/orders", None),
+            ("PO list (fields)", "purchase/orders", {"fields": "po_no,supplier_name,status,total_amount"}),
+            ("GRN list (full)", "inventory/grn", None),
+            ("GRN list (fields)", "inventory/grn", {"fields": "grn_no,po_no,item_name,qty,status"}),
+        ]
+        for name, endpoint, params in cases:
+            for encoding in ("identity", "gzip", "br"):
+                self.measure(name, endpoint, params, encoding)
+
+    def bench_startup(self, runs=10):
+        """Cold import + create_app() in a fresh interpreter, and the lifespan startup when Mongo is configured"""
+        backend_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+        script = (
+            "import asyncio, json, os, sys, time\n"
+            "start = time.perf_counter()\n"
+            "import server\n"
+            "app = server.create_app()\n"
+            "result = {'import_ms': (time.perf_counter() - start) * 1000, 'numpy_loaded': 'numpy' in sys.modules}\n"
+            "async def lifespan():\n"
+            "    start = time.perf_counter()\n"
+            "    async with app.router.lifespan_context(app):\n"
+            "        result['lifespan_ms'] = (time.perf_counter() - start) * 1000\n"
+            "if os.environ.get('MONGO_URL'):\n"
+            "    asyncio.run(lifespan())\n"
+            "print(json.dumps(result))\n"
+        )
+        samples = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, "-c", script], cwd=backend_dir, capture_output=True, text=True, timeout=60)
+            if output.returncode != 0:
+                print(f"❌ Startup run failed: {output.stderr.strip().splitlines()[-1:]}")
+                return
+            samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        for key in ("import_ms", "lifespan_ms"):
+            values = sorted(sample[key] for sample in samples if key in sample)
+            if values:
+                self.startup_results.append({
+                    "name": key,
+                    "p50_ms": statistics.median(values),
+                    "p95_ms": values[max(0, int(round(0.95 * len(values))) - 1)],
+                })
+        self.numpy_at_import = any(sample["numpy_loaded"] for sample in samples)
+
+    def print_summary(self):
+        print("\n" + "="*72)
+        print(f"{'Case':<22}{'Encoding':<10}{'Bytes':>12}{'p50 ms':>12}{'p95 ms':>12}")
+        print("="*72)
+        for result in self.results:
+            print(f"{result['name']:<22}{result['encoding']:<10}{result['bytes']:>12}{result['p50_ms']:>12.1f}{result['p95_ms']:>12.1f}")
+        if self.startup_results:
+            print("\n" + "="*72)
+            print(f"{'Worker startup':<44}{'p50 ms':>12}{'p95 ms':>12}")
+            print("="*72)
+            for result in self.startup_results:
+                print(f"{result['name']:<44}{result['p50_ms']:>12.1f}{result['p95_ms']:>12.1f}")
+            print(f"numpy loaded at import: {self.numpy_at_import}")
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "https://texinventory.preview.emergentagent.com"
+    bench = ERPBackendBenchmark(base_url)
+    bench.bench_startup()
+    if not bench.login("admin@erp.com", "admin123"):
+        bench.print_summary()
+        return 1
+    bench.bench_list_payloads()
+    bench.print_summary()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
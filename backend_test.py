@@ -1,6 +1,15 @@
+import io
 import requests
 import sys
-from datetime import datetime
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# How long to wait for background work: a reconciliation run, or the reservation sweeper (60s period)
+RECONCILE_WAIT_SECONDS = 300
+SWEEP_WAIT_SECONDS = 180
 
 class ERPBackendTester:
     def __init__(self, base_url="https://texinventory.preview.emergentagent.com"):
@@ -59,6 +68,32 @@ class ERPBackendTester:
             })
             return False, {}
 
+    def request(self, method, endpoint, data=None):
+        """Send one request without counting it as a test; returns (status, body)"""
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token}'}
+        response = requests.request(method, f"{self.api_url}/{endpoint}", json=data, headers=headers, timeout=30)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, {}
+
+    def fetch(self, endpoint, headers=None):
+        """GET without decoding the body; returns the raw response"""
+        headers = {'Authorization': f'Bearer {self.token}', **(headers or {})}
+        return requests.get(f"{self.api_url}/{endpoint}", headers=headers, timeout=30)
+
+    def check(self, name, condition, detail=""):
+        """Record an assertion about data returned by earlier requests"""
+        self.tests_run += 1
+        print(f"\n🔍 Checking {name}...")
+        if condition:
+            self.tests_passed += 1
+            print("✅ Passed")
+            return True
+        print(f"❌ Failed - {detail}")
+        self.failed_tests.append({"test": name, "error": detail})
+        return False
+
     def test_login(self, email, password):
         """Test login and get token"""
         print("\n" + "="*60)
@@ -280,6 +315,439 @@ class ERPBackendTester:
             200
         )
 
+    # ---------- Stock posting scenarios ----------
+    def create_stock_fixture(self, label):
+        """A fresh item and warehouse, so balances start from zero"""
+        suffix = uuid.uuid4().hex[:8]
+        if not getattr(self, 'category_id', None):
+            _, category = self.run_test(
+                "Create Item Category",
+                "POST",
+                "masters/item-categories",
+                200,
+                data={"code": f"TST-{suffix}", "name": f"Test category {suffix}", "inventory_type": "RAW", "default_uom": "NOS"}
+            )
+            self.category_id = category.get('id')
+        _, item = self.run_test(
+            f"Create Item ({label})",
+            "POST",
+            "masters/items",
+            200,
+            data={"item_code": f"TST-{suffix}", "item_name": f"Test item {label} {suffix}", "category_id": self.category_id, "uom": "NOS"}
+        )
+        _, warehouse = self.run_test(
+            f"Create Warehouse ({label})",
+            "POST",
+            "masters/warehouses",
+            200,
+            data={"warehouse_name": f"Test warehouse {label} {suffix}", "warehouse_type": "Store"}
+        )
+        return {"item": item, "warehouse": warehouse}
+
+    def post_inward(self, fixture, qty, batch_no=None, expiry_date=None):
+        return self.request("POST", "inventory/stock-inward", {
+            "inward_no": "", "qc_id": "test", "created_by": "test",
+            "item_id": fixture['item'].get('id'), "item_name": fixture['item'].get('item_name'),
+            "qty": qty, "uom": "NOS", "warehouse_id": fixture['warehouse'].get('id'),
+            "batch_no": batch_no, "expiry_date": expiry_date,
+        })
+
+    def post_issue(self, fixture, qty, reservation_id=None, batch_no=None):
+        return self.request("POST", "inventory/issue", {
+            "issue_no": "", "department": "Production", "issued_by": "test",
+            "item_id": fixture['item'].get('id'), "item_name": fixture['item'].get('item_name'),
+            "qty": qty, "uom": "NOS",
+            "warehouse_id": fixture['warehouse'].get('id'), "warehouse_name": fixture['warehouse'].get('warehouse_name'),
+            "reservation_id": reservation_id, "batch_no": batch_no,
+        })
+
+    def reserve(self, fixture, qty, ttl_minutes=60):
+        return self.request("POST", "inventory/reservations", {
+            "item_id": fixture['item'].get('id'), "warehouse_id": fixture['warehouse'].get('id'),
+            "qty": qty, "uom": "NOS", "source_type": "Issue", "ttl_minutes": ttl_minutes,
+        })
+
+    def available(self, fixture):
+        _, stock = self.request("GET", f"inventory/available?item_id={fixture['item'].get('id')}&warehouse_id={fixture['warehouse'].get('id')}")
+        return stock
+
+    def approve_adjustment(self, adjustment_id):
+        """Approve through every level of the chain; returns the last response"""
+        for _ in range(10):
+            status, outcome = self.request("PUT", f"approvals/stock_adjustment/{adjustment_id}/approve")
+            if status != 200 or outcome.get('status') == "Approved":
+                return status, outcome
+        return status, outcome
+
+    def run_reconciliation(self, repair=False):
+        """Start a reconciliation (waiting out one already running) and return the finished run"""
+        deadline = time.monotonic() + RECONCILE_WAIT_SECONDS
+        while True:
+            status, run = self.request("POST", "admin/stock-reconciliation", {"repair": repair})
+            if status != 409 or time.monotonic() > deadline:
+                break
+            time.sleep(2)
+        if status != 200:
+            return {"status": f"HTTP {status}"}
+        while time.monotonic() < deadline:
+            _, runs = self.request("GET", "admin/stock-reconciliation")
+            current = next((r for r in runs if r.get('id') == run['id']), {})
+            if current.get('status') != "Running":
+                return current
+            time.sleep(2)
+        return {"status": "Timed out"}
+
+    def drift_for(self, run, fixture):
+        return [
+            d for d in run.get('discrepancies', [])
+            if d['item_id'] == fixture['item'].get('id') and d['warehouse_id'] == fixture['warehouse'].get('id')
+        ]
+
+    def test_post_and_reconcile(self):
+        print("\n" + "="*60)
+        print("POSTING AND RECONCILIATION TESTS")
+        print("="*60)
+
+        fixture = self.create_stock_fixture("reconcile")
+        for qty in (10, 5):
+            status, _ = self.post_inward(fixture, qty)
+            self.check(f"Stock inward of {qty}", status == 200, f"HTTP {status}")
+        status, _ = self.post_issue(fixture, 4)
+        self.check("Issue of 4", status == 200, f"HTTP {status}")
+        stock = self.available(fixture)
+        self.check("Balance is 11 after posting", stock.get('qty') == 11, f"balance {stock}")
+
+        run = self.run_reconciliation()
+        self.check("Reconciliation completes", run.get('status') == "Completed", f"run {run.get('status')}: {run.get('error')}")
+        drift = self.drift_for(run, fixture)
+        self.check("Posted balance reconciles", not drift, f"discrepancies {drift}")
+
+    def test_reserve_issue_sweep(self):
+        print("\n" + "="*60)
+        print("RESERVATION TESTS")
+        print("="*60)
+
+        fixture = self.create_stock_fixture("reserve")
+        self.post_inward(fixture, 10)
+        status, reservation = self.reserve(fixture, 6)
+        self.check("Reserve 6 of 10", status == 200, f"HTTP {status}")
+        status, _ = self.post_issue(fixture, 5)
+        self.check("Issue of 5 against 4 unreserved is refused", status == 400, f"HTTP {status}")
+        status, _ = self.post_issue(fixture, 6, reservation_id=reservation.get('id'))
+        self.check("Issue against the reservation", status == 200, f"HTTP {status}")
+        stock = self.available(fixture)
+        self.check("Reservation consumed by the issue", stock.get('qty') == 4 and stock.get('reserved_qty') == 0, f"balance {stock}")
+
+        status, _ = self.reserve(fixture, 3, ttl_minutes=1)
+        self.check("Reserve 3 for one minute", status == 200, f"HTTP {status}")
+        self.check("Reserved stock is held", self.available(fixture).get('available_qty') == 1, f"balance {self.available(fixture)}")
+        print(f"   Waiting up to {SWEEP_WAIT_SECONDS}s for the sweeper...")
+        deadline = time.monotonic() + SWEEP_WAIT_SECONDS
+        stock = self.available(fixture)
+        while stock.get('reserved_qty') and time.monotonic() < deadline:
+            time.sleep(5)
+            stock = self.available(fixture)
+        self.check("Expired reservation swept back to available", stock.get('reserved_qty') == 0 and stock.get('available_qty') == 4, f"balance {stock}")
+
+    def test_fefo_allocation(self):
+        print("\n" + "="*60)
+        print("FEFO TESTS")
+        print("="*60)
+
+        fixture = self.create_stock_fixture("fefo")
+        soon = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
+        later = (datetime.now(timezone.utc) + timedelta(days=180)).isoformat()
+        # The later lot is received first, so FEFO and FIFO disagree
+        self.post_inward(fixture, 5, batch_no="LATE", expiry_date=later)
+        self.post_inward(fixture, 5, batch_no="SOON", expiry_date=soon)
+        self.post_inward(fixture, 5, batch_no="UNDATED")
+
+        status, issue = self.post_issue(fixture, 3)
+        allocations = [(a.get('batch_no'), a.get('qty')) for a in issue.get('lot_allocations', [])]
+        self.check("Issue draws the earliest expiry first", status == 200 and allocations == [("SOON", 3)], f"HTTP {status}, allocations {allocations}")
+        status, issue = self.post_issue(fixture, 6)
+        allocations = [(a.get('batch_no'), a.get('qty')) for a in issue.get('lot_allocations', [])]
+        self.check("Issue spills into the next expiry", status == 200 and allocations == [("SOON", 2), ("LATE", 4)], f"HTTP {status}, allocations {allocations}")
+        status, issue = self.post_issue(fixture, 1, batch_no="UNDATED")
+        allocations = [(a.get('batch_no'), a.get('qty')) for a in issue.get('lot_allocations', [])]
+        self.check("Issue restricted to one lot", status == 200 and allocations == [("UNDATED", 1)], f"HTTP {status}, allocations {allocations}")
+        _, lots = self.request("GET", f"inventory/lots?item_id={fixture['item'].get('id')}")
+        remaining = {lot['batch_no']: lot['qty'] for lot in lots}
+        self.check("Lot balances after FEFO issues", remaining == {"LATE": 1, "UNDATED": 4}, f"lots {remaining}")
+
+    def test_cycle_count_adjustment(self):
+        print("\n" + "="*60)
+        print("CYCLE COUNT TESTS")
+        print("="*60)
+
+        fixture = self.create_stock_fixture("cycle count")
+        self.post_inward(fixture, 20)
+        status, sheets = self.request("POST", "inventory/cycle-counts/generate", {"warehouse_id": fixture['warehouse'].get('id')})
+        self.check("Generate a count sheet", status == 200 and len(sheets) == 1, f"HTTP {status}, {len(sheets) if status == 200 else sheets}")
+        if status != 200 or not sheets:
+            return
+        status, sheet = self.request("POST", f"inventory/cycle-counts/{sheets[0]['id']}/counts", {
+            "counts": [{"item_id": fixture['item'].get('id'), "counted_qty": 17}]
+        })
+        self.check("Submit counts with a variance of -3", status == 200 and len(sheet.get('adjustment_ids', [])) == 1, f"HTTP {status}")
+        if status != 200 or not sheet.get('adjustment_ids'):
+            return
+        self.check("Pending adjustment leaves stock alone", self.available(fixture).get('qty') == 20, f"balance {self.available(fixture)}")
+        status, outcome = self.approve_adjustment(sheet['adjustment_ids'][0])
+        self.check("Approve the count adjustment", status == 200 and outcome.get('status') == "Approved", f"HTTP {status}, {outcome}")
+        self.check("Approved adjustment posts to stock", self.available(fixture).get('qty') == 17, f"balance {self.available(fixture)}")
+        run = self.run_reconciliation()
+        drift = self.drift_for(run, fixture)
+        self.check("Counted balance reconciles", run.get('status') == "Completed" and not drift, f"run {run.get('status')}, discrepancies {drift}")
+
+    def test_concurrent_postings(self):
+        print("\n" + "="*60)
+        print("CONCURRENCY TESTS")
+        print("="*60)
+
+        fixture = self.create_stock_fixture("concurrent issue")
+        self.post_inward(fixture, 10)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = [status for status, _ in pool.map(lambda _: self.post_issue(fixture, 2), range(8))]
+        stock = self.available(fixture)
+        self.check("Concurrent issues never overdraw", statuses.count(200) == 5 and stock.get('qty') == 0, f"statuses {statuses}, balance {stock}")
+
+        fixture = self.create_stock_fixture("concurrent reserve")
+        self.post_inward(fixture, 10)
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            statuses = [status for status, _ in pool.map(lambda _: self.reserve(fixture, 3), range(6))]
+        stock = self.available(fixture)
+        self.check("Concurrent reservations stop at available stock", statuses.count(200) == 3 and stock.get('reserved_qty') == 9, f"statuses {statuses}, balance {stock}")
+
+        fixture = self.create_stock_fixture("concurrent approval")
+        self.post_inward(fixture, 10)
+        status, adjustment = self.request("POST", "inventory/adjustment", {
+            "adjustment_no": "", "created_by": "test", "reason": "Found", "status": "Pending",
+            "item_id": fixture['item'].get('id'), "item_name": fixture['item'].get('item_name'),
+            "warehouse_id": fixture['warehouse'].get('id'), "adjustment_qty": 4, "uom": "NOS",
+        })
+        if status == 200:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                results = list(pool.map(lambda _: self.request("PUT", f"approvals/stock_adjustment/{adjustment['id']}/approve"), range(4)))
+            approved = [outcome for status, outcome in results if status == 200]
+            stock = self.available(fixture)
+            # With a multi-level flow, each approval moves one level; only the last one posts
+            self.check("Concurrent approvals post the adjustment at most once", stock.get('qty') in (10, 14) and len(approved) >= 1, f"{len(approved)} approvals, balance {stock}")
+
+        fixture = self.create_stock_fixture("reconcile while posting")
+        self.post_inward(fixture, 10)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            repair = pool.submit(self.run_reconciliation, True)
+            postings = [self.post_inward(fixture, 1)[0] for _ in range(20)] + [self.post_issue(fixture, 1)[0] for _ in range(10)]
+            repair_run = repair.result()
+        self.check("Postings during a repair run succeed", set(postings) == {200}, f"statuses {postings}")
+        self.check("Repair run completes", repair_run.get('status') == "Completed", f"run {repair_run.get('status')}: {repair_run.get('error')}")
+        stock = self.available(fixture)
+        self.check("Repair doesn't overwrite concurrent postings", stock.get('qty') == 20, f"balance {stock}")
+        run = self.run_reconciliation()
+        self.check("Balance still reconciles after the repair run", not self.drift_for(run, fixture), f"discrepancies {self.drift_for(run, fixture)}")
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            statuses = [status for status, _ in pool.map(lambda _: self.request("POST", "admin/stock-reconciliation", {"repair": False}), range(3))]
+        self.check("Only one reconciliation starts at a time", statuses.count(200) <= 1 and statuses.count(200) + statuses.count(409) == 3, f"statuses {statuses}")
+
+    def test_stock_flows(self):
+        """End-to-end stock scenarios; they create their own items and warehouses"""
+        self.test_post_and_reconcile()
+        self.test_fefo_allocation()
+        self.test_cycle_count_adjustment()
+        self.test_concurrent_postings()
+        self.test_reserve_issue_sweep()
+
+    # ---------- Request handling scenarios ----------
+    def test_gst_rounding(self):
+        print("\n" + "="*60)
+        print("GST COMPUTATION TESTS")
+        print("="*60)
+
+        suffix = uuid.uuid4().hex[:8]
+        hsn_code = f"99{suffix}"
+        self.run_test("Create 18% HSN", "POST", "masters/tax-hsn", 200, data={
+            "hsn_code": hsn_code, "description": "Test goods", "cgst_rate": 9, "sgst_rate": 9, "igst_rate": 18,
+        })
+        fixture = self.create_stock_fixture("gst")
+        item = fixture['item']
+        self.run_test("Set item HSN", "PUT", f"masters/items/{item.get('id')}", 200, data={**item, "hsn": hsn_code})
+        _, supplier = self.run_test("Create Maharashtra supplier", "POST", "masters/suppliers", 200, data={
+            "supplier_code": f"SUP-{suffix}", "name": f"Test supplier {suffix}", "gst": "27AAAAA0000A1Z5",
+        })
+        warehouses = {}
+        for state in ("27", "29"):
+            _, warehouses[state] = self.run_test(f"Create warehouse in state {state}", "POST", "masters/warehouses", 200, data={
+                "warehouse_name": f"Test GST warehouse {state} {suffix}", "warehouse_type": "Store", "gst_state_code": state,
+            })
+
+        def create_po(state):
+            lines = [(2, 50.25), (3, 33.335)]
+            status, po = self.request("POST", "purchase/orders", {
+                "po_no": "", "supplier_id": supplier.get('id'), "supplier_name": supplier.get('name'),
+                "warehouse_id": warehouses[state].get('id'), "created_by": "test",
+                "items": [
+                    {"item_id": item.get('id'), "item_name": item.get('item_name'), "qty": qty, "uom": "NOS",
+                     "rate": rate, "amount": 0, "total": 0}
+                    for qty, rate in lines
+                ],
+                "subtotal": 0, "tax_amount": 0, "total_amount": 0,
+            })
+            self.check(f"PO delivered to state {state} is created", status == 200, f"HTTP {status}: {po}")
+            return po
+
+        # 100.50 at 9% is 9.045 per half, which binary floats round down; 3 x 33.335 is 100.005
+        intra = create_po("27")
+        lines = intra.get('items', [{}, {}])
+        self.check("Intra-state PO is split into CGST and SGST",
+                   intra.get('tax_type') == "intra" and [(line.get('cgst_amount'), line.get('sgst_amount'), line.get('igst_amount')) for line in lines] == [(9.05, 9.05, 0), (9.0, 9.0, 0)],
+                   f"{intra.get('tax_type')}: {lines}")
+        self.check("Line amount rounds half up to the paisa", lines[1].get('amount') == 100.01, f"amount {lines[1].get('amount')}")
+        self.check("Intra-state totals add up in paise",
+                   (intra.get('subtotal'), intra.get('tax_amount'), intra.get('total_amount')) == (200.51, 36.1, 236.61),
+                   f"{intra.get('subtotal')} + {intra.get('tax_amount')} = {intra.get('total_amount')}")
+
+        inter = create_po("29")
+        lines = inter.get('items', [{}, {}])
+        self.check("Inter-state PO carries IGST only",
+                   inter.get('tax_type') == "inter" and [(line.get('cgst_amount'), line.get('sgst_amount'), line.get('igst_amount')) for line in lines] == [(0, 0, 18.09), (0, 0, 18.0)],
+                   f"{inter.get('tax_type')}: {lines}")
+        self.check("Inter-state totals add up in paise",
+                   (inter.get('subtotal'), inter.get('tax_amount'), inter.get('total_amount')) == (200.51, 36.09, 236.6),
+                   f"{inter.get('subtotal')} + {inter.get('tax_amount')} = {inter.get('total_amount')}")
+
+    def test_uom_conversion(self):
+        print("\n" + "="*60)
+        print("UOM CONVERSION TESTS")
+        print("="*60)
+
+        suffix = uuid.uuid4().hex[:6].upper()
+        box, pack, piece, other = (f"{name}{suffix}" for name in ("BOX", "PACK", "PC", "KG"))
+        for uom, conversions in ((box, {pack: 10}), (pack, {piece: 100}), (piece, None), (other, None)):
+            self.run_test(f"Create UOM {uom}", "POST", "masters/uoms", 200, data={
+                "uom_name": uom, "uom_type": "Count", "decimal_precision": 2, "conversions": conversions,
+            })
+        # PC -> BOX has no direct entry; it is found through PACK, in reverse
+        cases = [
+            (1, box, piece, 1000.0),
+            (500, piece, box, 0.5),
+            (5, pack, box, 0.5),
+            (2.5, piece.lower(), piece, 2.5),
+            (1, piece, box, 0.0),
+        ]
+        status, results = self.request("POST", "uoms/convert", {
+            "lines": [{"qty": qty, "from_uom": src, "to_uom": dst} for qty, src, dst, _ in cases]
+                     + [{"qty": 1, "from_uom": box, "to_uom": other}],
+        })
+        self.check("Convert request succeeds", status == 200 and len(results) == len(cases) + 1, f"HTTP {status}: {results}")
+        if status == 200:
+            for (qty, src, dst, expected), result in zip(cases, results):
+                self.check(f"{qty} {src} is {expected} {dst}", result.get('qty') == expected, f"got {result}")
+            self.check("Unconnected UOMs report an error", results[-1].get('qty') is None and results[-1].get('error'), f"got {results[-1]}")
+
+        status, results = self.request("POST", "uoms/convert", {
+            "lines": [{"qty": 1, "from_uom": piece, "to_uom": box}], "round_to_precision": False,
+        })
+        qty = results[0].get('qty') if status == 200 and results else None
+        self.check("Unrounded conversion keeps full precision", qty is not None and abs(qty - 0.001) < 1e-12, f"HTTP {status}: {results}")
+
+    def test_field_projection_and_compression(self):
+        print("\n" + "="*60)
+        print("SPARSE FIELDSET AND COMPRESSION TESTS")
+        print("="*60)
+
+        _, pos = self.run_test("Parent and child fields together", "GET", "purchase/orders?fields=items,items.qty", 200)
+        self.check("Only the requested fields come back",
+                   all(set(po) <= {"id", "items"} for po in pos), f"keys {[sorted(po) for po in pos[:3]]}")
+        self.run_test("Hidden field is refused", "GET", "masters/items?fields=password_hash", 400)
+        self.run_test("Operator field is refused", "GET", "masters/items?fields=$where", 400)
+
+        refused = self.fetch("masters/items", {"Accept-Encoding": "gzip;q=0"})
+        self.check("gzip;q=0 is not gzipped", refused.status_code == 200 and refused.headers.get('Content-Encoding') != "gzip",
+                   f"HTTP {refused.status_code}, Content-Encoding {refused.headers.get('Content-Encoding')}")
+        identity = self.fetch("masters/items", {"Accept-Encoding": "identity"})
+        self.check("identity is not encoded", 'Content-Encoding' not in identity.headers, f"Content-Encoding {identity.headers.get('Content-Encoding')}")
+        accepted = self.fetch("masters/items", {"Accept-Encoding": "gzip"})
+        if len(accepted.content) >= 1024:
+            self.check("gzip is used when accepted", accepted.headers.get('Content-Encoding') == "gzip",
+                       f"Content-Encoding {accepted.headers.get('Content-Encoding')}")
+
+    def test_delta_sync(self):
+        print("\n" + "="*60)
+        print("DELTA SYNC TESTS")
+        print("="*60)
+
+        _, first = self.run_test("Initial sync", "GET", "sync?entities=items", 200)
+        self.check("Initial sync is a full download", first.get('reset') is True, f"reset {first.get('reset')}")
+        self.run_test("Unknown entity is refused", "GET", "sync?entities=nonsense", 400)
+        _, ahead = self.run_test("Sync from a future version", "GET", f"sync?entities=items&since={first.get('version', 0) + 10**9}", 200)
+        self.check("A version ahead of the server resets", ahead.get('reset') is True, f"reset {ahead.get('reset')}")
+
+        fixture = self.create_stock_fixture("sync")
+        version, seen, pages = first.get('version', 0), set(), 0
+        while pages < 100:
+            status, page = self.request("GET", f"sync?entities=items&since={version}")
+            if status != 200:
+                break
+            pages += 1
+            # Version 0 (a young database, inside the overlap window) always means a full download
+            if version > 0:
+                self.check("Follow-up sync is incremental", page.get('reset') is False, f"reset on page {pages}")
+            seen.update(doc['id'] for doc in page.get('changes', {}).get('items', []))
+            self.check("Sync version never goes backwards", page.get('version', 0) >= version, f"{page.get('version')} < {version}")
+            version = page.get('version', 0)
+            if not page.get('has_more'):
+                break
+        self.check("New item arrives through the cursor", fixture['item'].get('id') in seen, f"{len(seen)} items over {pages} pages")
+
+    def test_xlsx_export(self):
+        print("\n" + "="*60)
+        print("REPORT EXPORT TESTS")
+        print("="*60)
+
+        response = self.fetch("reports/pending-po?format=xlsx&fields=po_no,total_amount")
+        self.check("xlsx export succeeds", response.status_code == 200 and "spreadsheetml" in response.headers.get('Content-Type', ''),
+                   f"HTTP {response.status_code}, {response.headers.get('Content-Type')}")
+        try:
+            with zipfile.ZipFile(io.BytesIO(response.content)) as workbook:
+                names = set(workbook.namelist())
+                sheet = workbook.read("xl/worksheets/sheet1.xml").decode("utf-8") if "xl/worksheets/sheet1.xml" in names else ""
+        except zipfile.BadZipFile as e:
+            names, sheet = set(), ""
+            self.check("xlsx export is a zip", False, str(e))
+        self.check("Workbook has its package parts", {"[Content_Types].xml", "xl/workbook.xml", "xl/worksheets/sheet1.xml"} <= names, f"parts {sorted(names)}")
+        self.check("Sheet starts with the requested columns", "<row>" in sheet and "po_no" in sheet.split("</row>")[0] and "total_amount" in sheet.split("</row>")[0],
+                   sheet[:300])
+        self.check("Sheet is well formed", sheet.endswith("</sheetData></worksheet>"), sheet[-100:])
+
+    def test_rate_limit(self):
+        """Run last: it drains this caller's token bucket"""
+        print("\n" + "="*60)
+        print("ADMISSION CONTROL TESTS")
+        print("="*60)
+
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            responses = list(pool.map(lambda _: self.fetch("reports/pending-po"), range(120)))
+        limited = [r for r in responses if r.status_code == 429]
+        self.check("A burst of reports is rate limited", limited, f"statuses {sorted({r.status_code for r in responses})}")
+        self.check("Shed requests are 429 or 503 only", all(r.status_code in (200, 429, 503) for r in responses),
+                   f"statuses {sorted({r.status_code for r in responses})}")
+        retry_after = [r.headers.get('Retry-After', '') for r in limited]
+        self.check("429s say when to retry", all(value.isdigit() and int(value) >= 1 for value in retry_after), f"Retry-After {retry_after[:5]}")
+        if retry_after and all(value.isdigit() for value in retry_after):
+            time.sleep(max(int(value) for value in retry_after))
+        status, _ = self.request("GET", "reports/pending-po")
+        self.check("Requests are admitted again after Retry-After", status == 200, f"HTTP {status}")
+
+    def test_request_handling(self):
+        """Tax, UOM, sync and transport behaviour; the rate-limit burst runs separately, last"""
+        self.test_gst_rounding()
+        self.test_uom_conversion()
+        self.test_field_projection_and_compression()
+        self.test_delta_sync()
+        self.test_xlsx_export()
+
     def print_summary(self):
         """Print test summary"""
         print("\n" + "="*60)
@@ -325,6 +793,9 @@ def main():
     tester.test_quality()
     tester.test_inventory()
     tester.test_reports()
+    tester.test_stock_flows()
+    tester.test_request_handling()
+    tester.test_rate_limit()
     
     # Print summary
     tester.print_summary()
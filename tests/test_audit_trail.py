@@ -0,0 +1,82 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import bson
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+
+
+class MemoryCollection:
+    """insert_many with pymongo's client-side encoding check; ``down`` simulates an outage"""
+
+    def __init__(self):
+        self.docs = []
+        self.down = False
+
+    async def insert_many(self, docs, ordered=True):
+        if self.down:
+            raise ConnectionError("audit_log unreachable")
+        for doc in docs:
+            bson.encode(doc)
+        self.docs.extend(docs)
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self.audit_log = MemoryCollection()
+        self.audit_dead_letter = MemoryCollection()
+
+
+@pytest.fixture
+def database():
+    memory = MemoryDatabase()
+    server.db.bind(memory)
+    yield memory
+    server.db.bind(None)
+
+
+def record(trail, n, **after):
+    for i in range(n):
+        trail.record("item", str(i), "create", {"user_id": "u1"}, after={"n": i, **after})
+
+
+def test_overflow_spills_to_disk_and_replays_in_order(database, tmp_path):
+    trail = server.AuditTrail(batch_size=2, flush_ms=10, max_buffer=3, spill_path=tmp_path / "spill.jsonl")
+    database.audit_log.down = True
+    record(trail, 7)
+    assert len(trail.buffer) == 3 and trail.spilled == 4
+    asyncio.run(trail.flush())
+    assert database.audit_log.docs == []
+
+    database.audit_log.down = False
+    asyncio.run(trail.flush())
+    assert [doc['entity_id'] for doc in database.audit_log.docs] == [str(i) for i in range(7)]
+    assert not list(tmp_path.iterdir())
+
+
+def test_unencodable_entries_are_dead_lettered(database, tmp_path):
+    trail = server.AuditTrail(batch_size=10, flush_ms=10, max_buffer=100, spill_path=tmp_path / "spill.jsonl")
+    record(trail, 2)
+    trail.record("item", "bad", "create", None, after={"tags": {"a", "b"}})
+    asyncio.run(trail.flush())
+    assert sorted(doc['entity_id'] for doc in database.audit_log.docs) == ["0", "1"]
+    assert [doc['entity_id'] for doc in database.audit_dead_letter.docs] == ["bad"]
+    assert trail.buffer == []
+
+
+def test_stop_keeps_entries_when_nothing_is_writable(database, tmp_path):
+    trail = server.AuditTrail(batch_size=10, flush_ms=10, max_buffer=100, spill_path=tmp_path / "missing" / "spill.jsonl")
+
+    async def run():
+        trail.start()
+        database.audit_log.down = True
+        record(trail, 3)
+        await trail.stop()
+
+    asyncio.run(run())
+    assert len(database.audit_dead_letter.docs) == 3
+    assert trail.buffer == []
@@ -0,0 +1,38 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import forecasting  # noqa: E402
+import server  # noqa: E402
+
+
+def test_smooth_series_tracks_level():
+    history = np.full((1, 60), 4.0)
+    daily, std, intermittent = forecasting.fit_demand(history, 0.2)
+    assert not intermittent[0]
+    assert daily[0] == 4.0
+    assert std[0] == 0.0
+
+
+def test_sparse_series_uses_croston():
+    history = np.zeros((1, 60))
+    history[0, ::10] = 10.0
+    daily, _, intermittent = forecasting.fit_demand(history, 0.2)
+    assert intermittent[0]
+    # About one unit a day, shrunk by the Syntetos-Boylan factor
+    assert 0.8 < daily[0] < 1.0
+
+
+def test_process_pool_matches_serial_fit(monkeypatch):
+    rng = np.random.default_rng(7)
+    history = rng.poisson(2.0, size=(40, 30)).astype(float)
+    monkeypatch.setattr(server, "FORECAST_WORKERS", 2)
+    monkeypatch.setattr(server, "FORECAST_CHUNK_SIZE", 10)
+    parallel = asyncio.run(server.fit_demand_parallel(history, 0.3))
+    serial = forecasting.fit_demand(history, 0.3)
+    for got, want in zip(parallel, serial):
+        np.testing.assert_array_equal(got, want)
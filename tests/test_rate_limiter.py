@@ -0,0 +1,61 @@
+import asyncio
+import sys
+from pathlib import Path
+from typing import Dict
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from fastapi import APIRouter, Depends, FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+
+
+def test_bucket_denies_then_refills():
+    limiter = server.TokenBucketLimiter()
+    assert asyncio.run(limiter.acquire("k", 2.0, 1.0, 2.0)) == 0.0
+    assert asyncio.run(limiter.acquire("k", 2.0, 1.0, 2.0)) > 0.0
+
+
+def test_prune_drops_only_refilled_buckets(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: clock[0])
+    limiter = server.TokenBucketLimiter(prune_interval=8.0)
+
+    asyncio.run(limiter.acquire("idle", 10.0, 1.0, 1.0))
+    clock[0] += 5.0
+    asyncio.run(limiter.acquire("busy", 10.0, 1.0, 5.0))
+    clock[0] += 4.0
+    # Next acquire triggers the sweep: "idle" refilled 1s after its request, "busy" is full again only at t=1010
+    asyncio.run(limiter.acquire("new", 10.0, 1.0, 1.0))
+    assert set(limiter._buckets) == {"busy", "new"}
+
+
+def test_admission_and_route_share_one_token_decode(monkeypatch):
+    calls = []
+    decode = server.jwt.decode
+    monkeypatch.setattr(server.jwt, "decode", lambda *a, **kw: calls.append(1) or decode(*a, **kw))
+
+    router = APIRouter()
+
+    @router.get("/me")
+    async def me(current_user: Dict = Depends(server.get_current_user)):
+        return current_user
+
+    @router.get("/public")
+    async def public():
+        return {}
+
+    app = FastAPI()
+    app.include_router(router, dependencies=[Depends(server.admission_control)])
+    client = TestClient(app)
+
+    token = server.create_jwt_token(server.User(id="u1", email="a@example.com", name="A", role=server.UserRole.ADMIN))
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert response.json()["user_id"] == "u1"
+    assert len(calls) == 1
+
+    assert client.get("/me").status_code == 403
+    assert client.get("/me", headers={"Authorization": "Bearer junk"}).status_code == 401
+    assert client.get("/public", headers={"Authorization": "Bearer junk"}).status_code == 200
@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+
+
+def test_module_imports():
+    assert server.api_router.routes
+
+
+def test_create_app_builds_without_connecting():
+    app = server.create_app(server.Settings(mongo_url="mongodb://localhost:1", db_name="test"))
+    assert any(route.path == "/api/inventory/issue" for route in app.routes)
+
+
+def test_reconcile_cli_imports():
+    import reconcile
+    assert reconcile.cli
@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def converter():
+    converter = server.UOMConverter()
+    converter.compile([
+        {"uom_name": "ROLL", "conversions": {"MTR": 50}, "decimal_precision": 3},
+        {"uom_name": "MTR", "conversions": {"CM": 100}, "decimal_precision": 2},
+        {"uom_name": "NOS", "conversions": {}, "decimal_precision": 0},
+    ])
+    return converter
+
+
+def test_conversions_close_transitively(converter):
+    assert converter.factor("ROLL", "CM") == 5000
+    assert converter.convert(125, "MTR", "ROLL") == 2.5
+    assert converter.convert(1, "cm", "roll") == 0.0
+
+
+def test_same_uom_converts_even_if_unlisted(converter):
+    assert converter.convert(5, "BOX", "box") == 5
+
+
+def test_unconvertible_uom_is_refused(converter):
+    # 5 MTR must never be booked as 5 of a UOM with no path to MTR
+    with pytest.raises(HTTPException) as error:
+        converter.convert(5, "MTR", "NOS")
+    assert error.value.status_code == 400